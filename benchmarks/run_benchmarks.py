@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# Time each stage of a moving target search against the local stand-in services, without network access
+#
+# Usage:
+#   python benchmarks/run_benchmarks.py --sizes 100 1000 10000 100000 --output results.json
+#   python benchmarks/run_benchmarks.py --baseline results.json  # exit code 1 on regressions
+#   python benchmarks/run_benchmarks.py --sizes 10000 --metrics metrics.txt  # breakdown of the inner stages
+
+import os
+import sys
+import json
+import time
+import argparse
+import warnings
+import numpy as np
+from astropy.time import Time
+from bokeh.embed import json_item
+
+# Run from a checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from movingmast.target import get_path, convert_path_to_polygon
+from movingmast.mast_tap import run_tap_query, clean_up_results
+from movingmast.plotting import mast_bokeh
+from movingmast.local_services import FixtureEngine, LocalTapService, synthetic_observations
+from movingmast.metrics import get_metrics
+
+STAGES = ['get_path', 'convert_path_to_polygon', 'run_tap_query', 'clean_up_results', 'mast_bokeh']
+TARGET = {'obj_name': '1143', 'id_type': 'smallbody', 'start': '2015-08-20', 'stop': '2015-09-01'}
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')  # fixtures of TARGET
+
+
+def timed(function, *args, repeat=1, **kwargs):
+    # Best time of several runs and the result of the last one
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run_size(n_rows, fixtures=None, step='1h', radius=0.2, repeat=1, latency=0.):
+    """
+    Time the stages of a search returning about n_rows MAST records.
+
+    Returns
+    -------
+    record : dict
+        Seconds for each stage, with the number of rows returned and the size of the serialized plot
+    """
+
+    engine = FixtureEngine(fixtures, latency=latency)
+    times = {'start': TARGET['start'], 'stop': TARGET['stop'], 'step': step}
+    record = {'size': n_rows}
+
+    record['get_path'], eph = timed(get_path, TARGET['obj_name'], times, id_type=TARGET['id_type'], cache=False,
+                                    engine=engine, repeat=repeat)
+    record['convert_path_to_polygon'], stcs = timed(convert_path_to_polygon, eph, radius=radius, repeat=repeat)
+
+    # About 80% of the observations fall within the search polygon
+    catalog = synthetic_observations(eph, int(np.ceil(n_rows / 0.8)), radius=radius, on_path=0.8,
+                                     missions=['HST', 'K2'], seed=n_rows)
+    start, end = Time(TARGET['start']).mjd, Time(TARGET['stop']).mjd
+    with LocalTapService(catalog, latency=latency) as tap:
+        # All records, fetched in pages (see iter_tap_query)
+        record['run_tap_query'], results = timed(run_tap_query, stcs, start, end, service=tap.url, maxrec=None,
+                                                 cache=False, repeat=repeat)
+        record['bytes_received'] = tap.bytes_sent // repeat
+    record['rows'] = len(results)
+
+    record['clean_up_results'], _ = timed(clean_up_results, results, TARGET['obj_name'], orig_eph=eph,
+                                          id_type=TARGET['id_type'], radius=radius, engine=engine, repeat=repeat)
+
+    def plot():
+        layout = mast_bokeh(eph, results, stcs, refresh=False)
+        return len(json.dumps(json_item(layout)))
+
+    record['mast_bokeh'], record['plot_bytes'] = timed(plot, repeat=repeat)
+    return record
+
+
+def compare(records, baseline, tolerance=1.5, minimum=0.05):
+    """
+    Stages slower than tolerance times the baseline (ignoring differences below minimum seconds).
+
+    Returns
+    -------
+    regressions : list
+        (size, stage, seconds, baseline seconds) of each regression
+    """
+
+    reference = {r['size']: r for r in baseline}
+    regressions = []
+    for record in records:
+        base = reference.get(record['size'])
+        if base is None:
+            continue
+        for stage in STAGES:
+            if stage in base and record[stage] > tolerance * base[stage] and record[stage] - base[stage] > minimum:
+                regressions.append((record['size'], stage, record[stage], base[stage]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the search stages with local stand-in services.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help='Numbers of MAST records to benchmark (default: 100 1000 10000 100000)')
+    parser.add_argument('--fixtures', default=FIXTURES,
+                        help='Fixture directory from movingmast.local_services.record_fixtures '
+                             '(default: benchmarks/fixtures)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs of each stage, keeping the best (default: 1)')
+    parser.add_argument('--latency', type=float, default=0., help='Simulated round-trip per request in seconds')
+    parser.add_argument('--output', default=None, help='Write the timings to this JSON file')
+    parser.add_argument('--baseline', default=None, help='Compare with the timings in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='Slowdown factor reported as a regression (default: 1.5)')
+    parser.add_argument('--metrics', default=None,
+                        help='Write the timers and counters of the inner stages (Prometheus text format) to this file')
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    records = []
+    print(f"{'size':>8} {'rows':>8} " + ' '.join(f'{s[:14]:>14}' for s in STAGES) + f" {'plot KB':>9}")
+    for size in args.sizes:
+        record = run_size(size, fixtures=args.fixtures, repeat=args.repeat, latency=args.latency)
+        records.append(record)
+        print(f"{size:>8} {record['rows']:>8} " + ' '.join(f'{record[s]:>14.3f}' for s in STAGES) +
+              f" {record['plot_bytes'] / 1024:>9.0f}", flush=True)
+
+    if args.metrics is not None:
+        with open(args.metrics, 'w') as f:
+            f.write(get_metrics().prometheus_text())
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(records, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(records, json.load(f), tolerance=args.tolerance)
+        for size, stage, seconds, reference in regressions:
+            print(f'REGRESSION: {stage} with {size} records took {seconds:.3f} s (baseline {reference:.3f} s)')
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
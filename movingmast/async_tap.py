@@ -0,0 +1,162 @@
+# Functions to handle concurrent asynchronous TAP jobs with asyncio
+
+import asyncio
+import threading
+import pyvo as vo
+from .metrics import span
+
+FINAL_PHASES = ('COMPLETED', 'ERROR', 'ABORTED')
+
+
+def run_coroutine(coroutine):
+    """
+    Run a coroutine to completion and return its result, blocking the calling thread.
+    Works both from plain scripts and from code that already runs an event loop (eg, Jupyter or Panel),
+    in which case the coroutine runs in a separate thread with its own loop, but the running loop is blocked
+    until it is done. Code running in an event loop should await the coroutines instead
+    (eg, run_tap_queries_async, run_chunked_tap_query_async or fetch_columns_async).
+    """
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    result = {}
+
+    def target():
+        try:
+            result['value'] = asyncio.run(coroutine)
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+class AsyncTapClient:
+    """
+    Client to submit ADQL queries as UWS (asynchronous) jobs to a TAP service, poll their phase and
+    fetch their results, with many jobs in flight at once.
+
+    The blocking HTTP calls of pyvo run in worker threads so the event loop can overlap the network waits.
+
+    Parameters
+    ----------
+    service : str
+        TAP service URL
+    max_concurrent : int
+        Maximum number of jobs running at the same time (Default: 4)
+    timeout : float
+        Timeout for each job in seconds, None for no timeout (Default: 600)
+    poll_interval : float
+        Initial time between phase checks in seconds (Default: 0.5)
+    max_poll_interval : float
+        Maximum time between phase checks in seconds (Default: 10)
+    backoff : float
+        Factor to increase the time between phase checks (Default: 1.5)
+    session : requests.Session
+        HTTP session for the requests, eg a CountingSession (Default: None, a new session)
+    """
+
+    def __init__(self, service, max_concurrent=4, timeout=600, poll_interval=0.5, max_poll_interval=10,
+                 backoff=1.5, session=None):
+        self.service = service
+        self.tap = vo.dal.TAPService(service, session=session)
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+
+    async def _call(self, function, *args, **kwargs):
+        # Run a blocking pyvo call in a worker thread
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: function(*args, **kwargs))
+
+    async def _run_job(self, query, maxrec=None):
+        with span('tap_job', service=self.service) as stage:
+            table = await self._wait_job(query, maxrec=maxrec)
+            stage.set(rows=len(table))
+        return table
+
+    async def _wait_job(self, query, maxrec=None):
+        job = await self._call(self.tap.submit_job, query, maxrec=maxrec)
+        try:
+            await self._call(job.run)
+
+            # Poll the job phase with an increasing interval
+            delay = self.poll_interval
+            phase = await self._call(lambda: job.phase)
+            while phase not in FINAL_PHASES:
+                await asyncio.sleep(delay)
+                delay = min(delay * self.backoff, self.max_poll_interval)
+                phase = await self._call(lambda: job.phase)
+
+            if phase != 'COMPLETED':
+                await self._call(job.raise_if_error)
+                raise RuntimeError(f'TAP job {job.job_id} finished with phase {phase}')
+            results = await self._call(job.fetch_result)
+            return await self._call(results.to_table)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            # Stop the job on the server when cancelled or timed out
+            try:
+                await asyncio.shield(self._call(job.abort))
+            except Exception:
+                pass
+            raise
+        finally:
+            try:
+                await asyncio.shield(self._call(job.delete))
+            except Exception:
+                pass
+
+    async def query(self, query, maxrec=None, semaphore=None):
+        """
+        Run a single ADQL query as an asynchronous job.
+
+        Parameters
+        ----------
+        query : str
+            ADQL query
+        maxrec : int
+            Maximum number of records to return
+        semaphore : asyncio.Semaphore
+            Semaphore limiting the number of concurrent jobs (Default: None)
+
+        Returns
+        -------
+        results : astropy Table
+        """
+
+        if semaphore is None:
+            return await asyncio.wait_for(self._run_job(query, maxrec=maxrec), self.timeout)
+        async with semaphore:
+            return await asyncio.wait_for(self._run_job(query, maxrec=maxrec), self.timeout)
+
+    async def gather(self, queries, maxrec=None, return_exceptions=False):
+        """
+        Run many ADQL queries concurrently, with at most max_concurrent jobs at the same time.
+
+        Parameters
+        ----------
+        queries : list
+            ADQL queries
+        maxrec : int
+            Maximum number of records to return per query
+        return_exceptions : bool
+            Return exceptions in place of the results of failed queries instead of raising them (Default: False)
+
+        Returns
+        -------
+        results : list
+            Astropy Tables, in the same order as queries
+        """
+
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        return await asyncio.gather(*[self.query(q, maxrec=maxrec, semaphore=semaphore) for q in queries],
+                                    return_exceptions=return_exceptions)
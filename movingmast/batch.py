@@ -0,0 +1,200 @@
+# Functions to handle batch searches for many targets
+
+import sys
+import csv
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .target import get_path, adaptive_path, ADAPTIVE_STEP
+from .mast_tap import run_chunked_tap_query, clean_up_results, fetch_columns, add_time_columns, VERIFY_COLUMNS
+
+TARGET_COLUMNS = ['obj_name', 'id_type', 'start', 'stop', 'location']
+OUTPUT_COLUMNS = ['obs_id', 'obsID', 'obs_collection', 'instrument_name', 'filters', 'target_name',
+                  's_ra', 's_dec', 't_min', 't_max', 'obs_mid_date', 't_exptime', 'proposal_pi']
+
+
+def read_targets(filename):
+    """
+    Read a list of targets to search for.
+
+    Each line has comma-separated values of: obj_name, id_type, start, stop, location (optional), step (optional).
+    Blank lines and lines starting with # are ignored, as is a header line starting with obj_name.
+    Example:
+        1143, smallbody, 2015-08-20, 2015-09-01
+        65210, smallbody, 2018-07-25, 2018-08-22, @TESS, 12h
+
+    Parameters
+    ----------
+    filename: str
+        File with the targets
+
+    Returns
+    -------
+    targets: list
+        List of dictionaries with the target information
+    """
+
+    targets = []
+    with open(filename) as f:
+        for i, row in enumerate(csv.reader(f, skipinitialspace=True)):
+            row = [x.strip() for x in row]
+            if len(row) == 0 or row[0] == '' or row[0].startswith('#') or row[0] == 'obj_name':
+                continue
+            if len(row) < 4:
+                raise ValueError(f'Line {i + 1} of {filename} needs at least obj_name, id_type, start, stop: {row}')
+            location = row[4] if len(row) > 4 and row[4].lower() not in ('', 'none') else None
+            target = {'obj_name': row[0], 'id_type': row[1], 'start': row[2], 'stop': row[3], 'location': location}
+            if len(row) > 5 and row[5] != '':
+                target['step'] = row[5]
+            targets.append(target)
+    return targets
+
+
+def run_target(target, step='1d', radius=0.0083, maxrec=1000, mission=None, max_days=5., clean=True, columns=None,
+               swept=True, min_fraction=0., verbose=False):
+    """
+    Run the full search for a single target:
+    get_path -> run_chunked_tap_query (convert_path_to_polygon per segment) -> clean_up_results -> fetch_columns
+    Only the columns needed for the verification are queried at first, the rest are fetched for the remaining rows.
+
+    Parameters
+    ----------
+    target: dict
+        Target information (obj_name, id_type, start, stop, location and optionally step)
+    step: str
+        Time step for the ephemerides, if not given in target. Use auto for adaptive_path. (Default: 1d)
+    radius: float
+        Footprint radius/width in degrees
+    maxrec: int
+        Maximum number of MAST records
+    mission: str
+        Comma-separated missions to search for (Default: None, all missions)
+    max_days: float
+        Maximum duration in days of the path segments queried separately (Default: 5)
+    clean: bool
+        Verify the target is in the observation footprints with clean_up_results (Default: True)
+    columns: list
+        MAST columns to return (Default: None, uses OUTPUT_COLUMNS)
+    swept: bool
+        Verify the path of the target over each exposure rather than at mid-exposure, see clean_up_results
+        (Default: True)
+    min_fraction: float
+        With swept, minimum fraction of the exposure time in the footprint (Default: 0, any overlap)
+    verbose: bool
+        Flag to control verbosity of output messages. (Default: False)
+
+    Returns
+    -------
+    results: astropy Table
+        Astropy Table of results, can be empty
+    """
+
+    times = {'start': target['start'], 'stop': target['stop'], 'step': target.get('step', step)}
+    if str(times['step']).strip().lower() == ADAPTIVE_STEP:
+        eph = adaptive_path(target['obj_name'], times, radius=radius, id_type=target['id_type'],
+                            location=target['location'], verbose=verbose)
+    else:
+        eph = get_path(target['obj_name'], times, id_type=target['id_type'], location=target['location'])
+    if columns is None:
+        columns = OUTPUT_COLUMNS
+    results = run_chunked_tap_query(eph, radius=radius, max_days=max_days, mission=mission, maxrec=maxrec,
+                                    columns=VERIFY_COLUMNS if clean else columns, verbose=verbose)
+    if clean and len(results) > 0:
+        results = clean_up_results(results, target['obj_name'], orig_eph=eph, id_type=target['id_type'],
+                                   location=target['location'], radius=radius, swept=swept,
+                                   min_fraction=min_fraction)
+        results = fetch_columns(results, columns, verbose=verbose)
+    # ISO dates of the returned rows only
+    return add_time_columns(results)
+
+
+def run_batch(targets, outfile, max_workers=4, columns=None, **kwargs):
+    """
+    Run searches for many targets with a pool of workers.
+    Results are written to a CSV file as each target completes.
+
+    Parameters
+    ----------
+    targets: list
+        List of target dictionaries (see read_targets)
+    outfile: str or file
+        Output CSV file name or open file
+    max_workers: int
+        Number of targets to run concurrently (Default: 4)
+    columns: list
+        MAST columns to write (Default: None, uses OUTPUT_COLUMNS)
+    kwargs
+        Additional arguments for run_target
+
+    Returns
+    -------
+    summary: list
+        List of dictionaries with the target, number of results and error message (if any)
+    """
+
+    if columns is None:
+        columns = OUTPUT_COLUMNS
+
+    close = False
+    if isinstance(outfile, str):
+        outfile = open(outfile, 'w', newline='')
+        close = True
+
+    summary = []
+    try:
+        writer = csv.writer(outfile)
+        writer.writerow(TARGET_COLUMNS + columns)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(run_target, target, columns=columns, **kwargs): target for target in targets}
+            for future in as_completed(futures):
+                target = futures[future]
+                prefix = [target[c] if target[c] is not None else '' for c in TARGET_COLUMNS]
+                try:
+                    results = future.result()
+                except Exception as e:
+                    print(f"ERROR searching for {target['obj_name']}: {e}")
+                    summary.append({'target': target, 'n_results': 0, 'error': str(e)})
+                    continue
+
+                n_results = 0 if results is None else len(results)
+                for row in (results if n_results > 0 else []):
+                    writer.writerow(prefix + [row[c] if c in results.colnames else '' for c in columns])
+                outfile.flush()
+                summary.append({'target': target, 'n_results': n_results, 'error': None})
+                print(f"{target['obj_name']}: {n_results} results")
+    finally:
+        if close:
+            outfile.close()
+
+    return summary
+
+
+def main(argv=None):
+    # Console entry point: movingmast-batch targets.csv -o results.csv
+    parser = argparse.ArgumentParser(description='Search MAST for observations of many moving targets.')
+    parser.add_argument('targets', help='File with comma-separated obj_name, id_type, start, stop, location, step')
+    parser.add_argument('-o', '--output', required=True, help='Output CSV file')
+    parser.add_argument('-j', '--workers', type=int, default=4, help='Number of concurrent targets (Default: 4)')
+    parser.add_argument('--step', default='1d',
+                        help='Ephemerides time step, or auto to sample according to the target motion (Default: 1d)')
+    parser.add_argument('--radius', type=float, default=0.0083, help='Footprint radius/width in degrees')
+    parser.add_argument('--maxrec', type=int, default=1000, help='Maximum number of MAST records per target')
+    parser.add_argument('--mission', default=None, help='Comma-separated mission filter (Default: all missions)')
+    parser.add_argument('--max-days', type=float, default=5., help='Days per path segment query (Default: 5)')
+    parser.add_argument('--no-clean', action='store_true', help='Skip the footprint verification')
+    parser.add_argument('--midpoint-check', action='store_true',
+                        help='Verify the footprints at mid-exposure instead of over the whole exposures')
+    parser.add_argument('--min-fraction', type=float, default=0.,
+                        help='Minimum fraction of the exposure time in the footprint (Default: 0, any overlap)')
+    args = parser.parse_args(argv)
+
+    targets = read_targets(args.targets)
+    summary = run_batch(targets, args.output, max_workers=args.workers, step=args.step, radius=args.radius,
+                        maxrec=args.maxrec, mission=args.mission, max_days=args.max_days,
+                        clean=not args.no_clean, swept=not args.midpoint_check, min_fraction=args.min_fraction)
+    n_errors = sum(1 for s in summary if s['error'] is not None)
+    print(f'Completed {len(summary) - n_errors} of {len(summary)} targets', file=sys.stderr)
+    return 1 if n_errors > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
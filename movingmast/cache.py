@@ -0,0 +1,768 @@
+# Functions to handle caching of remote results
+
+import os
+import io
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime
+import numpy as np
+from astropy.table import Table, MaskedColumn
+from .metrics import count
+
+CACHE_DIR_ENV = 'MOVINGMAST_CACHE_DIR'
+CACHE_URL_ENV = 'MOVINGMAST_CACHE_URL'
+_STEP_UNITS = {'m': 1. / 1440, 'h': 1. / 24, 'd': 1., 'w': 7.}
+
+
+def default_cache_dir():
+    # Cache directory, can be overridden with the MOVINGMAST_CACHE_DIR environment variable
+    return os.environ.get(CACHE_DIR_ENV, os.path.join(os.path.expanduser('~'), '.movingmast', 'cache'))
+
+
+def step_to_days(step):
+    """
+    Convert a JPL Horizons step string to days.
+
+    Parameters
+    ----------
+    step : str
+        Step size, as used by JPL Horizons (eg, 30m, 12h, 1d)
+
+    Returns
+    -------
+    days : float or None
+        Step size in days or None if it could not be interpreted (eg, a number of intervals)
+    """
+
+    step = str(step).strip().lower()
+    for unit in ('min', 'hour', 'day', 'week'):
+        # Horizons also accepts the long forms (eg, 1day)
+        if step.endswith(unit):
+            step = step[:-len(unit)] + unit[0]
+            break
+    if len(step) < 2 or step[-1] not in _STEP_UNITS:
+        return None
+    try:
+        value = float(step[:-1])
+    except ValueError:
+        return None
+    if value <= 0:
+        return None
+    return value * _STEP_UNITS[step[-1]]
+
+
+def date_to_jd(date):
+    """
+    Convert a date string as used by JPL Horizons (eg, 2019-01-01 or 2019-01-01 12:00) to Julian Date.
+
+    Parameters
+    ----------
+    date : str
+        Date string
+
+    Returns
+    -------
+    jd : float or None
+        Julian Date or None if it could not be interpreted
+    """
+
+    for fmt in ('%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            value = datetime.strptime(str(date).strip(), fmt)
+        except ValueError:
+            continue
+        return (value - datetime(1858, 11, 17)).total_seconds() / 86400. + 2400000.5
+    return None
+
+
+def _hash(*items):
+    text = json.dumps(items, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:20]
+
+
+def _table_arrays(table):
+    # Columns, masks and metadata of a table as numpy arrays for np.savez
+    arrays = {}
+    columns = []
+    for i, name in enumerate(table.colnames):
+        col = table[name]
+        data = np.asarray(col)
+        if data.dtype.kind == 'O':
+            data = data.astype(str)
+        arrays[f'c{i}'] = data
+        mask = getattr(col, 'mask', None)
+        if mask is not None and np.any(mask):
+            arrays[f'm{i}'] = np.asarray(mask)
+        columns.append({'name': name, 'unit': None if col.unit is None else str(col.unit),
+                        'format': col.format})
+    meta = {'columns': columns, 'meta': dict(table.meta)}
+    arrays['__meta__'] = np.array(json.dumps(meta, default=str))
+    return arrays
+
+
+def write_table(table, filename):
+    """
+    Write an astropy Table to a compressed, columnar numpy (npz) file.
+    Masks, units and table metadata are preserved.
+
+    Parameters
+    ----------
+    table : astropy Table
+        Table to write
+    filename : str or file-like object
+        Output file name or open binary file
+    """
+
+    arrays = _table_arrays(table)
+    if not isinstance(filename, (str, os.PathLike)):
+        np.savez_compressed(filename, **arrays)
+        return
+
+    # Write to a temporary file first so concurrent readers never see a partial file
+    tmp_name = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_name, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_name, filename)
+
+
+def read_table(filename):
+    """
+    Read an astropy Table written with write_table.
+
+    Parameters
+    ----------
+    filename : str or file-like object
+        Input file name or open binary file
+
+    Returns
+    -------
+    table : astropy Table
+    """
+
+    with np.load(filename, allow_pickle=False) as data:
+        meta = json.loads(str(data['__meta__']))
+        table = Table(meta=meta['meta'])
+        for i, info in enumerate(meta['columns']):
+            if f'm{i}' in data:
+                col = MaskedColumn(data[f'c{i}'], mask=data[f'm{i}'], name=info['name'], unit=info['unit'])
+            else:
+                col = Table.Column(data[f'c{i}'], name=info['name'], unit=info['unit'])
+            col.format = info['format']
+            table.add_column(col)
+    return table
+
+
+class RedisBackend:
+    """
+    Shared cache level in a Redis-compatible key-value store (eg, Redis, Valkey or KeyDB), so the results
+    are shared by several dashboard processes or hosts. Tables are stored in the format of write_table.
+
+    Parameters
+    ----------
+    url : str
+        Server URL (eg, redis://localhost:6379/0). Requires the redis package.
+    client : object
+        Existing client with get, set, delete and scan_iter methods, instead of connecting to url (Default: None)
+    prefix : str
+        Prefix of the keys in the store (Default: movingmast:)
+    """
+
+    def __init__(self, url=None, client=None, prefix='movingmast:'):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError('RedisBackend requires the redis package (pip install redis)')
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        """
+        Return the table stored under key, or None if it is not available.
+        """
+
+        data = self.client.get(self.prefix + key)
+        if data is None:
+            return None
+        return read_table(io.BytesIO(data))
+
+    def put(self, key, table, ttl=None):
+        """
+        Store a table under key, expiring after ttl seconds (Default: None, no expiration).
+        """
+
+        buffer = io.BytesIO()
+        write_table(table, buffer)
+        self.client.set(self.prefix + key, buffer.getvalue(), ex=None if ttl is None else max(int(ttl), 1))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def keys(self, base):
+        """
+        Keys starting with base.
+        """
+
+        keys = set()
+        for key in self.client.scan_iter(match=f'{self.prefix}{base}_*'):
+            if isinstance(key, bytes):
+                key = key.decode()
+            keys.add(key[len(self.prefix):])
+        return keys
+
+    def clear(self):
+        for key in self.client.scan_iter(match=f'{self.prefix}*'):
+            self.client.delete(key)
+
+
+def get_backend(url=None):
+    """
+    Shared cache backend for a URL, by default from the MOVINGMAST_CACHE_URL environment variable.
+    Returns None when no URL is set.
+    """
+
+    url = url if url is not None else os.environ.get(CACHE_URL_ENV)
+    if not url:
+        return None
+    return RedisBackend(url)
+
+
+class TableCache:
+    """
+    Two-level (memory and disk) cache of astropy Tables keyed on content hashes,
+    with an optional shared level (eg, RedisBackend) for several processes or hosts.
+
+    The memory level keeps up to max_entries tables in least-recently-used order.
+    The disk level keeps up to max_bytes of files, evicting the least recently used ones.
+    Entries older than ttl seconds are treated as missing.
+    Concurrent identical requests can be coalesced into a single fetch with coalesce().
+
+    Parameters
+    ----------
+    directory : str
+        Directory for the disk cache. Default of None uses default_cache_dir().
+        Use False to keep the cache only in memory.
+    max_entries : int
+        Maximum number of tables to hold in memory
+    max_bytes : int
+        Maximum total size of the disk cache in bytes
+    ttl : float
+        Time to live for entries in seconds (Default: None, no expiration)
+    backend : RedisBackend
+        Shared level, checked after memory and disk. Default of None uses get_backend(), set from the
+        MOVINGMAST_CACHE_URL environment variable. Use False to disable it.
+    """
+
+    subdirectory = 'tables'
+
+    def __init__(self, directory=None, max_entries=128, max_bytes=512 * 1024 ** 2, ttl=None, backend=None):
+        if directory is None:
+            directory = os.path.join(default_cache_dir(), self.subdirectory)
+        self.directory = directory or None
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        if backend is None:
+            backend = get_backend()
+        self.backend = None if backend is False else backend
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._memory = OrderedDict()  # key -> (created, table)
+        self._inflight = {}  # key -> Future of the fetch in progress
+        self._lock = threading.RLock()
+        if self.directory is not None:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+            except OSError as e:
+                print(f'WARNING: Unable to create cache directory {self.directory}, using memory only: {e}')
+                self.directory = None
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, f'{key}.npz')
+
+    def _expired(self, created):
+        return self.ttl is not None and (time.time() - created) > self.ttl
+
+    def get(self, key):
+        """
+        Return a copy of the table stored under key, or None if it is not cached.
+        """
+
+        with self._lock:
+            table = self._get(key)
+            self._record(table is not None)
+            return None if table is None else table.copy()
+
+    def _record(self, hit):
+        # Lookup statistics, also counted in the metrics (see movingmast.metrics)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        count('cache_requests', cache=self.subdirectory, result='hit' if hit else 'miss')
+
+    def _get(self, key):
+        # Look up a table without copying it or updating the statistics
+        if key in self._memory:
+            created, table = self._memory[key]
+            if not self._expired(created):
+                self._memory.move_to_end(key)
+                return table
+            self._discard(key)
+            return None
+
+        table = None
+        if self.directory is not None:
+            filename = self._filename(key)
+            try:
+                table = read_table(filename)
+                os.utime(filename)  # mark as recently used for the disk eviction
+            except Exception:
+                table = None
+        if table is None and self.backend is not None:
+            try:
+                table = self.backend.get(key)
+            except Exception as e:
+                print(f'WARNING: Unable to read {key} from the shared cache: {e}')
+        if table is None:
+            return None
+        created = table.meta.pop('movingmast_created', 0.)
+        if self._expired(created):
+            self._discard(key)
+            return None
+        self._remember(key, table, created)
+        return table
+
+    def put(self, key, table):
+        """
+        Store a table under key in memory and on disk.
+        """
+
+        with self._lock:
+            created = time.time()
+            self._remember(key, table.copy(), created)
+            table = table.copy(copy_data=False)
+            table.meta['movingmast_created'] = created
+            if self.directory is not None:
+                try:
+                    write_table(table, self._filename(key))
+                    self._evict_disk()
+                except (OSError, TypeError, ValueError) as e:
+                    print(f'WARNING: Unable to write {key} to the cache: {e}')
+            if self.backend is not None:
+                try:
+                    self.backend.put(key, table, ttl=self.ttl)
+                except Exception as e:
+                    print(f'WARNING: Unable to write {key} to the shared cache: {e}')
+
+    def coalesce(self, key, fetch):
+        """
+        Run fetch() for key unless the same key is already being fetched, in which case wait for
+        that fetch and return a copy of its result. Concurrent identical requests (eg, from several
+        dashboard sessions) then reach the remote service only once.
+
+        Parameters
+        ----------
+        key : str
+            Request key, eg from key()
+        fetch : callable
+            Function without arguments returning the table
+
+        Returns
+        -------
+        table : astropy Table
+        """
+
+        flight, leader = self.join(key)
+        if not leader:
+            table = flight.result()  # raises the error of the first request
+            if table is None:
+                # The first request was abandoned, try again
+                return self.coalesce(key, fetch)
+            return table.copy()
+        try:
+            table = fetch()
+        except Exception as e:
+            self.finish(key, error=e)
+            raise
+        except BaseException:
+            self.finish(key)
+            raise
+        self.finish(key, table)
+        return table
+
+    def join(self, key):
+        """
+        Return the Future of the fetch in progress for key and whether the caller is leading it.
+        The leader must call finish() once the table is available or the fetch has failed.
+        """
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                count('cache_coalesced', cache=self.subdirectory)
+                return flight, False
+            flight = Future()
+            self._inflight[key] = flight
+            return flight, True
+
+    def finish(self, key, table=None, error=None):
+        """
+        Complete the fetch in progress for key, with its table or the error that stopped it.
+        Without either, the fetch is abandoned and waiting requests try again.
+        """
+
+        with self._lock:
+            flight = self._inflight.pop(key, None)
+        if flight is None:
+            return
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            flight.set_result(table)
+
+    def _remember(self, key, table, created):
+        self._memory[key] = (created, table)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _discard(self, key):
+        self._memory.pop(key, None)
+        if self.directory is not None:
+            try:
+                os.remove(self._filename(key))
+            except OSError:
+                pass
+        if self.backend is not None:
+            try:
+                self.backend.delete(key)
+            except Exception:
+                pass
+
+    def _candidates(self, base):
+        # Keys of cached tables starting with base (eg, the same object or polygon)
+        keys = {k for k in self._memory if k.startswith(base + '_')}
+        if self.directory is not None:
+            try:
+                keys.update(name[:-4] for name in os.listdir(self.directory)
+                            if name.startswith(base + '_') and name.endswith('.npz'))
+            except OSError:
+                pass
+        if self.backend is not None:
+            try:
+                keys.update(self.backend.keys(base))
+            except Exception:
+                pass
+        return keys
+
+    def _evict_disk(self):
+        # Remove the least recently used files until the cache fits within max_bytes
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(f[1] for f in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        Remove all entries from memory and disk.
+        """
+
+        with self._lock:
+            self._memory.clear()
+            if self.directory is not None:
+                for name in os.listdir(self.directory):
+                    if name.endswith('.npz'):
+                        try:
+                            os.remove(os.path.join(self.directory, name))
+                        except OSError:
+                            pass
+            if self.backend is not None:
+                self.backend.clear()
+
+
+class EphemerisCache(TableCache):
+    """
+    Cache for JPL Horizons ephemerides keyed on (obj_name, id_type, location, epochs).
+
+    Requests with start/stop/step epochs can be served from a cached, wider time window
+    with the same step, as long as the requested start falls on the cached time grid.
+    """
+
+    subdirectory = 'ephemerides'
+
+    @staticmethod
+    def _base(obj_name, id_type, location):
+        location = None if location is None else str(location).strip()
+        return _hash('eph', str(obj_name).strip(), id_type, location)
+
+    @staticmethod
+    def _window(times):
+        # Return (start, stop, step) in JD/days for start/stop/step epochs, otherwise None
+        if not isinstance(times, dict) or 'step' not in times:
+            return None
+        start = date_to_jd(times.get('start'))
+        stop = date_to_jd(times.get('stop'))
+        step = step_to_days(times['step'])
+        if start is None or stop is None or step is None:
+            return None
+        return start, stop, step
+
+    def key(self, obj_name, times, id_type='smallbody', location=None):
+        """
+        Content hash for an ephemeris request.
+        """
+
+        base = self._base(obj_name, id_type, location)
+        if isinstance(times, dict):
+            epochs = {k: str(v).strip() for k, v in times.items()}
+        else:
+            epochs = np.round(np.atleast_1d(np.asarray(times, dtype=float)), 8).tolist()
+        return f'{base}_{_hash(epochs)}'
+
+    def lookup(self, obj_name, times, id_type='smallbody', location=None):
+        """
+        Return the cached ephemerides for a request, or None if they are not available.
+        """
+
+        with self._lock:
+            key = self.key(obj_name, times, id_type=id_type, location=location)
+            table = self._get(key)
+            if table is None:
+                table = self._from_window(obj_name, times, id_type, location)
+            self._record(table is not None)
+            return None if table is None else table.copy()
+
+    def store(self, obj_name, times, eph, id_type='smallbody', location=None):
+        """
+        Store the ephemerides for a request.
+        """
+
+        key = self.key(obj_name, times, id_type=id_type, location=location)
+        window = self._window(times)
+        eph = eph.copy()
+        if window is not None:
+            eph.meta['movingmast_window'] = list(window)
+        self.put(key, eph)
+
+    def _from_window(self, obj_name, times, id_type, location):
+        # Serve a request from a wider cached window with the same step
+        window = self._window(times)
+        if window is None:
+            return None
+        start, stop, step = window
+        tolerance = 1e-6  # ~0.1 seconds, in days
+        for key in self._candidates(self._base(obj_name, id_type, location)):
+            table = self._get(key)
+            if table is None or 'movingmast_window' not in table.meta:
+                continue
+            cached_start, cached_stop, cached_step = table.meta['movingmast_window']
+            if abs(cached_step - step) > tolerance:
+                continue
+            if start < cached_start - tolerance or stop > cached_stop + tolerance:
+                continue
+            offset = (start - cached_start) / step
+            if abs(offset - round(offset)) * step > tolerance:
+                continue
+            jd = np.asarray(table['datetime_jd'], dtype=float)
+            subset = table[(jd >= start - tolerance) & (jd <= stop + tolerance)]
+            subset.meta['movingmast_window'] = [start, stop, step]
+            return subset
+        return None
+
+
+class TapResultCache(TableCache):
+    """
+    Cache for TAP query results keyed on the normalized query: polygon, time window, missions, maxrec and service.
+
+    A query can also be served from a cached query with the same polygon and service when the cached results
+    were not truncated by maxrec and its time window and missions include the requested ones.
+    The cached rows are then filtered locally.
+    """
+
+    subdirectory = 'tap'
+
+    def __init__(self, directory=None, max_entries=64, max_bytes=1024 ** 3, ttl=86400, backend=None):
+        super().__init__(directory=directory, max_entries=max_entries, max_bytes=max_bytes, ttl=ttl,
+                         backend=backend)
+
+    @staticmethod
+    def _polygon(stcs):
+        # Vertices of the polygon rounded to ~0.4 milliarcsec so equivalent strings match
+        values = []
+        for elem in stcs.split():
+            try:
+                values.append(round(float(elem), 7))
+            except ValueError:
+                continue
+        return values
+
+    @staticmethod
+    def _missions(mission):
+        if mission is None:
+            return None
+        return sorted({x.strip() for x in mission.split(',') if x.strip() != ''})
+
+    def _base(self, stcs, service, columns=None):
+        return _hash('tap', service, self._polygon(stcs), columns)
+
+    def key(self, stcs, start_time=None, end_time=None, mission=None, maxrec=100, service=None, columns=None):
+        """
+        Content hash for a query.
+        """
+
+        window = None if start_time is None else [round(float(start_time), 7), round(float(end_time), 7)]
+        return f'{self._base(stcs, service, columns)}_{_hash(window, self._missions(mission), maxrec)}'
+
+    def lookup(self, stcs, start_time=None, end_time=None, mission=None, maxrec=100, service=None, columns=None):
+        """
+        Return the cached results of a query, or None if they are not available.
+        """
+
+        with self._lock:
+            key = self.key(stcs, start_time, end_time, mission, maxrec, service, columns)
+            table = self._get(key)
+            if table is None:
+                table = self._from_superset(self._base(stcs, service, columns), start_time, end_time,
+                                            self._missions(mission), maxrec)
+            self._record(table is not None)
+            return None if table is None else table.copy()
+
+    def store(self, table, stcs, start_time=None, end_time=None, mission=None, maxrec=100, service=None,
+              columns=None):
+        """
+        Store the results of a query.
+        """
+
+        table = table.copy(copy_data=False)
+        table.meta['movingmast_query'] = {
+            'window': None if start_time is None else [float(start_time), float(end_time)],
+            'missions': self._missions(mission),
+            'complete': maxrec is None or len(table) < maxrec}
+        self.put(self.key(stcs, start_time, end_time, mission, maxrec, service, columns), table)
+
+    def _from_superset(self, base, start_time, end_time, missions, maxrec):
+        # Filter the results of a wider query with the same polygon
+        for key in self._candidates(base):
+            table = self._get(key)
+            if table is None:
+                continue
+            query = table.meta.get('movingmast_query')
+            if query is None or not query['complete']:
+                continue
+            if query['window'] is not None:
+                if start_time is None or start_time < query['window'][0] or end_time > query['window'][1]:
+                    continue
+            if query['missions'] is not None and (missions is None or not set(missions) <= set(query['missions'])):
+                continue
+            if len(table) > 0 and not {'t_min', 't_max', 'obs_collection'} <= set(table.colnames):
+                continue
+
+            keep = np.ones(len(table), dtype=bool)
+            if len(table) > 0 and start_time is not None:
+                keep &= (np.asarray(table['t_min']) <= end_time) & (np.asarray(table['t_max']) >= start_time)
+            if len(table) > 0 and missions is not None:
+                keep &= np.isin(np.asarray(table['obs_collection']).astype(str), missions)
+            subset = table[keep][:maxrec]
+            subset.meta['movingmast_query'] = {'window': None if start_time is None else [start_time, end_time],
+                                               'missions': missions,
+                                               'complete': maxrec is None or len(subset) < maxrec}
+            return subset
+        return None
+
+
+class ProductCache(TableCache):
+    """
+    Cache for MAST product lists (manifests), one entry per obsID so lists fetched in different batches are reused.
+    """
+
+    subdirectory = 'products'
+
+    def __init__(self, directory=None, max_entries=4096, max_bytes=256 * 1024 ** 2, ttl=7 * 86400, backend=None):
+        super().__init__(directory=directory, max_entries=max_entries, max_bytes=max_bytes, ttl=ttl,
+                         backend=backend)
+
+    @staticmethod
+    def key(obsid):
+        """
+        Content hash for the product list of an observation.
+        """
+
+        if isinstance(obsid, bytes):
+            obsid = obsid.decode()
+        return _hash('products', str(obsid).strip())
+
+    def lookup(self, obsid):
+        """
+        Return the cached product list of an observation, or None if it is not available.
+        """
+
+        return self.get(self.key(obsid))
+
+    def store(self, obsid, products):
+        """
+        Store the product list of an observation.
+        """
+
+        self.put(self.key(obsid), products)
+
+
+_default_caches = {}
+_default_lock = threading.Lock()
+
+
+def get_ephemeris_cache():
+    """
+    Return the process-wide ephemeris cache, creating it if needed.
+    """
+
+    with _default_lock:
+        if 'ephemerides' not in _default_caches:
+            _default_caches['ephemerides'] = EphemerisCache()
+        return _default_caches['ephemerides']
+
+
+def get_tap_cache():
+    """
+    Return the process-wide TAP query results cache, creating it if needed.
+    """
+
+    with _default_lock:
+        if 'tap' not in _default_caches:
+            _default_caches['tap'] = TapResultCache()
+        return _default_caches['tap']
+
+
+def get_product_cache():
+    """
+    Return the process-wide product list cache, creating it if needed.
+    """
+
+    with _default_lock:
+        if 'products' not in _default_caches:
+            _default_caches['products'] = ProductCache()
+        return _default_caches['products']
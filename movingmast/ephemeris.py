@@ -0,0 +1,487 @@
+# Functions to handle ephemeris engines (JPL Horizons or local orbit propagation)
+
+import threading
+import erfa
+import numpy as np
+import astropy.units as u
+from astropy.time import Time
+from astropy.table import Table
+from astroquery.jplhorizons import Horizons
+from .cache import date_to_jd, step_to_days
+from .spherical import separation
+
+GAUSS_K = 0.01720209895  # Gaussian gravitational constant, rad/day
+SPEED_OF_LIGHT = 173.1446326846693  # AU/day
+OBLIQUITY = np.deg2rad(84381.448 / 3600.)  # J2000 obliquity of the ecliptic
+GEOCENTRIC_LOCATIONS = (None, '', '500', '500@399', 'geo', 'geocentric')
+
+
+def epochs_to_jd(times):
+    """
+    Expand epochs as accepted by get_path into an array of Julian Dates.
+
+    Parameters
+    ----------
+    times: float, arr or dict
+       Times as a float, array, or specified start/stop/step
+       (example: {'start':'2019-01-01', 'stop':'2019-12-31', 'step':'1d'})
+
+    Returns
+    -------
+    jd: numpy array
+        Julian Dates
+    """
+
+    if not isinstance(times, dict):
+        return np.atleast_1d(np.asarray(times, dtype=float))
+
+    start = date_to_jd(times['start'])
+    stop = date_to_jd(times['stop'])
+    if start is None or stop is None:
+        raise ValueError(f"Unable to interpret start/stop times: {times['start']}, {times['stop']}")
+    step = step_to_days(times.get('step', '1d'))
+    if step is None:
+        # Horizons also accepts a number of equal intervals
+        try:
+            intervals = int(times['step'])
+        except ValueError:
+            raise ValueError(f"Unable to interpret step: {times['step']}")
+        return np.linspace(start, stop, intervals + 1)
+    return start + step * np.arange(int(np.floor((stop - start) / step + 1e-9)) + 1)
+
+
+def _jd_to_str(jd):
+    # Format Julian Dates like the Horizons datetime_str column (eg, 2019-Jan-01 00:00)
+    minutes = np.round((np.asarray(jd, dtype=float) - 2400000.5) * 1440).astype('timedelta64[m]')
+    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+    return [f'{x[:4]}-{months[int(x[5:7]) - 1]}-{x[8:10]} {x[11:16]}'
+            for x in np.datetime_as_string(np.datetime64('1858-11-17T00:00') + minutes, unit='m')]
+
+
+def _unpack_epoch(packed):
+    # Convert an MPC packed date (eg, K194R) into a Julian Date
+    digits = '123456789ABCDEFGHIJKLMNOPQRSTUV'
+    century = {'I': 18, 'J': 19, 'K': 20}[packed[0]]
+    year = century * 100 + int(packed[1:3])
+    month = digits.index(packed[3]) + 1
+    day = digits.index(packed[4]) + 1
+    return date_to_jd(f'{year:04d}-{month:02d}-{day:02d}')
+
+
+def read_mpcorb(filename):
+    """
+    Read orbital elements from an MPCORB-style file
+    (see https://minorplanetcenter.net/iau/info/MPOrbitFormat.html).
+
+    Parameters
+    ----------
+    filename: str
+        MPCORB.DAT or a file with lines in the same format
+
+    Returns
+    -------
+    elements: dict
+        Dictionary of orbital elements indexed by packed designation, number, name and readable designation
+    """
+
+    elements = {}
+    with open(filename) as f:
+        for line in f:
+            if len(line) < 103 or line.startswith('-') or not line[20:25].strip():
+                continue
+            try:
+                row = {'targetname': line[166:194].strip() or line[0:7].strip(),
+                       'epoch': _unpack_epoch(line[20:25]),
+                       'M': float(line[26:35]),
+                       'w': float(line[37:46]),
+                       'Omega': float(line[48:57]),
+                       'incl': float(line[59:68]),
+                       'e': float(line[70:79]),
+                       'a': float(line[92:103])}
+            except (ValueError, KeyError, IndexError):
+                continue  # header lines
+
+            keys = {line[0:7].strip(), row['targetname']}
+            name = row['targetname']
+            if name.startswith('('):
+                number, _, rest = name[1:].partition(')')
+                keys.update([number, rest.strip()])
+            for key in keys:
+                if key:
+                    elements[key] = row
+    return elements
+
+
+def fetch_elements(obj_name, id_type='smallbody', epoch=None):
+    """
+    Fetch heliocentric osculating orbital elements from JPL Horizons.
+
+    Parameters
+    ----------
+    obj_name: str
+        Object name, see get_path
+    id_type: str
+        Object ID type for JPL Horizons, see get_path
+    epoch: float
+        Julian Date (TDB) of the elements. Default of None uses the current time.
+
+    Returns
+    -------
+    elements: dict
+        Orbital elements (a, e, incl, Omega, w, M, epoch, targetname)
+    """
+
+    if epoch is None:
+        epoch = Time.now().tdb.jd
+    el = Horizons(id=obj_name, location='500@10', id_type=id_type, epochs=epoch).elements()
+    return {'targetname': str(el['targetname'][0]), 'epoch': float(el['datetime_jd'][0]),
+            'a': float(el['a'][0]), 'e': float(el['e'][0]), 'incl': float(el['incl'][0]),
+            'Omega': float(el['Omega'][0]), 'w': float(el['w'][0]), 'M': float(el['M'][0])}
+
+
+def solve_kepler(mean_anomaly, e, tolerance=1e-12, max_iterations=50):
+    """
+    Solve Kepler's equation (E - e sin E = M) for elliptical orbits with Newton's method.
+
+    Parameters
+    ----------
+    mean_anomaly: float or numpy array
+        Mean anomaly in radians
+    e: float
+        Eccentricity (0 <= e < 1)
+
+    Returns
+    -------
+    E: numpy array
+        Eccentric anomaly in radians
+    """
+
+    mean_anomaly = np.remainder(mean_anomaly, 2 * np.pi)
+    E = np.where(e < 0.8, mean_anomaly, np.pi * np.ones_like(mean_anomaly))
+    for _ in range(max_iterations):
+        delta = (E - e * np.sin(E) - mean_anomaly) / (1 - e * np.cos(E))
+        E = E - delta
+        if np.all(np.abs(delta) < tolerance):
+            break
+    return E
+
+
+def propagate(elements, jd_tdb):
+    """
+    Heliocentric position of an object from its orbital elements with two-body Keplerian propagation.
+
+    Parameters
+    ----------
+    elements: dict
+        Orbital elements with a (AU), e, incl, Omega, w, M (degrees) and epoch (JD TDB)
+    jd_tdb: numpy array
+        Julian Dates (TDB) to compute positions for
+
+    Returns
+    -------
+    xyz: numpy array
+        Heliocentric equatorial (ICRF) positions in AU with shape (3, N)
+    """
+
+    a, e = elements['a'], elements['e']
+    if e >= 1 or a <= 0:
+        raise ValueError(f"Only elliptical orbits are supported (e={e}, a={a})")
+
+    n = GAUSS_K / a ** 1.5
+    M = np.deg2rad(elements['M']) + n * (np.asarray(jd_tdb, dtype=float) - elements['epoch'])
+    E = solve_kepler(M, e)
+
+    # Position in the orbital plane
+    x = a * (np.cos(E) - e)
+    y = a * np.sqrt(1 - e ** 2) * np.sin(E)
+
+    # Rotate to the ecliptic and then to the equator
+    i, node, peri = np.deg2rad([elements['incl'], elements['Omega'], elements['w']])
+    cn, sn, cp, sp, ci, si = np.cos(node), np.sin(node), np.cos(peri), np.sin(peri), np.cos(i), np.sin(i)
+    xe = (cn * cp - sn * sp * ci) * x + (-cn * sp - sn * cp * ci) * y
+    ye = (sn * cp + cn * sp * ci) * x + (-sn * sp + cn * cp * ci) * y
+    ze = (sp * si) * x + (cp * si) * y
+    ce, se = np.cos(OBLIQUITY), np.sin(OBLIQUITY)
+    return np.array([xe, ce * ye - se * ze, se * ye + ce * ze])
+
+
+def geocentric_observer(jd_tdb):
+    """
+    Heliocentric equatorial position of the geocenter in AU, shape (3, N), from the built-in
+    ERFA/astropy solar system ephemeris (no network access needed).
+    """
+
+    jd_tdb = np.asarray(jd_tdb, dtype=float)
+    grid = np.arange(np.floor(jd_tdb.min()) - 1, np.ceil(jd_tdb.max()) + 1.5, 0.5)
+    if len(grid) > jd_tdb.size:
+        heliocentric, _ = erfa.epv00(jd_tdb, 0.)
+        return heliocentric['p'].T
+
+    # For many epochs, interpolate states on a half-day grid with cubic Hermite polynomials (errors < 1e-11 AU)
+    heliocentric, _ = erfa.epv00(grid, 0.)
+    idx = np.clip(np.searchsorted(grid, jd_tdb) - 1, 0, len(grid) - 2)
+    h = grid[1] - grid[0]
+    s = ((jd_tdb - grid[idx]) / h)[:, np.newaxis]
+    p0, p1 = heliocentric['p'][idx], heliocentric['p'][idx + 1]
+    v0, v1 = heliocentric['v'][idx] * h, heliocentric['v'][idx + 1] * h
+    xyz = ((2 * s ** 3 - 3 * s ** 2 + 1) * p0 + (s ** 3 - 2 * s ** 2 + s) * v0 +
+           (-2 * s ** 3 + 3 * s ** 2) * p1 + (s ** 3 - s ** 2) * v1)
+    return xyz.T
+
+
+def horizons_vectors(body, start, stop, step='6h'):
+    """
+    Heliocentric equatorial state vectors of a spacecraft or body from JPL Horizons.
+
+    Parameters
+    ----------
+    body: str
+        Horizons major body code (eg, TESS, hst, -227)
+    start, stop: float
+        Time range in JD (TDB)
+    step: str
+        Sampling of the state vectors (Default: 6h)
+
+    Returns
+    -------
+    grid: numpy array
+        JD (TDB) of the vectors
+    xyz: numpy array
+        Positions in AU, shape (3, N)
+    """
+
+    # Horizons reads the epochs of vector tables as TDB
+    epochs = {'start': Time(start, format='jd', scale='tdb').iso[:16],
+              'stop': Time(stop, format='jd', scale='tdb').iso[:16], 'step': step}
+    vec = Horizons(id=body, location='500@10', id_type='majorbody', epochs=epochs).vectors(refplane='earth')
+    return np.asarray(vec['datetime_jd'], dtype=float), np.array([vec['x'], vec['y'], vec['z']], dtype=float)
+
+
+class HorizonsObserver:
+    """
+    Observer positions interpolated from JPL Horizons state vectors of a spacecraft or body.
+
+    The vectors are fetched over the epochs of the first call. Later calls with epochs outside of the fetched
+    range fetch them again over a range covering both, so positions are never extrapolated.
+
+    Parameters
+    ----------
+    location: str
+        Observer location as used by get_path (eg, @TESS, @hst, 500@-227)
+    step: str
+        Sampling of the fetched state vectors (Default: 6h)
+    extend: bool
+        Fetch the vectors again for epochs outside of the fetched range, otherwise raise a ValueError (Default: True)
+    vectors: function
+        Function returning the vectors of a body over a time range (Default: None, horizons_vectors)
+    """
+
+    def __init__(self, location, step='6h', extend=True, vectors=None):
+        self.location = location
+        self.body = location.split('@')[-1]
+        self.step = step
+        self.extend = extend
+        self.grid = None
+        self.xyz = None
+        self._vectors = horizons_vectors if vectors is None else vectors
+        self._lock = threading.RLock()
+
+    def covers(self, jd_tdb):
+        """
+        Whether all epochs (JD, TDB) are within the fetched range.
+        """
+
+        jd_tdb = np.asarray(jd_tdb, dtype=float)
+        return self.grid is not None and np.min(jd_tdb) >= self.grid[0] and np.max(jd_tdb) <= self.grid[-1]
+
+    def fetch(self, start, stop):
+        """
+        Fetch the vectors over a time range in JD (TDB), padded by a day.
+        """
+
+        with self._lock:
+            self.grid, self.xyz = self._vectors(self.body, start - 1, stop + 1, self.step)
+
+    def __call__(self, jd_tdb):
+        jd_tdb = np.atleast_1d(np.asarray(jd_tdb, dtype=float))
+        with self._lock:
+            if not self.covers(jd_tdb):
+                if self.grid is not None and not self.extend:
+                    raise ValueError(f'Epochs outside of the observer positions for {self.location}: '
+                                     f'JD {np.min(jd_tdb):.3f} to {np.max(jd_tdb):.3f} (TDB), '
+                                     f'available from {self.grid[0]:.3f} to {self.grid[-1]:.3f}')
+                start, stop = np.min(jd_tdb), np.max(jd_tdb)
+                if self.grid is not None:
+                    start, stop = min(start, self.grid[0]), max(stop, self.grid[-1])
+                self.fetch(start, stop)
+                if not self.covers(jd_tdb):
+                    raise ValueError(f'JPL Horizons vectors for {self.location} do not cover '
+                                     f'JD {np.min(jd_tdb):.3f} to {np.max(jd_tdb):.3f} (TDB)')
+            grid, xyz = self.grid, self.xyz
+        return np.array([np.interp(jd_tdb, grid, xyz[k]) for k in range(3)])
+
+
+def horizons_observer(location, times, step='6h'):
+    """
+    Build an observer from JPL Horizons state vectors of a spacecraft or body, fetched over
+    the time range of interest and interpolated afterwards (see HorizonsObserver).
+
+    Parameters
+    ----------
+    location: str
+        Observer location as used by get_path (eg, @TESS, @hst, 500@-227)
+    times: float, arr or dict
+        Times the observer will be needed for
+    step: str
+        Sampling of the fetched state vectors
+
+    Returns
+    -------
+    observer: HorizonsObserver
+        Function returning heliocentric equatorial positions in AU, shape (3, N), for JD (TDB) values
+    """
+
+    observer = HorizonsObserver(location, step=step)
+    jd_tdb = Time(epochs_to_jd(times), format='jd', scale='utc').tdb.jd
+    observer.fetch(np.min(jd_tdb), np.max(jd_tdb))
+    return observer
+
+
+class HorizonsEngine:
+    """
+    Ephemeris engine using the JPL Horizons service.
+    """
+
+    name = 'horizons'
+    remote = True
+
+    def ephemerides(self, obj_name, times, id_type='smallbody', location=None):
+        return Horizons(id=obj_name, location=location, id_type=id_type, epochs=times).ephemerides()
+
+
+class KeplerEngine:
+    """
+    Ephemeris engine propagating orbital elements locally with vectorized two-body Keplerian motion
+    and light-time correction. Positions are astrometric RA/Dec like the JPL Horizons defaults.
+
+    Parameters
+    ----------
+    elements: dict
+        Orbital elements indexed by object name (see read_mpcorb and fetch_elements).
+        Elements for objects not present are fetched once from JPL Horizons, if fetch is True.
+    observers: dict
+        Functions giving the heliocentric position of non-geocentric observers indexed by location
+        (see HorizonsObserver). Missing spacecraft observers are fetched from JPL Horizons, if fetch is True,
+        and extended to the epochs of later requests.
+    fetch: bool
+        Allow fetching elements and observer vectors from JPL Horizons (Default: True)
+    fallback: engine
+        Engine to use for objects whose elements are not available (eg, HorizonsEngine()). (Default: None)
+    """
+
+    name = 'kepler'
+    remote = False
+
+    def __init__(self, elements=None, observers=None, fetch=True, fallback=None):
+        self.elements = dict(elements) if elements is not None else {}
+        self.observers = dict(observers) if observers is not None else {}
+        self.fetch = fetch
+        self.fallback = fallback
+
+    def _get_elements(self, obj_name, id_type):
+        if obj_name not in self.elements:
+            if not self.fetch:
+                return None
+            self.elements[obj_name] = fetch_elements(obj_name, id_type=id_type)
+        return self.elements[obj_name]
+
+    def _get_observer(self, location):
+        if location in GEOCENTRIC_LOCATIONS:
+            return geocentric_observer
+        if location not in self.observers:
+            if not self.fetch:
+                raise ValueError(f'No observer positions available for location {location}')
+            # Fetched over the epochs of the first request, then extended as needed
+            self.observers[location] = HorizonsObserver(location)
+        return self.observers[location]
+
+    def positions(self, elements, jd_tdb, observer, iterations=3):
+        """
+        Observer-centric equatorial positions (AU, shape (3, N)) corrected for light-time.
+        """
+
+        obs = observer(jd_tdb)
+        tau = np.zeros_like(jd_tdb)
+        for _ in range(iterations):
+            rho = propagate(elements, jd_tdb - tau) - obs
+            tau = np.sqrt(np.sum(rho ** 2, axis=0)) / SPEED_OF_LIGHT
+        return rho, tau
+
+    def ephemerides(self, obj_name, times, id_type='smallbody', location=None):
+        elements = self._get_elements(obj_name, id_type)
+        if elements is None:
+            if self.fallback is None:
+                raise ValueError(f'No orbital elements available for {obj_name}')
+            return self.fallback.ephemerides(obj_name, times, id_type=id_type, location=location)
+
+        jd = epochs_to_jd(times)
+        jd_tdb = Time(jd, format='jd', scale='utc').tdb.jd
+        observer = self._get_observer(location)
+
+        # Evaluate the positions and their neighbors for the rates in one vectorized call
+        h = 1. / 24  # 1 hour
+        n = len(jd_tdb)
+        rho, tau = self.positions(elements, np.concatenate([jd_tdb, jd_tdb - h, jd_tdb + h]), observer)
+        dist = np.sqrt(np.sum(rho ** 2, axis=0))
+        ra = np.degrees(np.arctan2(rho[1], rho[0])) % 360
+        dec = np.degrees(np.arcsin(rho[2] / dist))
+
+        dra = (ra[2 * n:] - ra[n:2 * n] + 180) % 360 - 180  # handle ra=0/360
+        ra_rate = dra / 2 * 3600 * np.cos(np.radians(dec[:n]))  # arcsec/hour, includes cos(dec) like Horizons
+        dec_rate = (dec[2 * n:] - dec[n:2 * n]) / 2 * 3600
+        r = np.sqrt(np.sum(propagate(elements, jd_tdb - tau[:n]) ** 2, axis=0))
+
+        eph = Table()
+        eph['targetname'] = [elements.get('targetname', obj_name)] * n
+        eph['datetime_str'] = _jd_to_str(jd)
+        eph['datetime_jd'] = jd * u.d
+        eph['RA'] = ra[:n] * u.deg
+        eph['DEC'] = dec[:n] * u.deg
+        eph['RA_rate'] = ra_rate * u.arcsec / u.hour
+        eph['DEC_rate'] = dec_rate * u.arcsec / u.hour
+        eph['r'] = r * u.au
+        eph['delta'] = dist[:n] * u.au
+        eph['lighttime'] = tau[:n] * 1440 * u.min
+        return eph
+
+
+def compare_ephemerides(eph, reference):
+    """
+    Angular separation between two ephemerides computed for the same epochs
+    (eg, a local KeplerEngine result validated against JPL Horizons).
+
+    Parameters
+    ----------
+    eph: astropy Table
+        Ephemerides to check
+    reference: astropy Table
+        Reference ephemerides
+
+    Returns
+    -------
+    separation: numpy array
+        Separation in arcseconds for each epoch
+    """
+
+    return separation(eph['RA'], eph['DEC'], reference['RA'], reference['DEC']) * 3600
+
+
+_default_engine = HorizonsEngine()
+
+
+def get_engine(engine=None):
+    """
+    Return the ephemeris engine to use, the default being JPL Horizons.
+    """
+
+    return _default_engine if engine is None else engine
@@ -0,0 +1,492 @@
+# Functions to handle footprint verification for many observations at once
+# All geometry is spherical (see spherical.py): footprints crossing RA=0/360 or covering a pole need no special cases
+
+import numpy as np
+from .spherical import lonlat_to_xyz, xyz_to_lonlat, separation, points_in_polygons, arcs_cross_polygons, point_arc_distance, \
+    _normalize, _angle, _pair_chunks, _expand_edges
+
+
+def check_pairs(packed, rows, ra, dec, s_ra, s_dec, radius=0.0083):
+    """
+    Check if the target is in the footprint for (observation, target position) pairs.
+    If a radius is provided, the observation center being within radius of the target also counts.
+
+    Parameters
+    ----------
+    packed : PackedRegions
+        Observation footprints
+    rows : numpy array
+        Index of the observation for each pair
+    ra, dec : numpy array
+        Target position for each pair
+    s_ra, s_dec : numpy array
+        Observation centers, one per footprint
+    radius : float
+        Size of target for intersection calculations (Default: 0.0083). None or negative to skip the circle check.
+
+    Returns
+    -------
+    flags : numpy array
+        Boolean array for each pair
+    """
+
+    rows = np.asarray(rows, dtype=int)
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    flags = points_in_polygons(packed, rows, ra, dec)
+    if radius is not None and radius >= 0:
+        with np.errstate(invalid='ignore'):
+            flags |= separation(np.asarray(s_ra, dtype=float)[rows], np.asarray(s_dec, dtype=float)[rows],
+                                ra, dec) < radius
+    return flags & packed.valid[rows]
+
+
+def detail_check(packed, eph_ra, eph_dec, eph_mjd, s_ra, s_dec, t_min, t_max, rows=None, radius=0.0083,
+                 aggressive_check=False, max_pairs=2 ** 20):
+    """
+    A more detailed check for footprint matching.
+    This checks each location in the ephemerides and confirms if an observation intersects it.
+
+    Parameters
+    ----------
+    packed : PackedRegions
+        Observation footprints
+    eph_ra, eph_dec, eph_mjd : numpy array
+        Ephemerides positions and MJD times
+    s_ra, s_dec, t_min, t_max : numpy array
+        Observation centers and start/end times (MJD), one per footprint
+    rows : numpy array
+        Footprints to check (Default: None, all footprints)
+    radius : float
+        Size of target for intersection calculations
+    aggressive_check : bool
+        Only use ephemerides positions within the observation start and end times (Default: False)
+    max_pairs : int
+        Maximum number of (observation, position) pairs to evaluate at once
+
+    Returns
+    -------
+    flags : numpy array
+        Boolean array for each row checked
+    """
+
+    if rows is None:
+        rows = np.arange(len(packed))
+    rows = np.asarray(rows, dtype=int)
+    eph_ra = np.asarray(eph_ra, dtype=float)
+    eph_dec = np.asarray(eph_dec, dtype=float)
+    eph_mjd = np.asarray(eph_mjd, dtype=float)
+    t_min = np.asarray(t_min, dtype=float)
+    t_max = np.asarray(t_max, dtype=float)
+
+    flags = np.zeros(len(rows), dtype=bool)
+    n_eph = len(eph_ra)
+    if n_eph == 0 or len(rows) == 0:
+        return flags
+
+    # Only positions within the bounding cap of a footprint (padded by radius) need the exact tests
+    eph_xyz = lonlat_to_xyz(eph_ra, eph_dec).reshape(-1, 3)
+    centers, cap_radii = packed.caps
+    pad = radius if radius is not None and radius > 0 else 0.
+    reach = np.cos(np.radians(np.minimum(cap_radii + pad, 180.)))
+
+    block = max(max_pairs // n_eph, 1)
+    for start in range(0, len(rows), block):
+        sub = np.arange(start, min(start + block, len(rows)))
+        pair_row = np.repeat(sub, n_eph)
+        pair_eph = np.tile(np.arange(n_eph), len(sub))
+        obs = rows[pair_row]
+        with np.errstate(invalid='ignore'):
+            keep = np.sum(eph_xyz[pair_eph] * centers[obs], axis=-1) >= reach[obs]
+        if aggressive_check:
+            keep &= (eph_mjd[pair_eph] <= t_max[obs]) & (eph_mjd[pair_eph] >= t_min[obs])
+        pair_row = pair_row[keep]
+        pair_eph = pair_eph[keep]
+        hits = check_pairs(packed, rows[pair_row], eph_ra[pair_eph], eph_dec[pair_eph], s_ra, s_dec, radius=radius)
+        flags[np.unique(pair_row[hits])] = True
+
+    return flags
+
+
+class FootprintIndex:
+    """
+    Index over observation footprints in time and space.
+
+    Time intervals (t_min, t_max) are grouped by duration, with each group sorted by start time,
+    so that all footprints overlapping a time window are found with binary searches.
+    Candidates are then filtered with their bounding caps (circles on the sky) before the exact geometric tests.
+
+    Parameters
+    ----------
+    packed : PackedRegions
+        Observation footprints
+    t_min, t_max : numpy array
+        Observation start and end times (MJD)
+    s_ra, s_dec : numpy array
+        Observation centers. These are included in the bounding caps for the target circle check.
+    """
+
+    def __init__(self, packed, t_min, t_max, s_ra=None, s_dec=None):
+        self.packed = packed
+        self.t_min = np.asarray(t_min, dtype=float)
+        self.t_max = np.asarray(t_max, dtype=float)
+        n = len(packed)
+
+        # Bounding caps of the footprints (enlarged to include the observation centers)
+        centers, radii = packed.caps
+        self.centers = centers
+        self.radii = radii.copy()
+        if s_ra is not None and s_dec is not None:
+            s_xyz = lonlat_to_xyz(s_ra, s_dec).reshape(-1, 3)
+            with np.errstate(invalid='ignore'):
+                self.radii = np.fmax(self.radii, np.degrees(_angle(centers, s_xyz)))
+
+        # Group intervals by duration (powers of 2 in days) so each group has a small maximum duration
+        usable = np.where(packed.valid & np.isfinite(self.t_min) & np.isfinite(self.t_max))[0]
+        duration = np.maximum(self.t_max[usable] - self.t_min[usable], 0)
+        level = np.ceil(np.log2(np.maximum(duration, 1. / 1440))).astype(int)
+        self._groups = []
+        for value in np.unique(level):
+            members = usable[level == value]
+            members = members[np.argsort(self.t_min[members], kind='stable')]
+            max_duration = np.max(self.t_max[members] - self.t_min[members])
+            self._groups.append((members, self.t_min[members], max_duration))
+
+    def query_time(self, start, end):
+        """
+        Candidate (query, footprint) pairs whose time intervals overlap the query windows [start, end].
+
+        Parameters
+        ----------
+        start, end : numpy array
+            Query windows (MJD)
+
+        Returns
+        -------
+        query, footprint : numpy array
+            Index of the query window and of the footprint for each overlapping pair
+        """
+
+        start = np.atleast_1d(np.asarray(start, dtype=float))
+        end = np.atleast_1d(np.asarray(end, dtype=float))
+        queries = []
+        footprints = []
+        for members, t_min, max_duration in self._groups:
+            lo = np.searchsorted(t_min, start - max_duration, side='left')
+            hi = np.searchsorted(t_min, end, side='right')
+            n = np.maximum(hi - lo, 0)
+            query = np.repeat(np.arange(len(start)), n)
+            position = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + np.repeat(lo, n)
+            footprint = members[position]
+            keep = self.t_max[footprint] >= start[query]
+            queries.append(query[keep])
+            footprints.append(footprint[keep])
+        if len(queries) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        return np.concatenate(queries), np.concatenate(footprints)
+
+    def query(self, start, end, centers, radii):
+        """
+        Candidate (query, footprint) pairs overlapping the query windows in both time and space.
+
+        Parameters
+        ----------
+        start, end : numpy array
+            Query time windows (MJD)
+        centers, radii : numpy array
+            Query bounding caps: center unit vectors with shape (N, 3) and radii in degrees
+
+        Returns
+        -------
+        query, footprint : numpy array
+            Index of the query and of the footprint for each candidate pair
+        """
+
+        query, footprint = self.query_time(start, end)
+        centers = np.asarray(centers, dtype=float).reshape(-1, 3)
+        distance = np.degrees(_angle(self.centers[footprint], centers[query]))
+        keep = distance <= self.radii[footprint] + np.asarray(radii, dtype=float)[query]
+        return query[keep], footprint[keep]
+
+
+def segment_check(index, eph_ra, eph_dec, eph_mjd, s_ra, s_dec, rows=None, radius=0.0083):
+    """
+    Check if the target path between each observation's start and end times intersects its footprint.
+    If a radius is provided, the observation center being within radius of the path also counts.
+
+    Parameters
+    ----------
+    index : FootprintIndex
+        Index of the observation footprints
+    eph_ra, eph_dec, eph_mjd : numpy array
+        Ephemerides positions and MJD times, sorted by time
+    s_ra, s_dec : numpy array
+        Observation centers, one per footprint
+    rows : numpy array
+        Footprints to check (Default: None, all footprints)
+    radius : float
+        Size of target for intersection calculations
+
+    Returns
+    -------
+    flags : numpy array
+        Boolean array for each row checked
+    """
+
+    eph_ra = np.asarray(eph_ra, dtype=float)
+    eph_dec = np.asarray(eph_dec, dtype=float)
+    eph_mjd = np.asarray(eph_mjd, dtype=float)
+    s_ra = np.asarray(s_ra, dtype=float)
+    s_dec = np.asarray(s_dec, dtype=float)
+    if rows is None:
+        rows = np.arange(len(index.packed))
+    rows = np.asarray(rows, dtype=int)
+    selected = np.zeros(len(index.packed), dtype=bool)
+    selected[rows] = True
+    if len(eph_mjd) < 2:
+        return np.zeros(len(rows), dtype=bool)
+
+    # Great-circle segments between consecutive ephemerides positions, searched with their bounding caps
+    pad = radius if radius is not None and radius > 0 else 0.
+    xyz = lonlat_to_xyz(eph_ra, eph_dec).reshape(-1, 3)
+    p0, p1 = xyz[:-1], xyz[1:]
+    segment, obs = index.query(eph_mjd[:-1], eph_mjd[1:], _normalize(p0 + p1),
+                               np.degrees(_angle(p0, p1)) / 2 + pad)
+    keep = selected[obs]
+    segment, obs = segment[keep], obs[keep]
+
+    # Clip each segment to the observation time window
+    t0, t1 = eph_mjd[segment], eph_mjd[segment + 1]
+    span = np.where(t1 > t0, t1 - t0, 1.)
+    u0 = np.clip((index.t_min[obs] - t0) / span, 0, 1)[:, np.newaxis]
+    u1 = np.clip((index.t_max[obs] - t0) / span, 0, 1)[:, np.newaxis]
+    a = _normalize(p0[segment] + u0 * (p1[segment] - p0[segment]))
+    b = _normalize(p0[segment] + u1 * (p1[segment] - p0[segment]))
+    a_lon, a_lat = xyz_to_lonlat(a)
+
+    hits = points_in_polygons(index.packed, obs, a_lon, a_lat) | arcs_cross_polygons(index.packed, obs, a, b)
+    if radius is not None and radius >= 0:
+        with np.errstate(invalid='ignore'):
+            hits |= point_arc_distance(lonlat_to_xyz(s_ra[obs], s_dec[obs]).reshape(-1, 3), a, b) < radius
+
+    flagged = np.zeros(len(index.packed), dtype=bool)
+    flagged[obs[hits]] = True
+    return flagged[rows] & index.packed.valid[rows]
+
+
+def _tangent_basis(center):
+    # Orthonormal vectors spanning the plane tangent at each center, shape (N, 3) each
+    axis = np.where(np.abs(center[:, 2:3]) < 0.9, [[0., 0., 1.]], [[1., 0., 0.]])
+    e1 = _normalize(np.cross(axis, center))
+    return e1, np.cross(center, e1)
+
+
+def _project(xyz, center, e1, e2):
+    # Gnomonic projection (great circles become straight lines) and the scale factor of each point
+    w = np.sum(xyz * center, axis=-1)
+    return np.stack([np.sum(xyz * e1, axis=-1), np.sum(xyz * e2, axis=-1)], axis=-1) / w[:, np.newaxis], w
+
+
+def _cross2(a, b):
+    return a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+
+
+def _slab(value, slope, low, high):
+    # Parameters s where low <= value + s * slope <= high, as (lo, hi) with lo > hi when empty
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s0 = (low - value) / slope
+        s1 = (high - value) / slope
+    flat = slope == 0
+    inside = (value >= low) & (value <= high)
+    lo = np.where(flat, np.where(inside, -np.inf, np.inf), np.minimum(s0, s1))
+    hi = np.where(flat, np.where(inside, np.inf, -np.inf), np.maximum(s0, s1))
+    return lo, hi
+
+
+def _disk(x0, d, center, r):
+    # Parameters s where |x0 + s * d - center| <= r, as (lo, hi) with lo > hi when empty
+    f = x0 - center
+    a = np.sum(d * d, axis=-1)
+    b = np.sum(d * f, axis=-1)
+    c = np.sum(f * f, axis=-1) - r ** 2
+    disc = b * b - a * c
+    with np.errstate(divide='ignore', invalid='ignore'):
+        root = np.sqrt(np.maximum(disc, 0))
+        lo = np.where(disc >= 0, (-b - root) / a, np.inf)
+        hi = np.where(disc >= 0, (-b + root) / a, -np.inf)
+    still = a == 0
+    lo = np.where(still, np.where(c <= 0, -np.inf, np.inf), lo)
+    hi = np.where(still, np.where(c <= 0, np.inf, -np.inf), hi)
+    return lo, hi
+
+
+def _union_lengths(pair, lo, hi, n_pairs):
+    # Total length of the union of the intervals [lo, hi] within [0, 1] of each pair
+    lo = np.clip(lo, 0, 1)
+    hi = np.clip(hi, 0, 1)
+    keep = hi > lo
+    pair, lo, hi = pair[keep], lo[keep], hi[keep]
+    if len(pair) == 0:
+        return np.zeros(n_pairs)
+    # Offsetting each pair by 2 keeps the intervals of different pairs apart in a single sweep
+    order = np.lexsort((lo, pair))
+    start = lo[order] + 2 * pair[order]
+    end = hi[order] + 2 * pair[order]
+    reach = np.concatenate([[-np.inf], np.maximum.accumulate(end)[:-1]])
+    covered = np.maximum(end - np.maximum(start, reach), 0)
+    return np.bincount(pair[order], weights=covered, minlength=n_pairs)
+
+
+def _covered_fractions(packed, obs, a, b, radius):
+    # Fraction of each arc (a, b) within radius of its footprint, parametrized linearly between a and b
+    n_pairs = len(obs)
+    covered = np.zeros(n_pairs)
+    center = _normalize(a + b)
+    e1, e2 = _tangent_basis(center)
+    xa, wa = _project(a, center, e1, e2)
+    xb, wb = _project(b, center, e1, e2)
+    r = np.tan(np.radians(radius)) if radius is not None and radius > 0 else 0.
+    counts = packed.counts[obs]
+    xyz = packed.xyz
+
+    for start, stop in _pair_chunks(counts):
+        n = counts[start:stop]
+        if n.sum() == 0:
+            continue
+        pair, i, j = _expand_edges(packed, obs, start, stop, n)
+        vi, _ = _project(xyz[i], center[pair], e1[pair], e2[pair])
+        vj, _ = _project(xyz[j], center[pair], e1[pair], e2[pair])
+        x0 = xa[pair]
+        d = xb[pair] - x0
+        edge = vj - vi
+        length = np.linalg.norm(edge, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            along = edge / length[:, np.newaxis]
+        normal = np.stack([-along[:, 1], along[:, 0]], axis=-1)
+
+        # Buffer around the boundary: a disk at each vertex and a band along each edge
+        los, his, pairs = [], [], []
+        if r > 0:
+            lo, hi = _disk(x0, d, vi, r)
+            los.append(lo)
+            his.append(hi)
+            lo1, hi1 = _slab(np.sum((x0 - vi) * along, axis=-1), np.sum(d * along, axis=-1), 0., length)
+            lo2, hi2 = _slab(np.sum((x0 - vi) * normal, axis=-1), np.sum(d * normal, axis=-1), -r, r)
+            los.append(np.maximum(lo1, lo2))
+            his.append(np.minimum(hi1, hi2))
+            pairs += [pair, pair]
+
+        # Interior: pieces of the arc between its crossings with the edges, kept when their middle is inside
+        denominator = _cross2(d, edge)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = _cross2(vi - x0, edge) / denominator
+            t = _cross2(vi - x0, d) / denominator
+        crossing = (denominator != 0) & (t >= 0) & (t <= 1) & (s > 0) & (s < 1)
+        local = np.arange(start, stop)
+        cut_pair = np.concatenate([local, local, pair[crossing]])
+        cut = np.concatenate([np.zeros(stop - start), np.ones(stop - start), s[crossing]])
+        order = np.lexsort((cut, cut_pair))
+        cut_pair, cut = cut_pair[order], cut[order]
+        same = cut_pair[1:] == cut_pair[:-1]
+        piece_pair, piece_lo, piece_hi = cut_pair[1:][same], cut[:-1][same], cut[1:][same]
+        middle = (piece_lo + piece_hi) / 2
+        point = xa[piece_pair] + middle[:, np.newaxis] * (xb[piece_pair] - xa[piece_pair])
+        point = _normalize(center[piece_pair] + point[:, :1] * e1[piece_pair] + point[:, 1:] * e2[piece_pair])
+        inside = points_in_polygons(packed, obs[piece_pair], *xyz_to_lonlat(point))
+        los.append(piece_lo[inside])
+        his.append(piece_hi[inside])
+        pairs.append(piece_pair[inside])
+
+        # Back from the projected line to the arc parameter, which is not linear in the projection
+        lo = np.clip(np.concatenate(los), 0, 1)
+        hi = np.clip(np.concatenate(his), 0, 1)
+        pairs = np.concatenate(pairs)
+        weight_a, weight_b = wa[pairs], wb[pairs]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lo = lo * weight_a / (lo * weight_a + (1 - lo) * weight_b)
+            hi = hi * weight_a / (hi * weight_a + (1 - hi) * weight_b)
+        covered[start:stop] = _union_lengths(pairs - start, lo, hi, stop - start)
+
+    return covered
+
+
+def swept_check(index, eph_ra, eph_dec, eph_mjd, rows=None, radius=0.0083, max_piece=2.):
+    """
+    Fraction of each observation's exposure during which the target overlaps its footprint.
+
+    The target path is interpolated along great circles between the ephemerides (linearly in time, as
+    in segment_check) over each observation's [t_min, t_max], and intersected with the footprint grown by
+    radius (the footprint, plus a disk around each vertex and a band along each edge). Crossings are exact:
+    each piece of path is projected with its footprint on the plane tangent at its middle (gnomonic
+    projection, where great circles are straight lines). Pieces are at most max_piece long, so distances
+    to the edges are off by less than 0.1% of radius.
+
+    Parameters
+    ----------
+    index : FootprintIndex
+        Index of the observation footprints and their start/end times, built without s_ra/s_dec
+    eph_ra, eph_dec, eph_mjd : numpy array
+        Ephemerides positions and MJD times, sorted by time. Parts of exposures outside them count as
+        out of the footprint.
+    rows : numpy array
+        Footprints to check (Default: None, all footprints)
+    radius : float
+        Size of target for intersection calculations. None or 0 for a point.
+    max_piece : float
+        Longest piece of path projected at once, in degrees (Default: 2)
+
+    Returns
+    -------
+    fractions : numpy array
+        Fraction of the exposure time in the footprint for each row checked, between 0 and 1.
+        Exposures shorter than a second are treated as lasting a second.
+    """
+
+    eph_ra = np.asarray(eph_ra, dtype=float)
+    eph_dec = np.asarray(eph_dec, dtype=float)
+    eph_mjd = np.asarray(eph_mjd, dtype=float)
+    if rows is None:
+        rows = np.arange(len(index.packed))
+    rows = np.asarray(rows, dtype=int)
+    selected = np.zeros(len(index.packed), dtype=bool)
+    selected[rows] = True
+    fractions = np.zeros(len(index.packed))
+    if len(eph_mjd) < 2:
+        return fractions[rows]
+
+    # Split the path into pieces of at most max_piece degrees, keeping time linear along the chords
+    xyz = lonlat_to_xyz(eph_ra, eph_dec).reshape(-1, 3)
+    n = np.maximum(np.ceil(np.degrees(_angle(xyz[:-1], xyz[1:])) / max_piece), 1).astype(int)
+    segment = np.repeat(np.arange(len(n)), n)
+    k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    u0, u1 = k / n[segment], (k + 1) / n[segment]
+    chord = (xyz[1:] - xyz[:-1])[segment]
+    p0 = _normalize(xyz[:-1][segment] + u0[:, np.newaxis] * chord)
+    p1 = _normalize(xyz[:-1][segment] + u1[:, np.newaxis] * chord)
+    t0 = eph_mjd[:-1][segment] + u0 * np.diff(eph_mjd)[segment]
+    t1 = eph_mjd[:-1][segment] + u1 * np.diff(eph_mjd)[segment]
+
+    # Exposures of at least a second, for a meaningful fraction
+    t_min = index.t_min
+    t_max = np.maximum(index.t_max, t_min + 1. / 86400)
+    pad = radius if radius is not None and radius > 0 else 0.
+    piece, obs = index.query(t0, t1, _normalize(p0 + p1), np.degrees(_angle(p0, p1)) / 2 + pad)
+    keep = selected[obs]
+    piece, obs = piece[keep], obs[keep]
+
+    # Part of each piece within the exposure, then the fraction of that part in the footprint
+    duration = np.where(t1[piece] > t0[piece], t1[piece] - t0[piece], 1.)
+    v0 = np.clip((t_min[obs] - t0[piece]) / duration, 0, 1)[:, np.newaxis]
+    v1 = np.clip((t_max[obs] - t0[piece]) / duration, 0, 1)[:, np.newaxis]
+    exposed = (v1 - v0)[:, 0] * (t1[piece] - t0[piece])
+    keep = exposed > 0
+    piece, obs, v0, v1, exposed = piece[keep], obs[keep], v0[keep], v1[keep], exposed[keep]
+    a = _normalize(p0[piece] + v0 * (p1[piece] - p0[piece]))
+    b = _normalize(p0[piece] + v1 * (p1[piece] - p0[piece]))
+
+    covered = _covered_fractions(index.packed, obs, a, b, radius)
+    in_footprint = np.bincount(obs, weights=covered * exposed, minlength=len(index.packed))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fractions = np.clip(in_footprint / (t_max - t_min), 0, 1)
+    fractions = np.where(np.isfinite(fractions) & index.packed.valid, fractions, 0.)
+    return fractions[rows]
@@ -0,0 +1,233 @@
+# Functions to handle background jobs with progress updates and cancellation
+
+import os
+import time
+import uuid
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+PENDING, RUNNING, DONE, ERROR, CANCELLED = 'pending', 'running', 'done', 'error', 'cancelled'
+WORKERS_ENV = 'MOVINGMAST_JOB_WORKERS'
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job function when the job has been cancelled.
+    """
+
+
+class Job:
+    """
+    A function running in the background, with its status, progress and result.
+
+    The job function receives the Job as its first argument and reports progress with update(),
+    which also raises JobCancelled once the job has been cancelled (cooperative cancellation).
+
+    Attributes
+    ----------
+    id : str
+        Job identifier
+    name : str
+        Short description of the job
+    status : str
+        One of pending, running, done, error or cancelled
+    message : str
+        Last progress message
+    done, total : int
+        Progress counters, total is None when unknown
+    partial : object
+        Intermediate results made available by the job function (eg, the first pages of a query)
+    result : object
+        Value returned by the job function
+    error : Exception
+        Exception raised by the job function
+    """
+
+    def __init__(self, name=''):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.status = PENDING
+        self.message = 'Waiting for a worker...'
+        self.done = 0
+        self.total = None
+        self.partial = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.ended = None
+        self.future = None
+        self._cancel = threading.Event()
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.name!r} {self.status}: {self.message}>'
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, ERROR, CANCELLED)
+
+    @property
+    def fraction(self):
+        # Completed fraction, None when unknown
+        if not self.total:
+            return None
+        return min(self.done / self.total, 1.)
+
+    def check(self):
+        """
+        Raise JobCancelled if the job has been cancelled.
+        """
+
+        if self.cancelled:
+            raise JobCancelled(f'Job {self.id} was cancelled')
+
+    def update(self, message=None, done=None, total=None, partial=None):
+        """
+        Report progress from the job function. Raises JobCancelled if the job has been cancelled.
+
+        Parameters
+        ----------
+        message : str
+            Progress message (Default: None, unchanged)
+        done, total : int
+            Progress counters (Default: None, unchanged)
+        partial : object
+            Intermediate results (Default: None, unchanged)
+        """
+
+        self.check()
+        if message is not None:
+            self.message = message
+        if done is not None:
+            self.done = done
+        if total is not None:
+            self.total = total
+        if partial is not None:
+            self.partial = partial
+
+    def cancel(self):
+        """
+        Ask the job to stop. Pending jobs never start; running jobs stop at their next update().
+        """
+
+        self._cancel.set()
+        if self.future is not None and self.future.cancel():
+            self._finish(CANCELLED, 'Cancelled')
+
+    def _finish(self, status, message):
+        self.status = status
+        self.message = message
+        self.ended = time.time()
+
+    async def wait(self, interval=0.5):
+        """
+        Wait for the job to finish without blocking the event loop.
+        """
+
+        while not self.finished:
+            await asyncio.sleep(interval)
+        return self
+
+
+class JobManager:
+    """
+    Pool of worker threads running jobs, shared by all sessions of a process.
+
+    Parameters
+    ----------
+    max_workers : int
+        Number of jobs running at the same time, others wait in a queue (Default: 8)
+    keep : float
+        Seconds to keep finished jobs for get() (Default: 3600)
+    """
+
+    def __init__(self, max_workers=8, keep=3600):
+        self.max_workers = max_workers
+        self.keep = keep
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='movingmast-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, function, *args, name='', **kwargs):
+        """
+        Run function(job, *args, **kwargs) in the background.
+
+        Returns
+        -------
+        job : Job
+        """
+
+        job = Job(name=name)
+
+        def run():
+            if job.cancelled:
+                job._finish(CANCELLED, 'Cancelled')
+                return
+            job.status = RUNNING
+            job.message = 'Running...'
+            try:
+                job.result = function(job, *args, **kwargs)
+                job._finish(DONE, 'Done')
+            except JobCancelled:
+                job._finish(CANCELLED, 'Cancelled')
+            except Exception as e:
+                job.error = e
+                job._finish(ERROR, f'{e}')
+
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        job.future = self.executor.submit(run)
+        return job
+
+    def get(self, job_id):
+        """
+        Job with the given id, None if unknown.
+        """
+
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancel the job with the given id.
+        """
+
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def jobs(self):
+        """
+        List of known jobs, oldest first.
+        """
+
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _prune(self):
+        # Forget jobs that finished more than keep seconds ago
+        now = time.time()
+        for job_id in [k for k, job in self._jobs.items() if job.finished and now - job.ended > self.keep]:
+            del self._jobs[job_id]
+
+
+_default_manager = None
+_default_lock = threading.Lock()
+
+
+def get_job_manager():
+    """
+    Process-wide JobManager, with the number of workers from the MOVINGMAST_JOB_WORKERS environment variable.
+    """
+
+    global _default_manager
+    with _default_lock:
+        if _default_manager is None:
+            _default_manager = JobManager(max_workers=int(os.environ.get(WORKERS_ENV, 8)))
+        return _default_manager
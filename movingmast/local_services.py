@@ -0,0 +1,611 @@
+# Local stand-ins for JPL Horizons and the MAST TAP service, for offline benchmarks and development
+
+import io
+import os
+import re
+import time
+import uuid
+import zlib
+import threading
+import numpy as np
+import astropy.units as u
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+from astropy.table import Table, vstack
+from astropy.io.votable import from_table
+from astropy.io.votable.tree import Info
+from .ephemeris import epochs_to_jd, _jd_to_str, HorizonsEngine
+from .polygon import PackedRegions
+from .spherical import points_in_polygons
+
+MISSIONS = {  # footprint size (deg), exposure time (s) and instrument of the synthetic observations
+    'HST': (0.05, 1200., 'WFC3/UVIS'),
+    'TESS': (2., 1800., 'Photometer'),
+    'K2': (0.3, 1800., 'Kepler'),
+    'SWIFT': (0.4, 900., 'UVOT'),
+    'GALEX': (1.2, 1500., 'GALEX'),
+}
+LOCATIONS = {'TESS': '@TESS', 'K2': '500@-227'}  # observers of the labels in moving_targets.txt
+
+
+def _slug(*items):
+    # File name for a fixture
+    text = '_'.join(str(x) for x in items if x is not None)
+    return re.sub(r'[^A-Za-z0-9.+-]+', '_', text).strip('_')
+
+
+def _seed(*items):
+    return zlib.crc32('|'.join(str(x) for x in items).encode())
+
+
+def synthetic_ephemerides(obj_name, times, id_type='smallbody', location=None):
+    """
+    Deterministic ephemerides with the columns of get_path, for objects without recorded fixtures.
+    Each object moves along a smooth, curving track with a rate of 0.05-0.5 degrees per day.
+
+    Parameters
+    ----------
+    obj_name, times, id_type, location
+        See get_path
+
+    Returns
+    -------
+    eph : astropy Table
+    """
+
+    rng = np.random.default_rng(_seed(obj_name, id_type))
+    jd = epochs_to_jd(times)
+    ra0, dec0 = rng.uniform(0, 360), rng.uniform(-60, 60)
+    rate = rng.uniform(0.05, 0.5)  # deg/day
+    angle = rng.uniform(0, 2 * np.pi)  # initial direction, rad
+    curvature = rng.choice([-1, 1]) * rng.uniform(0.005, 0.02)  # rad/day
+
+    # Arc of a circle started at J2000, repeating every 10 years, so any set of epochs gives the same positions
+    phase = (jd - 2451545.0) % 3650
+    heading = angle + curvature * phase
+    x = rate * (np.sin(heading) - np.sin(angle)) / curvature
+    y = -rate * (np.cos(heading) - np.cos(angle)) / curvature
+    dec = np.clip(dec0 + y, -85, 85)
+    ra = (ra0 + x / np.cos(np.radians(dec))) % 360
+
+    eph = Table()
+    eph['targetname'] = [str(obj_name)] * len(jd)
+    eph['datetime_str'] = _jd_to_str(jd)
+    eph['datetime_jd'] = jd * u.d
+    eph['RA'] = ra * u.deg
+    eph['DEC'] = dec * u.deg
+    # Derivatives of the positions in arcsec/hour, RA_rate including cos(dec) like Horizons
+    dec_rate = np.where(np.abs(dec0 + y) < 85, rate * np.sin(heading), 0.)
+    ra_rate = rate * np.cos(heading) + x * np.tan(np.radians(dec)) * np.radians(dec_rate)
+    eph['RA_rate'] = ra_rate * 3600 / 24 * u.arcsec / u.hour
+    eph['DEC_rate'] = dec_rate * 3600 / 24 * u.arcsec / u.hour
+    return eph
+
+
+class FixtureEngine:
+    """
+    Ephemeris engine serving recorded JPL Horizons ephemerides (see record_fixtures), interpolated
+    to the requested epochs, and synthetic_ephemerides for objects without fixtures.
+
+    Parameters
+    ----------
+    directory : str
+        Fixture directory, with a horizons subdirectory (Default: None, synthetic ephemerides only)
+    latency : float
+        Seconds to wait for each request, to mimic the round-trip to JPL Horizons (Default: 0)
+    synthetic : bool
+        Use synthetic ephemerides for objects without fixtures instead of raising an error (Default: True)
+    remote : bool
+        Report the engine as remote, so get_path caches its results like those of JPL Horizons (Default: False)
+    """
+
+    name = 'fixture'
+
+    def __init__(self, directory=None, latency=0., synthetic=True, remote=False):
+        self.directory = directory
+        self.latency = latency
+        self.synthetic = synthetic
+        self.remote = remote
+        self._fixtures = {}
+
+    def _fixture(self, obj_name, id_type, location):
+        key = _slug(obj_name, id_type, location)
+        if key not in self._fixtures:
+            filename = None if self.directory is None else os.path.join(self.directory, 'horizons', f'{key}.ecsv')
+            self._fixtures[key] = Table.read(filename) if filename is not None and os.path.exists(filename) else None
+        return self._fixtures[key]
+
+    def ephemerides(self, obj_name, times, id_type='smallbody', location=None):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        fixture = self._fixture(obj_name, id_type, location)
+        if fixture is None:
+            if not self.synthetic:
+                raise ValueError(f'No recorded ephemerides for {obj_name}')
+            return synthetic_ephemerides(obj_name, times, id_type=id_type, location=location)
+
+        jd = epochs_to_jd(times)
+        grid = np.asarray(fixture['datetime_jd'], dtype=float)
+        if jd.min() < grid[0] or jd.max() > grid[-1]:
+            raise ValueError(f'Epochs outside of the recorded ephemerides of {obj_name}')
+        eph = Table()
+        eph['targetname'] = [fixture['targetname'][0]] * len(jd)
+        eph['datetime_str'] = _jd_to_str(jd)
+        eph['datetime_jd'] = jd * u.d
+        ra = np.degrees(np.unwrap(np.radians(np.asarray(fixture['RA'], dtype=float))))
+        eph['RA'] = np.interp(jd, grid, ra) % 360 * u.deg
+        for col in fixture.colnames:
+            if col not in eph.colnames and fixture[col].dtype.kind == 'f':
+                eph[col] = np.interp(jd, grid, np.asarray(fixture[col])) * (fixture[col].unit or 1)
+        return eph
+
+
+def read_moving_targets(filename):
+    """
+    Targets and search windows listed in moving_targets.txt, for fixtures and benchmarks.
+
+    Returns
+    -------
+    targets : list
+        Dictionaries with obj_name, id_type, start, stop and location, like read_targets
+    """
+
+    targets = []
+    date = r'(\d{4}-\d{2}-\d{2}|\d{1,2}/\d{1,2}/\d{2})'
+    pattern = re.compile(rf'^\s*(.*?)\s+(?:(\S+):\s*)?{date}\s+-?\s*{date}\s*(\w*)')
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0]
+            match = pattern.match(line)
+            if match is None:
+                continue
+            name, label, start, stop, id_type = match.groups()
+            name = name.rstrip(':').strip()
+            number = re.match(r'\(?(\d+)\)?\s', name + ' ')
+            obj_name = number.group(1) if number else name.split(':')[-1].strip()
+            location = LOCATIONS.get(label)
+            targets.append({'obj_name': obj_name, 'id_type': id_type or ('majorbody' if ':' in line.split()[0]
+                                                                         else 'smallbody'),
+                            'start': _iso_date(start), 'stop': _iso_date(stop), 'location': location})
+    return targets
+
+
+def _iso_date(date):
+    if '/' in date:
+        month, day, year = date.split('/')
+        return f'20{year}-{int(month):02d}-{int(day):02d}'
+    return date
+
+
+def synthetic_observations(eph, n_rows, radius=0.0083, on_path=0.5, missions=None, seed=0, start_id=1000000):
+    """
+    Synthetic MAST observations around a path, with the columns of dbo.ObsPointing used by the package.
+
+    Observations are spread over the time span of the path. A fraction of them contain the target at
+    their mid-point time, the others are shifted by a few footprint sizes. K2 observations have two
+    POLYGON rings, like the Kepler CCD footprints.
+
+    Parameters
+    ----------
+    eph : astropy Table
+        Path with datetime_jd, RA and DEC
+    n_rows : int
+        Number of observations
+    radius : float
+        Target radius in degrees (Default: 0.0083)
+    on_path : float
+        Fraction of the observations containing the target (Default: 0.5)
+    missions : list
+        Missions to draw from (Default: None, all of MISSIONS)
+    seed : int
+        Random seed (Default: 0)
+    start_id : int
+        First obsID (Default: 1000000)
+
+    Returns
+    -------
+    observations : astropy Table
+    """
+
+    rng = np.random.default_rng(seed)
+    missions = list(MISSIONS) if missions is None else list(missions)
+    jd = np.asarray(eph['datetime_jd'], dtype=float)
+    ra_path = np.degrees(np.unwrap(np.radians(np.asarray(eph['RA'], dtype=float))))
+    dec_path = np.asarray(eph['DEC'], dtype=float)
+
+    mission = np.array(missions)[rng.integers(0, len(missions), n_rows)]
+    size = np.array([MISSIONS[m][0] for m in mission])
+    exptime = np.array([MISSIONS[m][1] for m in mission]) * rng.uniform(0.5, 2, n_rows)
+    t_mid = rng.uniform(jd[0], jd[-1], n_rows) - 2400000.5
+    ra = np.interp(t_mid + 2400000.5, jd, ra_path)
+    dec = np.interp(t_mid + 2400000.5, jd, dec_path)
+    off = rng.random(n_rows) >= on_path
+    shift = np.where(off, rng.uniform(1.5, 4, n_rows), rng.uniform(0, 0.3, n_rows)) * (size + radius)
+    angle = rng.uniform(0, 2 * np.pi, n_rows)
+    dec = np.clip(dec + shift * np.sin(angle), -89, 89)
+    ra = (ra + shift * np.cos(angle) / np.cos(np.radians(dec))) % 360
+
+    # Square footprints (two side by side rings for K2), counter-clockwise
+    half = size / 2
+    width = half / np.cos(np.radians(dec))
+    corners = [(-1, -1), (1, -1), (1, 1), (-1, 1)]
+    regions = []
+    for k in range(n_rows):
+        rings = [(ra[k], width[k])] if mission[k] != 'K2' else [(ra[k] - width[k] / 2, width[k] / 2),
+                                                                 (ra[k] + width[k] / 2, width[k] / 2)]
+        regions.append(' '.join('POLYGON ICRS ' + ' '.join(f'{(c + a * w) % 360:.6f} {dec[k] + b * half[k]:.6f}'
+                                                           for a, b in corners)
+                                for c, w in rings))
+
+    t = Table()
+    t['obsID'] = np.arange(start_id, start_id + n_rows)
+    t['obs_id'] = [f'{m.lower()}_{i:08d}' for m, i in zip(mission, t['obsID'])]
+    t['obs_collection'] = mission
+    t['dataproduct_type'] = np.where(rng.random(n_rows) < 0.8, 'image', 'spectrum')
+    t['instrument_name'] = [MISSIONS[m][2] for m in mission]
+    t['filters'] = np.array(['F606W', 'TESS', 'KEPLER', 'UVW1', 'NUV'])[rng.integers(0, 5, n_rows)]
+    t['target_name'] = [f'FIELD-{i % 997}' for i in range(n_rows)]
+    t['proposal_pi'] = np.array(['Smith', 'Garcia', 'Chen', 'Okafor', 'Novak'])[rng.integers(0, 5, n_rows)]
+    t['proposal_id'] = [str(x) for x in rng.integers(10000, 20000, n_rows)]
+    t['calib_level'] = rng.integers(1, 4, n_rows)
+    t['t_exptime'] = exptime
+    t['s_ra'] = ra
+    t['s_dec'] = dec
+    t['s_region'] = regions
+    t['t_min'] = t_mid - exptime / 86400 / 2
+    t['t_max'] = t_mid + exptime / 86400 / 2
+    t['wavelength_region'] = np.where(mission == 'GALEX', 'UV', 'OPTICAL')
+    t['dataRights'] = 'PUBLIC'
+    t['dataURL'] = [f'mast:{m}/product/{i}.fits' for m, i in zip(mission, t['obs_id'])]
+    return t
+
+
+def record_fixtures(targets, directory, step='6h', service=None, maxrec=None, engine=None, verbose=False):
+    """
+    Record JPL Horizons ephemerides and MAST TAP results of targets (eg, from read_moving_targets)
+    as fixtures for FixtureEngine and LocalTapService. Requires network access.
+
+    Parameters
+    ----------
+    targets : list
+        Target dictionaries with obj_name, id_type, start, stop and location
+    directory : str
+        Fixture directory
+    step : str
+        Ephemeris step; the fixtures are interpolated to other steps (Default: 6h)
+    service : str
+        TAP service to record (Default: None, the STScI CAOMTAP service)
+    maxrec : int
+        Maximum number of MAST records per target (Default: None, all)
+    engine : HorizonsEngine or KeplerEngine
+        Ephemeris engine to record (Default: None, JPL Horizons)
+    verbose : bool
+        Flag to control verbosity of output messages. (Default: False)
+    """
+
+    from .mast_tap import iter_chunked_tap_query, DEFAULT_SERVICE
+
+    for sub in ('horizons', 'tap'):
+        os.makedirs(os.path.join(directory, sub), exist_ok=True)
+    if engine is None:
+        engine = HorizonsEngine()
+    for target in targets:
+        times = {'start': target['start'], 'stop': target['stop'], 'step': step}
+        eph = engine.ephemerides(target['obj_name'], times, id_type=target['id_type'], location=target['location'])
+        keep = [c for c in eph.colnames if eph[c].dtype.kind in 'fiU' or c == 'targetname']
+        eph = Table(eph[keep], masked=False)
+        eph.write(os.path.join(directory, 'horizons', _slug(target['obj_name'], target['id_type'],
+                                                            target['location']) + '.ecsv'), overwrite=True)
+        chunks = list(iter_chunked_tap_query(eph, service=service or DEFAULT_SERVICE, max_records=maxrec,
+                                             verbose=verbose))
+        results = vstack(chunks, metadata_conflicts='silent') if len(chunks) > 0 else Table()
+        results.write(os.path.join(directory, 'tap', _slug(target['obj_name'], target['start']) + '.ecsv'),
+                      overwrite=True)
+        if verbose:
+            print(f"{target['obj_name']}: {len(eph)} epochs, {len(results)} MAST records")
+
+
+def read_tap_fixtures(directory):
+    """
+    Observations recorded by record_fixtures, as a single catalog for LocalTapService.
+    """
+
+    folder = os.path.join(directory, 'tap')
+    tables = [Table.read(os.path.join(folder, x)) for x in sorted(os.listdir(folder)) if x.endswith('.ecsv')] \
+        if os.path.isdir(folder) else []
+    tables = [x for x in tables if len(x) > 0]
+    if len(tables) == 0:
+        return Table()
+    catalog = vstack(tables, metadata_conflicts='silent')
+    _, first = np.unique(np.asarray(catalog['obsID']).astype(str), return_index=True)
+    return catalog[np.sort(first)]
+
+
+class QueryError(ValueError):
+    """
+    ADQL query not supported by LocalTapService.
+    """
+
+
+_SELECT = re.compile(r'^\s*SELECT\s+(?:TOP\s+(\d+)\s+)?(.*?)\s+FROM\s+(\S+)\s*(?:WHERE\s+(.*?))?'
+                     r'\s*(?:ORDER\s+BY\s+(\w+)\s*)?$', re.I | re.S)
+_CONTAINS = re.compile(r"CONTAINS\(\s*s_region\s*,\s*POLYGON\(\s*'[^']*'\s*,([^)]*)\)\s*\)\s*=\s*1", re.I)
+_TIME = re.compile(r'\(?\s*t_min\s*<=\s*([-+\d.eE]+)\s+AND\s+t_max\s*>=\s*([-+\d.eE]+)\s*\)?', re.I)
+_IN = re.compile(r'(\w+)\s+IN\s*\(([^)]*)\)', re.I)
+_GREATER = re.compile(r"(\w+)\s*>\s*('(?:[^']|'')*'|[-+\d.eE]+)", re.I)
+_LITERAL = re.compile(r"'((?:[^']|'')*)'|([-+\d.eE]+)")
+_T_MID = re.compile(r'\(\s*t_min\s*\+\s*t_max\s*\)\s*/\s*2\s*\+\s*2400000\.5\s+AS\s+(\w+)', re.I)
+
+
+def _literals(text):
+    # Values of a comma-separated list of ADQL literals, strings or numbers
+    values = []
+    for quoted, number in _LITERAL.findall(text):
+        values.append(float(number) if number else quoted.replace("''", "'"))
+    return values
+
+
+def _compare_values(column, value):
+    # Column values comparable with an ADQL literal
+    if isinstance(value, str):
+        return np.char.strip(np.asarray(column).astype(str))
+    return np.asarray(column, dtype=float)
+
+
+class LocalTapService:
+    """
+    Local HTTP stand-in for the MAST CAOMTAP service with synchronous (/sync) and asynchronous (/async, UWS)
+    TAP queries on an in-memory catalog of observations, eg from synthetic_observations or read_tap_fixtures.
+
+    It evaluates the ADQL produced by build_tap_query and fetch_columns: TOP, column lists (including the
+    derived t_mid), CONTAINS of the observation center in a POLYGON, the time overlap, IN lists,
+    the greater-than condition for paging and ORDER BY. Other queries are answered with a TAP error.
+
+    Use it as a context manager, or call start() and stop(), and pass url as the service:
+
+        with LocalTapService(catalog) as tap:
+            results = run_tap_query(stcs, service=tap.url, cache=False)
+
+    Parameters
+    ----------
+    catalog : astropy Table
+        Observations, with at least obsID, s_ra, s_dec, t_min, t_max and obs_collection
+    host : str
+        Address to listen on (Default: 127.0.0.1)
+    port : int
+        Port to listen on (Default: 0, any free port)
+    latency : float
+        Seconds to wait before answering each request, to mimic the network round-trip (Default: 0)
+    """
+
+    def __init__(self, catalog, host='127.0.0.1', port=0, latency=0.):
+        self.catalog = catalog
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self._jobs = {}
+        self._polygons = {}  # CONTAINS results by polygon
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+        self._centers = np.column_stack([np.asarray(catalog['s_ra'], dtype=float),
+                                         np.asarray(catalog['s_dec'], dtype=float)]) if len(catalog) > 0 else None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/tap'
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def query(self, adql, maxrec=None):
+        """
+        Evaluate an ADQL query on the catalog.
+
+        Returns
+        -------
+        results : astropy Table
+        """
+
+        match = _SELECT.match(adql)
+        if match is None:
+            raise QueryError(f'Unsupported query: {adql}')
+        top, select, _, where, order_by = match.groups()
+        t = self.catalog
+        keep = np.ones(len(t), dtype=bool)
+        where = where or ''
+
+        polygon = _CONTAINS.search(where)
+        if polygon is not None:
+            keep &= self._contains(polygon.group(1))
+            where = where.replace(polygon.group(0), '')
+        window = _TIME.search(where)
+        if window is not None:
+            end, start = float(window.group(1)), float(window.group(2))
+            keep &= (np.asarray(t['t_min'], dtype=float) <= end) & (np.asarray(t['t_max'], dtype=float) >= start)
+            where = where.replace(window.group(0), '')
+        for col, values in _IN.findall(where):
+            values = _literals(values)
+            if len(values) > 0:
+                keep &= np.isin(_compare_values(t[col], values[0]), values)
+        where = _IN.sub('', where)
+        for col, value in _GREATER.findall(where):
+            value = _literals(value)[0]
+            keep &= _compare_values(t[col], value) > value
+
+        rows = np.where(keep)[0]
+        if order_by is not None:
+            values = t[order_by][rows]
+            rows = rows[np.argsort(np.asarray(values) if values.dtype.kind != 'U' else values, kind='stable')]
+        limit = min([int(x) for x in (top, maxrec) if x is not None], default=None)
+        if limit is not None:
+            rows = rows[:limit]
+        return self._project(t[rows], select)
+
+    def _contains(self, text):
+        # Observation centers in a polygon, kept for the following pages of the same search
+        with self._lock:
+            if text in self._polygons:
+                return self._polygons[text]
+        vertices = np.array(_literals(text), dtype=float).reshape(-1, 2)
+        ring = PackedRegions.from_rings([vertices])
+        inside = points_in_polygons(ring, np.zeros(len(self.catalog), dtype=int), self._centers[:, 0],
+                                    self._centers[:, 1])
+        with self._lock:
+            self._polygons[text] = inside
+            while len(self._polygons) > 16:
+                self._polygons.pop(next(iter(self._polygons)))
+        return inside
+
+    @staticmethod
+    def _project(t, select):
+        if select.strip() == '*':
+            return t
+        out = Table()
+        for item in [x.strip() for x in select.split(',')]:
+            derived = _T_MID.match(item)
+            if derived is not None:
+                out[derived.group(1)] = (np.asarray(t['t_min'], dtype=float) +
+                                         np.asarray(t['t_max'], dtype=float)) / 2 + 2400000.5
+            elif item in t.colnames:
+                out[item] = t[item]
+            else:
+                raise QueryError(f'Unknown column: {item}')
+        return out
+
+    @staticmethod
+    def votable(t=None, error=None):
+        """
+        VOTable document with a table of results, or a TAP error.
+        """
+
+        vot = from_table(t if t is not None else Table({'error': np.zeros(0)}))
+        resource = vot.resources[0]
+        resource.type = 'results'
+        info = Info(name='QUERY_STATUS', value='ERROR' if error is not None else 'OK')
+        if error is not None:
+            info.content = str(error)
+        resource.infos.append(info)
+        buffer = io.BytesIO()
+        vot.to_xml(buffer)
+        return buffer.getvalue()
+
+    def _run(self, params):
+        try:
+            maxrec = params.get('MAXREC')
+            return 200, self.votable(self.query(params.get('QUERY', ''), None if maxrec is None else int(maxrec)))
+        except (QueryError, KeyError, ValueError) as e:
+            return 400, self.votable(error=e)
+
+    def _job_xml(self, job_id):
+        job = self._jobs[job_id]
+        result = ''
+        if job['phase'] == 'COMPLETED':
+            result = f'<uws:result id="result" xlink:href="{self.url}/async/{job_id}/results/result"/>'
+        error = ''
+        if job['phase'] == 'ERROR':
+            error = f'<uws:errorSummary type="fatal"><uws:message>{escape(job["error"])}</uws:message>' \
+                    f'</uws:errorSummary>'
+        return (f'<?xml version="1.0" encoding="UTF-8"?>'
+                f'<uws:job xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0" xmlns:xlink="http://www.w3.org/1999/xlink" '
+                f'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" version="1.1">'
+                f'<uws:jobId>{job_id}</uws:jobId><uws:ownerId xsi:nil="true"/>'
+                f'<uws:phase>{job["phase"]}</uws:phase><uws:quote xsi:nil="true"/>'
+                f'<uws:creationTime>{job["created"]}</uws:creationTime>'
+                f'<uws:startTime xsi:nil="true"/><uws:endTime xsi:nil="true"/>'
+                f'<uws:executionDuration>0</uws:executionDuration><uws:destruction xsi:nil="true"/>'
+                f'<uws:parameters><uws:parameter id="query">{escape(job["params"].get("QUERY", ""))}'
+                f'</uws:parameter></uws:parameters>'
+                f'<uws:results>{result}</uws:results>{error}</uws:job>').encode()
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _params(self):
+                query = parse_qs(urlparse(self.path).query)
+                if self.command == 'POST':
+                    length = int(self.headers.get('Content-Length', 0))
+                    query.update(parse_qs(self.rfile.read(length).decode()))
+                return {k.upper(): v[-1] for k, v in query.items()}
+
+            def _send(self, status, body=b'', content_type='text/xml', location=None):
+                self.send_response(status)
+                if location is not None:
+                    self.send_header('Location', location)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with service._lock:
+                    service.bytes_sent += len(body)
+
+            def _route(self):
+                with service._lock:
+                    service.requests += 1
+                if service.latency > 0:
+                    time.sleep(service.latency)
+                path = urlparse(self.path).path.rstrip('/').split('/')[2:]  # after /tap
+                params = self._params()
+                if path == ['sync']:
+                    return self._send(*service._run(params))
+                if path == ['async'] and self.command == 'POST':
+                    job_id = uuid.uuid4().hex[:12]
+                    with service._lock:
+                        service._jobs[job_id] = {'params': params, 'phase': 'PENDING', 'result': None, 'error': '',
+                                                 'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                    return self._send(303, location=f'{service.url}/async/{job_id}')
+                if len(path) < 2 or path[0] != 'async' or path[1] not in service._jobs:
+                    return self._send(404, b'Not found', 'text/plain')
+
+                job_id = path[1]
+                job = service._jobs[job_id]
+                if self.command == 'DELETE' or params.get('ACTION', '').upper() == 'DELETE':
+                    with service._lock:
+                        service._jobs.pop(job_id, None)
+                    return self._send(303, location=f'{service.url}/async')
+                if path[2:] == ['phase'] and self.command == 'POST':
+                    phase = params.get('PHASE', '').upper()
+                    if phase == 'RUN' and job['phase'] == 'PENDING':
+                        status, body = service._run(job['params'])
+                        job['result'] = body
+                        job['phase'] = 'COMPLETED' if status == 200 else 'ERROR'
+                        job['error'] = '' if status == 200 else 'Query error, see the result document'
+                    elif phase == 'ABORT' and job['phase'] not in ('COMPLETED', 'ERROR'):
+                        job['phase'] = 'ABORTED'
+                    return self._send(303, location=f'{service.url}/async/{job_id}')
+                if path[2:] == ['phase']:
+                    return self._send(200, job['phase'].encode(), 'text/plain')
+                if path[2:] == ['results', 'result'] and job['result'] is not None:
+                    return self._send(200, job['result'])
+                if path[2:] == []:
+                    return self._send(200, service._job_xml(job_id))
+                return self._send(404, b'Not found', 'text/plain')
+
+            do_GET = _route
+            do_POST = _route
+            do_DELETE = _route
+
+        return Handler
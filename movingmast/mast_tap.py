@@ -1,12 +1,21 @@
 # Functions to handle TAP related calls
 
+import queue
+import asyncio
+import threading
 import pyvo as vo
 import warnings
-from astropy.time import Time
-from astroquery.jplhorizons import Horizons
-from regions import PixCoord, PolygonPixelRegion, CirclePixelRegion
-from .polygon import parse_s_region
-from astroquery.mast import Observations
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import erfa
+from astropy.table import Table, MaskedColumn, vstack, unique
+from .polygon import get_packed_regions
+from .footprint import check_pairs, detail_check, segment_check, swept_check, FootprintIndex
+from .target import get_path, adaptive_path, split_path, convert_path_to_polygon
+from .async_tap import AsyncTapClient, run_coroutine
+from .cache import get_tap_cache
+from .products import get_product_lists
+from .metrics import span, timed, CountingSession
 warnings.simplefilter('ignore')  # block out warnings
 
 
@@ -21,10 +30,39 @@ def convert_stcs_for_adql(stcs):
     return adql
 
 
-def run_tap_query(stcs, start_time=None, end_time=None, mission=None,
-                  service='http://vao.stsci.edu/CAOMTAP/TapService.aspx', maxrec=100, verbose=False):
+DEFAULT_SERVICE = 'http://vao.stsci.edu/CAOMTAP/TapService.aspx'
+
+# Columns needed to verify results with clean_up_results, see build_tap_query
+VERIFY_COLUMNS = ['obsID', 'obs_id', 'obs_collection', 's_ra', 's_dec', 's_region', 't_min', 't_max']
+# Columns derived from t_min and t_max (see add_time_columns), not available from the TAP service
+DERIVED_COLUMNS = ['t_mid', 'obs_mid_date', 'start_date', 'end_date']
+
+
+def _select_columns(columns):
+    # Columns to request: always obsID (for paging and fetch_columns) and the times (for process_results),
+    # without the derived columns
+    if columns is None or columns == '*':
+        return None
+    selected = []
+    for col in ['obsID'] + list(columns) + ['t_min', 't_max']:
+        if col not in selected and col not in DERIVED_COLUMNS:
+            selected.append(col)
+    return selected
+
+
+def _adql_literal(value):
+    # Format a value for an ADQL comparison
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return repr(value.item() if hasattr(value, 'item') else value)
+
+
+def build_tap_query(stcs, start_time=None, end_time=None, mission=None, maxrec=100, order_by=None, after=None,
+                    columns=None):
     """
-    Handler for TAP service.
+    Build the ADQL query for observations in a polygon and time window.
 
     Parameters
     ----------
@@ -36,21 +74,29 @@ def run_tap_query(stcs, start_time=None, end_time=None, mission=None,
         MJD end time
     mission : str
         Mission to search for (eg, HST, TESS, etc). (Default: None)
-    service : str
-        Service to use (Default: STScI CAOMTAP)
     maxrec : int
         Number of records to return
-    verbose : bool
-        Flag to control verbosity of output messages. (Default: False)
+    order_by : str
+        Column to sort the results by, for paging (Default: None)
+    after : int or str
+        Only return records with order_by values greater than this, for paging (Default: None)
+    columns : list
+        Columns to return, eg VERIFY_COLUMNS (Default: None, all columns).
+        The mid-point time is then computed by the service as t_mid.
 
     Returns
     -------
-    results : astropy Table
-        Astropy Table of results
+    query : str
+        ADQL query
     """
-    tap = vo.dal.TAPService(service)
 
-    query = f"SELECT TOP {maxrec} * " \
+    columns = _select_columns(columns)
+    if columns is None:
+        select = '*'
+    else:
+        select = ', '.join(columns) + ', (t_min + t_max) / 2 + 2400000.5 AS t_mid'
+
+    query = f"SELECT TOP {maxrec} {select} " \
             f"FROM dbo.ObsPointing " \
             f"WHERE CONTAINS(s_region, {convert_stcs_for_adql(stcs)})=1 "
     if start_time is not None:
@@ -59,70 +105,731 @@ def run_tap_query(stcs, start_time=None, end_time=None, mission=None,
         mission_list = mission.split(',')
         mission_string = ','.join([f"'{x}'" for x in mission_list])
         query += f"AND obs_collection in ({mission_string}) "
-    if verbose:
-        print(query)
+    if order_by is not None:
+        if after is not None:
+            query += f'AND {order_by} > {_adql_literal(after)} '
+        query += f'ORDER BY {order_by}'
+    return query
+
+
+def _decode_columns(t):
+    # Decode bytes columns in place, with numpy string operations
+    for col in t.colnames:
+        column = t[col]
+        if len(column) == 0:
+            continue
+        if column.dtype.kind == 'S':
+            decoded = np.char.decode(np.asarray(column), 'utf-8')
+            mask = getattr(column, 'mask', None)
+            t[col] = MaskedColumn(decoded, mask=mask) if mask is not None and np.any(mask) else decoded
+        elif column.dtype.kind == 'O' and isinstance(column[0], bytes):
+            t[col] = [x.decode() if isinstance(x, bytes) else x for x in column]
+
+
+def _iso_strings(jd1, jd2):
+    # UTC ISO strings (YYYY-MM-DD HH:MM:SS.sss, as astropy Time.iso) from two-part Julian Dates,
+    # formatted digit by digit in a byte array. Non-finite dates give empty strings.
+    jd1 = np.asarray(jd1, dtype=float)
+    jd2 = np.asarray(jd2, dtype=float)
+    finite = np.isfinite(jd1) & np.isfinite(jd2)
+    iy, im, iday, ihmsf = erfa.d2dtf('UTC', 3, np.where(finite, jd1, 2400000.5), np.where(finite, jd2, 0.))
+    fields = [(iy, 4), '-', (im, 2), '-', (iday, 2), ' ', (ihmsf['h'], 2), ':', (ihmsf['m'], 2), ':',
+              (ihmsf['s'], 2), '.', (ihmsf['f'], 3)]
+    chars = np.zeros((len(jd1), 23), dtype=np.uint8)
+    position = 0
+    for field in fields:
+        if isinstance(field, str):
+            chars[:, position] = ord(field)
+            position += 1
+            continue
+        value, width = field
+        for k in range(width):
+            chars[:, position + k] = value // 10 ** (width - 1 - k) % 10 + ord('0')
+        position += width
+    chars[~finite] = 0
+    return chars.view('S23').ravel().astype('U23')
+
+
+def mjd_to_iso(mjd):
+    """
+    Convert MJD values to ISO strings, equivalent to astropy's Time(mjd, format='mjd').iso but much faster.
+    """
+
+    mjd = np.atleast_1d(np.asarray(mjd, dtype=float))
+    return _iso_strings(np.full(mjd.shape, 2400000.5), mjd)
+
+
+def jd_to_iso(jd):
+    """
+    Convert JD values to ISO strings, equivalent to astropy's Time(jd, format='jd').iso but much faster.
+    """
 
-    # TODO: Decide: Sync vs Async queries
-    print('Querying MAST...')
-    results = tap.search(query, maxrec=maxrec)
+    jd = np.atleast_1d(np.asarray(jd, dtype=float))
+    jd1 = np.floor(jd)
+    return _iso_strings(jd1, jd - jd1)
 
-    # Async query
-    # job = tap.submit_job(query, maxrec=100)
-    # job.run()
-    # Check job.phase until it is COMPLETED
-    # results = job.fetch_result()
 
-    t = results.to_table()
+def add_time_columns(t, dates=True):
+    """
+    Add the mid-point time (t_mid, JD) and the ISO date columns (obs_mid_date, start_date, end_date)
+    to MAST results, if not already present. Columns are derived once and reused afterwards.
+
+    Parameters
+    ----------
+    t : astropy Table
+        Table with t_min and t_max (MJD)
+    dates : bool
+        Add the ISO date columns as well as t_mid (Default: True)
+
+    Returns
+    -------
+    t : astropy Table
+        Same table, with the extra columns
+    """
+
+    if len(t) == 0:
+        return t
+    t_min = np.ma.filled(np.ma.asarray(t['t_min'], dtype=float), np.nan)
+    t_max = np.ma.filled(np.ma.asarray(t['t_max'], dtype=float), np.nan)
+    if 't_mid' not in t.colnames:
+        t['t_mid'] = (t_max + t_min) / 2 + 2400000.5
+    if not dates:
+        return t
+    if 'obs_mid_date' not in t.colnames:
+        # From the MJD mid-point for full precision
+        t['obs_mid_date'] = mjd_to_iso((t_max + t_min) / 2)
+    if 'start_date' not in t.colnames:
+        t['start_date'] = mjd_to_iso(t_min)
+    if 'end_date' not in t.colnames:
+        t['end_date'] = mjd_to_iso(t_max)
+    return t
+
+
+@timed()
+def process_results(t):
+    """
+    Decode bytes columns and add the mid-point time (t_mid) to TAP results.
+    The ISO date columns are only derived for the rows that are kept (eg, by clean_up_results),
+    see add_time_columns.
+
+    Parameters
+    ----------
+    t : astropy Table
+        Table from the TAP service
+
+    Returns
+    -------
+    t : astropy Table
+        Table with the extra column
+    """
 
-    # Add extra columns
     if len(t) > 0:
-        # Decode bytes columns
-        for col in t.colnames:
-            if isinstance(t[col][0], bytes):
-                t[col] = [x.decode() for x in t[col]]
+        _decode_columns(t)
+        add_time_columns(t, dates=False)
+
+    return t
 
-        # Add mid-point time in both jd and iso
-        t['t_mid'] = (t['t_max'] + t['t_min']) / 2 + 2400000.5
-        t['obs_mid_date'] = Time(t['t_mid'], format='jd').iso
-        t['start_date'] = Time(t['t_min'], format='mjd').iso
-        t['end_date'] = Time(t['t_max'], format='mjd').iso
 
+def _get_cache(cache):
+    # Resolve the cache argument of the query functions
+    if cache is True:
+        return get_tap_cache()
+    if cache is False:
+        return None
+    return cache
+
+
+def _tap_search(service, query, maxrec):
+    # Synchronous query, timed with the bytes received
+    session = CountingSession()
+    with span('tap_search', service=service) as stage:
+        t = vo.dal.TAPService(service, session=session).search(query, maxrec=maxrec).to_table()
+        stage.set(rows=len(t), bytes=session.received())
     return t
 
 
-def _detail_check(eph, polygon_pix, observation_coords, start_date, end_date, radius=0.0083, aggressive_check=False):
-    # A more detailed check for polygon footprint matching.
-    # This checks each location in the original ephemerides and confirms if an observation intersects it
+def run_tap_query(stcs, start_time=None, end_time=None, mission=None,
+                  service=DEFAULT_SERVICE, maxrec=100, verbose=False, cache=True, columns=None):
+    """
+    Handler for TAP service.
 
-    flag = False
-    for row in eph:
-        if aggressive_check:
-            if ((row['datetime_jd'] - 2400000.5) > end_date) or ((row['datetime_jd'] - 2400000.5) < start_date):
-                flag = False
-                continue
+    Parameters
+    ----------
+    stcs : str
+        Polygon to search for
+    start_time : float
+        MJD start time
+    end_time : float
+        MJD end time
+    mission : str
+        Mission to search for (eg, HST, TESS, etc). (Default: None)
+    service : str
+        Service to use (Default: STScI CAOMTAP)
+    maxrec : int
+        Number of records to return, None for all of them (fetched in pages with iter_tap_query)
+    verbose : bool
+        Flag to control verbosity of output messages. (Default: False)
+    cache : bool or TapResultCache
+        Cache to use for the results. True (default) uses the process-wide cache, False disables caching.
+    columns : list
+        Columns to return, eg VERIFY_COLUMNS. Others can be added later with fetch_columns. (Default: None, all)
+
+    Returns
+    -------
+    results : astropy Table
+        Astropy Table of results, with the ISO date columns (see add_time_columns)
+    """
+
+    search = {'stcs': stcs, 'start_time': start_time, 'end_time': end_time, 'mission': mission,
+              'columns': _select_columns(columns)}
+    if maxrec is None:
+        with span('run_tap_query', service=service, maxrec=maxrec) as stage:
+            chunks = list(iter_tap_query(service=service, verbose=verbose, cache=cache, **search))
+            t = vstack(chunks, metadata_conflicts='silent') if len(chunks) > 0 else Table()
+            stage.set(rows=len(t))
+        return add_time_columns(t)
+
+    def fetch():
+        if cache is not None:
+            t = cache.lookup(maxrec=maxrec, service=service, **search)
+            if t is not None:
+                print('Using cached MAST results')
+                return t
 
-        target_coords = PixCoord(row['RA'], row['DEC'])
-        if radius is None or radius < 0 and observation_coords is not None:
-            flag = target_coords in polygon_pix
+        query = build_tap_query(maxrec=maxrec, **search)
+        if verbose:
+            print(query)
+
+        # Synchronous query, see run_tap_queries for concurrent asynchronous jobs
+        print('Querying MAST...')
+        t = process_results(_tap_search(service, query, maxrec))
+        if cache is not None:
+            cache.store(t, maxrec=maxrec, service=service, **search)
+        return t
+
+    cache = _get_cache(cache)
+    with span('run_tap_query', service=service, maxrec=maxrec) as stage:
+        if cache is None:
+            t = fetch()
         else:
-            target_circle = CirclePixelRegion(center=target_coords, radius=radius)
-            flag = (target_coords in polygon_pix) or (observation_coords in target_circle)
+            # Concurrent identical queries (eg, from several dashboard sessions) share a single fetch
+            t = cache.coalesce(cache.key(maxrec=maxrec, service=service, **search), fetch)
+        stage.set(rows=len(t))
+    # Not in place, the table of a coalesced fetch is shared with the other requests
+    return add_time_columns(t.copy(copy_data=False))
+
+
+def iter_tap_query(stcs, start_time=None, end_time=None, mission=None, service=DEFAULT_SERVICE, page_size=1000,
+                   max_records=None, verbose=False, columns=None, cache=True):
+    """
+    Stream the results of a search in pages, so there is no maxrec ceiling and the first results
+    are available as soon as the first page arrives. Pages are sorted by obsID and each page asks for
+    the records after the last obsID of the previous one.
+
+    Complete streams are cached. Identical searches made while a stream is in progress wait for it
+    and then receive its pages from the cache instead of querying MAST again.
 
-        if flag:
+    Parameters
+    ----------
+    stcs : str
+        Polygon to search for
+    start_time : float
+        MJD start time
+    end_time : float
+        MJD end time
+    mission : str
+        Mission to search for (eg, HST, TESS, etc). (Default: None)
+    service : str
+        Service to use (Default: STScI CAOMTAP)
+    page_size : int
+        Number of records per page (Default: 1000)
+    max_records : int
+        Maximum number of records in total (Default: None, all of them)
+    verbose : bool
+        Flag to control verbosity of output messages. (Default: False)
+    columns : list
+        Columns to return, eg VERIFY_COLUMNS (Default: None, all columns)
+    cache : bool or TapResultCache
+        Cache to use for the results. True (default) uses the process-wide cache, False disables caching.
+
+    Yields
+    ------
+    results : astropy Table
+        Astropy Table with each page of results, processed with process_results
+    """
+
+    search = {'stcs': stcs, 'start_time': start_time, 'end_time': end_time, 'mission': mission,
+              'columns': _select_columns(columns)}
+    cache = _get_cache(cache)
+    if cache is None:
+        yield from _iter_pages(service=service, page_size=page_size, max_records=max_records, verbose=verbose,
+                               **search)
+        return
+
+    while True:
+        t = cache.lookup(maxrec=max_records, service=service, **search)
+        if t is not None:
+            for i in range(0, len(t), page_size):
+                yield t[i:i + page_size]
+            return
+        key = cache.key(maxrec=max_records, service=service, **search)
+        flight, leader = cache.join(key)
+        if leader:
+            break
+        # Wait for the identical stream in progress, then read it from the cache
+        t = flight.result()
+        if t is not None:
+            for i in range(0, len(t), page_size):
+                yield t[i:i + page_size]
+            return
+
+    pages = []
+    try:
+        for page in _iter_pages(service=service, page_size=page_size, max_records=max_records, verbose=verbose,
+                                **search):
+            pages.append(page)
+            yield page
+    except Exception as e:
+        cache.finish(key, error=e)
+        raise
+    except BaseException:
+        # Stream abandoned (eg, closed by the caller), waiting searches try again
+        cache.finish(key)
+        raise
+    t = vstack(pages, metadata_conflicts='silent') if len(pages) > 0 else Table()
+    cache.store(t, maxrec=max_records, service=service, **search)
+    cache.finish(key, t)
+
+
+def _iter_pages(stcs, start_time, end_time, mission, columns, service, page_size, max_records, verbose):
+    # Pages of results of a search, without caching
+    search = {'stcs': stcs, 'start_time': start_time, 'end_time': end_time, 'mission': mission,
+              'columns': columns}
+    last = None
+    n_records = 0
+    while max_records is None or n_records < max_records:
+        size = page_size if max_records is None else min(page_size, max_records - n_records)
+        query = build_tap_query(maxrec=size, order_by='obsID', after=last, **search)
+        if verbose:
+            print(query)
+
+        page = _tap_search(service, query, size)
+        if len(page) == 0:
             break
+        last = page['obsID'][-1]
+        n_records += len(page)
+        yield process_results(page)
+        if len(page) < size:
+            break
+
 
-    return flag
+def run_tap_queries(searches, service=DEFAULT_SERVICE, maxrec=100, max_concurrent=4, timeout=600, verbose=False,
+                    cache=True, columns=None):
+    """
+    Run several searches as concurrent asynchronous TAP jobs.
+    Blocks until all jobs are done: inside a running event loop (eg, Jupyter), await run_tap_queries_async instead.
+
+    Parameters
+    ----------
+    searches : list
+        List of dictionaries with the run_tap_query arguments for each search (stcs, start_time, end_time, mission,
+        and optionally columns)
+    service : str
+        Service to use (Default: STScI CAOMTAP)
+    maxrec : int
+        Number of records to return per search
+    max_concurrent : int
+        Maximum number of jobs running at the same time (Default: 4)
+    timeout : float
+        Timeout for each job in seconds (Default: 600)
+    verbose : bool
+        Flag to control verbosity of output messages. (Default: False)
+    cache : bool or TapResultCache
+        Cache to use for the results. True (default) uses the process-wide cache, False disables caching.
+    columns : list
+        Columns to return for the searches that do not specify them (Default: None, all columns)
+
+    Returns
+    -------
+    results : list
+        List of astropy Tables, in the same order as searches
+    """
+
+    return run_coroutine(run_tap_queries_async(searches, service=service, maxrec=maxrec, max_concurrent=max_concurrent,
+                                               timeout=timeout, verbose=verbose, cache=cache, columns=columns))
+
+
+async def run_tap_queries_async(searches, service=DEFAULT_SERVICE, maxrec=100, max_concurrent=4, timeout=600,
+                                verbose=False, cache=True, columns=None):
+    """
+    Coroutine running several searches as concurrent asynchronous TAP jobs, see run_tap_queries.
+    Use it with await from code already running an event loop (eg, Jupyter or Panel callbacks).
+    """
+
+    searches = [{**search, 'columns': _select_columns(search.get('columns', columns))} for search in searches]
+    cache = _get_cache(cache)
+    results = [None] * len(searches)
+    if cache is not None:
+        results = [cache.lookup(maxrec=maxrec, service=service, **search) for search in searches]
+    missing = [i for i, t in enumerate(results) if t is None]
+    if len(missing) == 0:
+        print('Using cached MAST results')
+        return results
+
+    queries = [build_tap_query(maxrec=maxrec, **searches[i]) for i in missing]
+    if verbose:
+        for query in queries:
+            print(query)
+
+    print(f'Querying MAST ({len(queries)} jobs, {len(searches) - len(queries)} cached)...')
+    session = CountingSession()
+    client = AsyncTapClient(service, max_concurrent=max_concurrent, timeout=timeout, session=session)
+    with span('run_tap_queries', service=service, jobs=len(queries), cached=len(searches) - len(queries)) as stage:
+        tables = await client.gather(queries, maxrec=maxrec)
+        stage.set(rows=sum(len(t) for t in tables), bytes=session.received())
+    for i, t in zip(missing, tables):
+        results[i] = process_results(t)
+        if cache is not None:
+            cache.store(results[i], maxrec=maxrec, service=service, **searches[i])
+    return results
+
+
+@timed()
+def run_chunked_tap_query(eph, radius=0.0083, max_days=5., max_vertices=200, mission=None, service=DEFAULT_SERVICE,
+                          maxrec=100, max_concurrent=4, timeout=600, verbose=False, cache=True, columns=None):
+    """
+    Search for observations along a path with one query per time segment.
+    Each segment of the path gets its own polygon and time window, so observations at the right place
+    but at the wrong time are not returned. Results are merged and de-duplicated on obsID.
+
+    Parameters
+    ----------
+    eph : astropy Table
+        Ephemerides of the target
+    radius : float
+        Width of the path in degrees
+    max_days : float
+        Maximum duration of each segment in days (Default: 5)
+    max_vertices : int
+        Vertex budget of each segment polygon, see convert_path_to_polygon (Default: 200)
+    mission : str
+        Mission to search for (eg, HST, TESS, etc). (Default: None)
+    service : str
+        Service to use (Default: STScI CAOMTAP)
+    maxrec : int
+        Number of records to return per segment and in total, None for all of them (streamed in pages with
+        iter_chunked_tap_query)
+    max_concurrent : int
+        Maximum number of segment queries running at the same time (Default: 4)
+    timeout : float
+        Timeout for each segment query in seconds (Default: 600)
+    verbose : bool
+        Flag to control verbosity of output messages. (Default: False)
+    cache : bool or TapResultCache
+        Cache to use for the results of each segment, see run_tap_query (Default: True)
+    columns : list
+        Columns to return, eg VERIFY_COLUMNS (Default: None, all columns)
+
+    Returns
+    -------
+    results : astropy Table
+        Astropy Table of results
+    """
+
+    if maxrec is None:
+        return _stream_segments(eph, radius, max_days, max_vertices, mission, service, max_concurrent, verbose,
+                                cache, columns)
+
+    searches = _segment_searches(eph, radius, max_days, max_vertices, mission, columns, verbose)
+    if len(searches) == 1:
+        return run_tap_query(service=service, maxrec=maxrec, verbose=verbose, cache=cache, **searches[0])
+
+    tables = run_tap_queries(searches, service=service, maxrec=maxrec, max_concurrent=max_concurrent,
+                             timeout=timeout, verbose=verbose, cache=cache)
+    return _merge_segments(tables, maxrec)
+
+
+async def run_chunked_tap_query_async(eph, radius=0.0083, max_days=5., max_vertices=200, mission=None,
+                                      service=DEFAULT_SERVICE, maxrec=100, max_concurrent=4, timeout=600,
+                                      verbose=False, cache=True, columns=None):
+    """
+    Coroutine searching for observations along a path with one query per time segment, see run_chunked_tap_query.
+    Use it with await from code already running an event loop (eg, Jupyter or Panel callbacks).
+    """
+
+    with span('run_chunked_tap_query'):
+        loop = asyncio.get_running_loop()
+        if maxrec is None:
+            # All the records, streamed in pages in a worker thread
+            return await loop.run_in_executor(None, lambda: _stream_segments(eph, radius, max_days, max_vertices,
+                                                                             mission, service, max_concurrent,
+                                                                             verbose, cache, columns))
+
+        searches = _segment_searches(eph, radius, max_days, max_vertices, mission, columns, verbose)
+        if len(searches) == 1:
+            # Synchronous query, in a worker thread
+            return await loop.run_in_executor(None, lambda: run_tap_query(service=service, maxrec=maxrec,
+                                                                          verbose=verbose, cache=cache,
+                                                                          **searches[0]))
+
+        tables = await run_tap_queries_async(searches, service=service, maxrec=maxrec,
+                                             max_concurrent=max_concurrent, timeout=timeout, verbose=verbose,
+                                             cache=cache)
+        return _merge_segments(tables, maxrec)
+
+
+def _segment_searches(eph, radius, max_days, max_vertices, mission, columns, verbose):
+    # run_tap_query arguments for each time segment of a path
+    searches = []
+    for segment in split_path(eph, max_days=max_days):
+        searches.append({'stcs': convert_path_to_polygon(segment, radius=radius, max_vertices=max_vertices,
+                                                         verbose=verbose),
+                         'start_time': min(segment['datetime_jd']) - 2400000.5,
+                         'end_time': max(segment['datetime_jd']) - 2400000.5,
+                         'mission': mission,
+                         'columns': columns})
+    return searches
+
+
+def _stream_segments(eph, radius, max_days, max_vertices, mission, service, max_concurrent, verbose, cache, columns):
+    # All the results of the segments of a path (maxrec=None), see iter_chunked_tap_query
+    chunks = list(iter_chunked_tap_query(eph, radius=radius, max_days=max_days, max_vertices=max_vertices,
+                                         mission=mission, service=service, verbose=verbose, columns=columns,
+                                         cache=cache, max_concurrent=max_concurrent))
+    return _merge_segments(chunks, None)
+
+
+def _merge_segments(tables, maxrec):
+    # Results of the segments of a path, de-duplicated on obsID and sorted by time,
+    # with the columns of run_tap_query whatever the number of segments
+    tables = [t for t in tables if len(t) > 0]
+    if len(tables) == 0:
+        return Table()
+
+    t = unique(vstack(tables, metadata_conflicts='silent'), keys='obsID')
+    t.sort('t_min')
+    return add_time_columns(t[:maxrec])
+
+
+def iter_chunked_tap_query(eph, radius=0.0083, max_days=5., max_vertices=200, mission=None, service=DEFAULT_SERVICE,
+                           page_size=1000, max_records=None, verbose=False, columns=None, progress=None, cache=True,
+                           max_concurrent=4):
+    """
+    Stream the results of a search along a path with one search per time segment (see run_chunked_tap_query),
+    in pages of results (see iter_tap_query). Up to max_concurrent segments are queried at the same time and
+    pages are yielded as they arrive. Observations already returned for another segment are skipped.
+
+    Parameters
+    ----------
+    eph : astropy Table
+        Ephemerides of the target
+    radius : float
+        Width of the path in degrees
+    max_days : float
+        Maximum duration of each segment in days (Default: 5)
+    max_vertices : int
+        Vertex budget of each segment polygon, see convert_path_to_polygon (Default: 200)
+    mission : str
+        Mission to search for (eg, HST, TESS, etc). (Default: None)
+    service : str
+        Service to use (Default: STScI CAOMTAP)
+    page_size : int
+        Number of records per page (Default: 1000)
+    max_records : int
+        Maximum number of records in total (Default: None, all of them)
+    verbose : bool
+        Flag to control verbosity of output messages. (Default: False)
+    columns : list
+        Columns to return, eg VERIFY_COLUMNS (Default: None, all columns)
+    progress : callable
+        Called as progress(done, total, n_records) at the start, after each page and as segments complete,
+        with the number of segments done and in total (Default: None)
+    cache : bool or TapResultCache
+        Cache to use for the results of each segment, see iter_tap_query (Default: True)
+    max_concurrent : int
+        Maximum number of segments queried at the same time (Default: 4)
+
+    Yields
+    ------
+    results : astropy Table
+        Astropy Table with each page of new results
+    """
+
+    searches = []
+    for segment in split_path(eph, max_days=max_days):
+        searches.append({'stcs': convert_path_to_polygon(segment, radius=radius, max_vertices=max_vertices,
+                                                         verbose=verbose),
+                         'start_time': min(segment['datetime_jd']) - 2400000.5,
+                         'end_time': max(segment['datetime_jd']) - 2400000.5})
+
+    # Segment workers put (page, error) items in a bounded queue, None when their segment is complete
+    pages = queue.Queue(maxsize=2 * max_concurrent)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run_segment(search):
+        if stop.is_set():
+            return
+        stream = iter_tap_query(mission=mission, service=service, page_size=page_size, verbose=verbose,
+                                columns=columns, cache=cache, **search)
+        try:
+            for page in stream:
+                if not put((page, None)):
+                    return
+        except Exception as e:
+            put((None, e))
+            return
+        finally:
+            stream.close()  # an abandoned stream lets identical searches try again
+        put((None, None))
+
+    seen = set()
+    n_records = 0
+    done = 0
+    if progress is not None:
+        progress(done, len(searches), n_records)
+    pool = ThreadPoolExecutor(max_workers=max_concurrent)
+    try:
+        for search in searches:
+            pool.submit(run_segment, search)
+        while done < len(searches):
+            t, error = pages.get()
+            if error is not None:
+                raise error
+            if t is None:
+                done += 1
+                if progress is not None:
+                    progress(done, len(searches), n_records)
+                continue
+            obs = np.asarray(t['obsID']).astype(str)
+            new = np.array([x not in seen for x in obs], dtype=bool)
+            t = t[new]
+            if max_records is not None:
+                t = t[:max_records - n_records]
+            if len(t) == 0:
+                continue
+            seen.update(np.asarray(t['obsID']).astype(str))
+            n_records += len(t)
+            if progress is not None:
+                progress(done, len(searches), n_records)
+            yield t
+            if max_records is not None and n_records >= max_records:
+                return
+    finally:
+        # Stop the segments still running (eg, enough records, or the stream was closed by the caller)
+        stop.set()
+        pool.shutdown(wait=False)
+
+
+def fetch_columns(t, columns=None, service=DEFAULT_SERVICE, batch_size=500, max_concurrent=4, timeout=600,
+                  verbose=False):
+    """
+    Fetch more columns for the rows of a table, eg for the results of a query with VERIFY_COLUMNS
+    that remain after clean_up_results. Rows are matched on obsID, in batches of concurrent queries.
+    Inside a running event loop (eg, Jupyter), await fetch_columns_async instead.
+
+    Parameters
+    ----------
+    t : astropy Table
+        Results with an obsID column
+    columns : list
+        Columns to add (Default: None, all columns)
+    service : str
+        Service to use (Default: STScI CAOMTAP)
+    batch_size : int
+        Number of obsID values per query (Default: 500)
+    max_concurrent : int
+        Maximum number of queries running at the same time (Default: 4)
+    timeout : float
+        Timeout for each query in seconds (Default: 600)
+    verbose : bool
+        Flag to control verbosity of output messages. (Default: False)
+
+    Returns
+    -------
+    t : astropy Table
+        Copy of the table with the additional columns, in the same row order
+    """
+
+    return run_coroutine(fetch_columns_async(t, columns=columns, service=service, batch_size=batch_size,
+                                             max_concurrent=max_concurrent, timeout=timeout, verbose=verbose))
+
+
+async def fetch_columns_async(t, columns=None, service=DEFAULT_SERVICE, batch_size=500, max_concurrent=4, timeout=600,
+                              verbose=False):
+    """
+    Coroutine fetching more columns for the rows of a table, see fetch_columns.
+    Use it with await from code already running an event loop (eg, Jupyter or Panel callbacks).
+    """
+
+    if t is None or len(t) == 0:
+        return t
+    if columns is not None:
+        columns = [c for c in columns if c not in t.colnames and c not in DERIVED_COLUMNS]
+        if len(columns) == 0:
+            return t
+    select = '*' if columns is None else ', '.join(['obsID'] + columns)
+
+    ids = np.unique(np.asarray(t['obsID']))
+    queries = [f"SELECT {select} FROM dbo.ObsPointing "
+               f"WHERE obsID IN ({', '.join([_adql_literal(x) for x in ids[i:i + batch_size]])})"
+               for i in range(0, len(ids), batch_size)]
+    if verbose:
+        for query in queries:
+            print(query)
+
+    print('Fetching more columns from MAST...')
+    session = CountingSession()
+    client = AsyncTapClient(service, max_concurrent=max_concurrent, timeout=timeout, session=session)
+    with span('fetch_columns', service=service, jobs=len(queries)) as stage:
+        tables = [x for x in await client.gather(queries, maxrec=batch_size) if len(x) > 0]
+        stage.set(rows=sum(len(x) for x in tables), bytes=session.received())
+    t = t.copy()
+    if len(tables) == 0:
+        return t
+    extra = vstack(tables, metadata_conflicts='silent')
+    _decode_columns(extra)
+
+    # Match the rows on obsID
+    extra_ids = np.asarray(extra['obsID']).astype(str)
+    order = np.argsort(extra_ids)
+    position = np.clip(np.searchsorted(extra_ids[order], np.asarray(t['obsID']).astype(str)), 0, len(extra) - 1)
+    match = order[position]
+    found = extra_ids[match] == np.asarray(t['obsID']).astype(str)
+    for col in extra.colnames:
+        if col in t.colnames:
+            continue
+        values = extra[col][match]
+        if not np.all(found):
+            values = MaskedColumn(values, mask=~found)
+        t[col] = values
+    return t
+
+
+def _to_float(col):
+    # Column values as a float array, with masked values as NaN
+    return np.ma.filled(np.ma.asarray(col, dtype=float), np.nan)
 
 
 def clean_up_results(t_init, obj_name, orig_eph=None, id_type='smallbody', location=None, radius=0.0083,
-                     aggressive_check=False):
+                     aggressive_check=False, engine=None, swept=False, min_fraction=0.):
     """
     Function to clean up results. Will check if the target is inside the observation footprint.
     If a radius is provided, will also construct a circle and check if the observation center is in the target circle.
     TODO: This is a buggy for several reasons:
           1- regions doesn't have intersection of polygons yet so valid observations are missed
           2- the mid point for observations like TESS can be days away from the target location
-          3- the _detail_check function is effectively re-adding most of what it clears
+          3- without aggressive_check, the detailed check ignores times and re-adds most of what it clears
+    With swept=True, the path of the target during each exposure is intersected with the footprint instead
+    (see swept_check), which has none of these issues.
 
     Parameters
     ----------
@@ -160,7 +867,20 @@ def clean_up_results(t_init, obj_name, orig_eph=None, id_type='smallbody', locat
         Size of target for intersection calculations
 
     aggressive_check: bool
-        Perform additional time checks; can remove valid observations (Default: False)
+        Only match the ephemerides path between each observation's start and end times (Default: False)
+
+    engine: HorizonsEngine or KeplerEngine
+        Ephemeris engine to use for the target positions, see get_path. (Default: None, JPL Horizons)
+
+    swept: bool
+        Intersect the path of the target during each exposure with the footprint grown by radius, and add
+        the fraction of the exposure time in the footprint as a footprint_fraction column (Default: False).
+        orig_eph is used when it covers all the exposures (best from adaptive_path), otherwise the path over
+        the exposures is fetched with adaptive_path.
+
+    min_fraction: float
+        With swept, keep the observations with more than this fraction of their exposure in the footprint
+        (Default: 0, any overlap)
 
     Returns
     -------
@@ -171,13 +891,27 @@ def clean_up_results(t_init, obj_name, orig_eph=None, id_type='smallbody', locat
     if len(t_init) == 0:
         return None
 
+    with span('clean_up_results', obj_name=str(obj_name)) as stage:
+        if swept:
+            t = _swept_results(t_init, obj_name, orig_eph=orig_eph, id_type=id_type, location=location,
+                               radius=radius, min_fraction=min_fraction, engine=engine)
+        else:
+            t = _clean_up_results(t_init, obj_name, orig_eph=orig_eph, id_type=id_type, location=location,
+                                  radius=radius, aggressive_check=aggressive_check, engine=engine)
+        stage.set(rows=len(t_init), verified=len(t))
+    # ISO dates only for the verified rows
+    return add_time_columns(t)
+
+
+def _clean_up_results(t_init, obj_name, orig_eph, id_type, location, radius, aggressive_check, engine):
+    # Footprint verification of clean_up_results
     if radius is not None and not isinstance(radius, float):
         radius = float(radius)
 
     t = t_init.copy()
 
-    # Sort by mid point time
-    t['t_mid'] = (t['t_max'] + t['t_min']) / 2 + 2400000.5
+    # Sort by mid point time (derived by process_results, or now for tables from elsewhere)
+    add_time_columns(t, dates=False)
     t.sort('t_mid')
 
     # Ephemerides results are sorted by time, hence the initial sort
@@ -190,37 +924,39 @@ def clean_up_results(t_init, obj_name, orig_eph=None, id_type='smallbody', locat
         ind = t['t_mid'] > threshold
         t = t[ind]
 
-    eph = Horizons(id=obj_name, location=location, id_type=id_type, epochs=t['t_mid']).ephemerides()
+    eph = get_path(obj_name, times=list(t['t_mid']), id_type=id_type, location=location, engine=engine)
 
-    # For each row in table, check s_region versus target position at mid-time
-    check_list = []
-    for i, row in enumerate(t):
-        # print(row['t_mid'], eph['datetime_jd'][i], eph['RA'][i], eph['DEC'][i])
+    # Check s_region versus target position at mid-time for all rows at once
+    with span('parse_regions', rows=len(t)):
+        packed = get_packed_regions(t['s_region'])
+    s_ra = _to_float(t['s_ra'])
+    s_dec = _to_float(t['s_dec'])
+    with span('check_pairs') as stage:
+        check_list = check_pairs(packed, np.arange(len(t)), _to_float(eph['RA']), _to_float(eph['DEC']),
+                                 s_ra, s_dec, radius=radius)
+        stage.set(matched=int(np.sum(check_list)))
 
-        # Create a polygon for the footprint and check if target is inside polygon
-        try:
-            stcs = parse_s_region(row['s_region'])
-            xs = stcs['ra']
-            ys = stcs['dec']
-            polygon_pix = PolygonPixelRegion(vertices=PixCoord(x=xs, y=ys))
-            target_coords = PixCoord(eph['RA'][i], eph['DEC'][i])
-            observation_coords = PixCoord(row['s_ra'], row['s_dec'])
-            if radius is None or radius < 0:
-                flag = target_coords in polygon_pix
+    # Check the remaining rows against the original ephemerides
+    if orig_eph is not None:
+        rows = np.where(~check_list & packed.valid)[0]
+        eph_ra = _to_float(orig_eph['RA'])
+        eph_dec = _to_float(orig_eph['DEC'])
+        eph_mjd = _to_float(orig_eph['datetime_jd']) - 2400000.5
+        with span('segment_check' if aggressive_check else 'detail_check', rows=len(rows)) as stage:
+            if aggressive_check:
+                # Only the path between each observation's start and end times, using a time/space index
+                index = FootprintIndex(packed, _to_float(t['t_min']), _to_float(t['t_max']), s_ra, s_dec)
+                check_list[rows] = segment_check(index, eph_ra, eph_dec, eph_mjd, s_ra, s_dec,
+                                                 rows=rows, radius=radius)
             else:
-                target_circle = CirclePixelRegion(center=target_coords, radius=radius)
-                flag = (target_coords in polygon_pix) or (observation_coords in target_circle)
-            if orig_eph is not None and not flag:
-                flag = _detail_check(orig_eph, polygon_pix, observation_coords,
-                                     start_date=row['t_min'], end_date=row['t_max'],
-                                     radius=radius, aggressive_check=aggressive_check)
-            # print(row['obs_id'], flag)
-        except Exception as e:
-            print(f"ERROR checking footprint for {row['obs_id']} with: {e}"
-                  f"\nAssuming False")
-            flag = False
+                # Every position in the ephemerides
+                check_list[rows] = detail_check(packed, eph_ra, eph_dec, eph_mjd, s_ra, s_dec,
+                                                _to_float(t['t_min']), _to_float(t['t_max']),
+                                                rows=rows, radius=radius)
+            stage.set(matched=int(np.sum(check_list[rows])))
 
-        check_list.append(flag)
+    for obs_id in t['obs_id'][~packed.valid]:
+        print(f"ERROR checking footprint for {obs_id}\nAssuming False")
 
     # Set the flags
     t['in_footprint'] = check_list
@@ -228,13 +964,79 @@ def clean_up_results(t_init, obj_name, orig_eph=None, id_type='smallbody', locat
     return t[t['in_footprint']]
 
 
-def get_files(t_init, obs_id=''):
+def _swept_results(t_init, obj_name, orig_eph, id_type, location, radius, min_fraction, engine):
+    # Footprint verification of clean_up_results over the whole exposures
+    if radius is not None and not isinstance(radius, float):
+        radius = float(radius)
+
     t = t_init.copy()
-    obs_list = obs_id.split(',')
-    obs_list = [x.strip() for x in obs_list]
-    mask = [x in obs_list for x in t['obs_id']]
-    t = t[mask]
-    data_products_by_id = Observations.get_product_list(t['obsID'].astype(str))
-    # data_products_by_id['Download'] = [f'<a href="https://mast.stsci.edu/portal/api/v0.1/Download/file?uri={x}">Download</a>'
-    #                                    for x in data_products_by_id['dataURI']]
-    return data_products_by_id
+    add_time_columns(t, dates=False)
+    t.sort('t_mid')
+    print('Verifying footprints over the exposures...')
+
+    # Fix for TESS
+    if location is not None and location.upper() == '@TESS':
+        print('Restriction for TESS observations')
+        threshold = 2456778.50000  # 2018-05-01
+        t = t[t['t_mid'] > threshold]
+
+    t_min = _to_float(t['t_min'])
+    t_max = _to_float(t['t_max'])
+    timed_rows = np.isfinite(t_min) & np.isfinite(t_max)
+    if not np.any(timed_rows):
+        t['footprint_fraction'] = np.zeros(len(t))
+        t['in_footprint'] = np.zeros(len(t), dtype=bool)
+        return t[:0]
+    first, last = np.min(t_min[timed_rows]), np.max(t_max[timed_rows])
+
+    # Path over all the exposures, from the search ephemerides when they cover them
+    eph = orig_eph
+    if eph is not None:
+        eph_mjd = _to_float(eph['datetime_jd']) - 2400000.5
+    if eph is None or len(eph) < 2 or eph_mjd[0] > first or eph_mjd[-1] < last:
+        # Whole minutes around the exposures
+        times = {'start': mjd_to_iso(first - 1. / 1440)[0][:16], 'stop': mjd_to_iso(last + 1. / 1440)[0][:16]}
+        eph = adaptive_path(obj_name, times, radius=radius if radius else 0.0083, id_type=id_type,
+                            location=location, engine=engine)
+        eph_mjd = _to_float(eph['datetime_jd']) - 2400000.5
+
+    with span('parse_regions', rows=len(t)):
+        packed = get_packed_regions(t['s_region'])
+    with span('swept_check', rows=len(t), samples=len(eph)) as stage:
+        index = FootprintIndex(packed, t_min, t_max)
+        fraction = swept_check(index, _to_float(eph['RA']), _to_float(eph['DEC']), eph_mjd, radius=radius)
+        stage.set(matched=int(np.sum(fraction > min_fraction)))
+
+    for obs_id in t['obs_id'][~packed.valid]:
+        print(f"ERROR checking footprint for {obs_id}\nAssuming False")
+
+    t['footprint_fraction'] = fraction
+    t['in_footprint'] = fraction > min_fraction
+
+    return t[t['in_footprint']]
+
+
+def get_files(t_init, obs_id='', **kwargs):
+    """
+    Product lists of the selected observations of a results table.
+
+    Parameters
+    ----------
+    t_init : astropy Table
+        MAST results with obs_id and obsID columns
+    obs_id : str
+        Comma-separated obs_id values of the observations to get the products of
+    kwargs
+        Additional arguments for get_product_lists (eg, chunk_size, max_workers, cache)
+
+    Returns
+    -------
+    products : astropy Table
+    """
+
+    obs_list = [x.strip() for x in obs_id.split(',')]
+    mask = np.isin(np.char.strip(np.asarray(t_init['obs_id']).astype(str)), obs_list)
+    with span('get_files', observations=int(np.sum(mask))) as stage:
+        products = get_product_lists(np.asarray(t_init['obsID'])[mask].astype(str), **kwargs)
+        stage.set(rows=len(products))
+    return products
@@ -0,0 +1,437 @@
+# Functions to handle instrumentation of the search stages: timers, counters and pluggable sinks
+
+import os
+import time
+import logging
+import threading
+import itertools
+import functools
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+
+METRICS_ENV = 'MOVINGMAST_METRICS'
+METRICS_PORT_ENV = 'MOVINGMAST_METRICS_PORT'
+TOTALS = ('rows', 'bytes')  # numeric span attributes also summed into counters for each stage
+
+_ids = itertools.count(1)
+
+
+class Span:
+    """
+    A timed stage of a search, eg a TAP query or the footprint verification.
+
+    Attributes
+    ----------
+    name : str
+        Stage name
+    attributes : dict
+        Details of the stage (eg, rows, bytes, service), set when the span is opened or with set()
+    parent : Span
+        Span of the enclosing stage in the same thread, None for a top-level stage
+    start_time : float
+        Start as a Unix timestamp
+    duration : float
+        Duration in seconds, None while the stage is running
+    error : str
+        Exception that ended the stage, None if it succeeded
+    context : dict
+        State kept by the sinks for the span (eg, the OpenTelemetry span)
+    """
+
+    def __init__(self, name, attributes=None, parent=None):
+        self.id = next(_ids)
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.parent = parent
+        self.start_time = time.time()
+        self.duration = None
+        self.error = None
+        self.context = {}
+        self._start = time.perf_counter()
+
+    def __repr__(self):
+        return f'<Span {self.name} {self.duration} s {self.attributes}>'
+
+    @property
+    def status(self):
+        return 'ok' if self.error is None else 'error'
+
+    def set(self, **attributes):
+        """
+        Add or update attributes of the span.
+        """
+
+        self.attributes.update(attributes)
+
+
+class Sink:
+    """
+    Receiver of the spans and counters of a Metrics registry. Subclasses override the methods they need.
+    """
+
+    def start(self, span):
+        pass
+
+    def end(self, span):
+        pass
+
+    def count(self, name, value, labels):
+        pass
+
+
+class LoggingSink(Sink):
+    """
+    Log the duration and attributes of every stage.
+
+    Parameters
+    ----------
+    logger : str or logging.Logger
+        Logger to use (Default: movingmast)
+    level : int
+        Logging level of the messages (Default: logging.INFO)
+    """
+
+    def __init__(self, logger='movingmast', level=logging.INFO):
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.level = level
+
+    def end(self, span):
+        details = ', '.join(f'{k}={v}' for k, v in span.attributes.items())
+        error = f' failed with {span.error}' if span.error is not None else ''
+        self.logger.log(self.level, f'{span.name} took {span.duration:.3f} s{error}' +
+                        (f' ({details})' if details else ''))
+
+
+def _otel_value(value):
+    # OpenTelemetry attributes are bool, int, float or str
+    return value if isinstance(value, (bool, int, float, str)) else str(value)
+
+
+class OpenTelemetrySink(Sink):
+    """
+    Export the stages as OpenTelemetry spans, nested like the stages.
+    The exporter (eg, OTLP to a collector) is configured with the OpenTelemetry SDK as usual.
+
+    Parameters
+    ----------
+    tracer : opentelemetry.trace.Tracer
+        Tracer to use (Default: None, the tracer named movingmast of the global tracer provider).
+        Requires the opentelemetry-api package.
+    """
+
+    def __init__(self, tracer=None):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise ImportError('OpenTelemetrySink requires the opentelemetry-api package '
+                              '(pip install opentelemetry-api)')
+        self._trace = trace
+        self.tracer = trace.get_tracer('movingmast') if tracer is None else tracer
+
+    def start(self, span):
+        context = None
+        if span.parent is not None and 'otel' in span.parent.context:
+            context = self._trace.set_span_in_context(span.parent.context['otel'])
+        span.context['otel'] = self.tracer.start_span(
+            span.name, context=context, start_time=int(span.start_time * 1e9),
+            attributes={k: _otel_value(v) for k, v in span.attributes.items()})
+
+    def end(self, span):
+        otel = span.context.pop('otel', None)
+        if otel is None:
+            return
+        otel.set_attributes({k: _otel_value(v) for k, v in span.attributes.items()})
+        if span.error is not None:
+            otel.set_status(self._trace.Status(self._trace.StatusCode.ERROR, span.error))
+        otel.end(end_time=int((span.start_time + span.duration) * 1e9))
+
+
+class CountingSession(requests.Session):
+    """
+    HTTP session counting the bytes received, eg for the pyvo TAP services (TAPService(url, session=...)).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._responses = []
+        self.hooks['response'].append(lambda response, *args, **kwargs: self._responses.append(response))
+
+    def received(self):
+        """
+        Bytes received (before decompression) since the previous call.
+        """
+
+        responses, self._responses = self._responses, []
+        return sum(int(response.raw.tell()) for response in responses if hasattr(response.raw, 'tell'))
+
+
+def _labels(labels):
+    # Prometheus label set, eg {stage="run_tap_query",status="ok"}
+    if len(labels) == 0:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+class Metrics:
+    """
+    Registry of the stage timers and counters of a process, forwarding them to pluggable sinks.
+
+    Stages are timed with span(), which can be nested: a stage opened while another one runs in the same
+    thread is recorded as its child. Whatever the sinks, the registry keeps the number of runs, total and
+    maximum duration of every stage and the value of every counter, available with snapshot() or in the
+    Prometheus text format with prometheus_text().
+
+    Parameters
+    ----------
+    sinks : list
+        Sinks receiving the spans and counters, eg LoggingSink or OpenTelemetrySink (Default: None)
+    """
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+        self._counters = {}  # (name, labels) -> value
+        self._stages = {}  # (name, status) -> [count, total seconds, max seconds]
+        self._lock = threading.Lock()
+        self._current = contextvars.ContextVar('movingmast_span', default=None)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def remove_sink(self, sink):
+        if sink in self.sinks:
+            self.sinks.remove(sink)
+
+    def _notify(self, method, *args):
+        # A failing sink must not break the search
+        for sink in list(self.sinks):
+            try:
+                getattr(sink, method)(*args)
+            except Exception as e:
+                print(f'WARNING: Metrics sink {type(sink).__name__} failed: {e}')
+
+    def count(self, name, value=1, **labels):
+        """
+        Add value to a counter, eg count('cache_requests', cache='tap', result='hit').
+        """
+
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+        self._notify('count', name, value, dict(labels))
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Time a stage. The span is yielded so attributes found while it runs can be added with set().
+        Numeric rows and bytes attributes are also added to the rows and bytes counters of the stage.
+
+        Example
+        -------
+        with metrics.span('run_tap_query', service=service) as stage:
+            t = ...
+            stage.set(rows=len(t))
+        """
+
+        span = Span(name, attributes, parent=self._current.get())
+        self._notify('start', span)
+        token = self._current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            self._current.reset(token)
+            span.duration = time.perf_counter() - span._start
+            with self._lock:
+                stats = self._stages.setdefault((name, span.status), [0, 0., 0.])
+                stats[0] += 1
+                stats[1] += span.duration
+                stats[2] = max(stats[2], span.duration)
+            for total in TOTALS:
+                value = span.attributes.get(total)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.count(total, value, stage=name)
+            self._notify('end', span)
+
+    def current(self):
+        """
+        Span of the stage running in this thread, None outside of any stage.
+        """
+
+        return self._current.get()
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._stages.clear()
+
+    def snapshot(self):
+        """
+        Current values of the timers and counters.
+
+        Returns
+        -------
+        snapshot : dict
+            stages: {name: {count, errors, seconds, max_seconds}},
+            counters: {(name, labels): value} and
+            cache_hit_rates: {cache: fraction of the lookups served by the cache}
+        """
+
+        with self._lock:
+            counters = dict(self._counters)
+            stages = {}
+            for (name, status), (n, total, longest) in self._stages.items():
+                stage = stages.setdefault(name, {'count': 0, 'errors': 0, 'seconds': 0., 'max_seconds': 0.})
+                stage['count'] += n
+                stage['errors'] += n if status == 'error' else 0
+                stage['seconds'] += total
+                stage['max_seconds'] = max(stage['max_seconds'], longest)
+
+        lookups = {}
+        for (name, labels), value in counters.items():
+            if name == 'cache_requests':
+                labels = dict(labels)
+                hits, total = lookups.get(labels['cache'], (0, 0))
+                lookups[labels['cache']] = (hits + (value if labels['result'] == 'hit' else 0), total + value)
+        rates = {cache: hits / total for cache, (hits, total) in lookups.items() if total > 0}
+        return {'stages': stages, 'counters': counters, 'cache_hit_rates': rates}
+
+    def prometheus_text(self, prefix='movingmast'):
+        """
+        Timers and counters in the Prometheus text exposition format.
+
+        Stages are exported as the summary <prefix>_stage_seconds (with _count and _sum) and the gauge
+        <prefix>_stage_seconds_max, labelled by stage and status; counters as <prefix>_<name>_total.
+        """
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            stages = sorted(self._stages.items())
+
+        lines = [f'# HELP {prefix}_stage_seconds Duration of the search stages',
+                 f'# TYPE {prefix}_stage_seconds summary']
+        for (name, status), (n, total, _) in stages:
+            labels = _labels([('stage', name), ('status', status)])
+            lines.append(f'{prefix}_stage_seconds_count{labels} {n}')
+            lines.append(f'{prefix}_stage_seconds_sum{labels} {total:.6f}')
+        lines.append(f'# TYPE {prefix}_stage_seconds_max gauge')
+        for (name, status), (_, _, longest) in stages:
+            lines.append(f"{prefix}_stage_seconds_max{_labels([('stage', name), ('status', status)])} {longest:.6f}")
+
+        declared = set()
+        for (name, labels), value in counters:
+            metric = f'{prefix}_{name}_total'
+            if metric not in declared:
+                lines.append(f'# TYPE {metric} counter')
+                declared.add(metric)
+            lines.append(f'{metric}{_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def serve_prometheus(port=9464, host='', metrics=None):
+    """
+    Serve the Prometheus text format of a Metrics registry at http://host:port/metrics from a background thread.
+
+    Parameters
+    ----------
+    port : int
+        Port to listen on, 0 for any free port (Default: 9464)
+    host : str
+        Address to listen on (Default: '', all interfaces)
+    metrics : Metrics
+        Registry to export (Default: None, the process-wide registry of get_metrics)
+
+    Returns
+    -------
+    server : ThreadingHTTPServer
+        Running server, stopped with server.shutdown()
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = (metrics or get_metrics()).prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='movingmast-metrics').start()
+    return server
+
+
+_default_metrics = None
+_default_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    Process-wide Metrics registry.
+
+    Sinks can be enabled with the MOVINGMAST_METRICS environment variable, a comma-separated list of
+    log (LoggingSink) and otel (OpenTelemetrySink), and the Prometheus endpoint with MOVINGMAST_METRICS_PORT.
+    """
+
+    global _default_metrics
+    with _default_lock:
+        if _default_metrics is None:
+            _default_metrics = Metrics()
+            names = [x.strip().lower() for x in os.environ.get(METRICS_ENV, '').split(',') if x.strip()]
+            if 'log' in names:
+                _default_metrics.add_sink(LoggingSink())
+            if 'otel' in names:
+                _default_metrics.add_sink(OpenTelemetrySink())
+            if os.environ.get(METRICS_PORT_ENV):
+                try:
+                    serve_prometheus(int(os.environ[METRICS_PORT_ENV]), metrics=_default_metrics)
+                except (ValueError, OSError) as e:
+                    print(f'WARNING: Unable to serve the metrics on port {os.environ[METRICS_PORT_ENV]}: {e}')
+        return _default_metrics
+
+
+def span(name, **attributes):
+    """
+    Time a stage with the process-wide registry, see Metrics.span.
+    """
+
+    return get_metrics().span(name, **attributes)
+
+
+def count(name, value=1, **labels):
+    """
+    Add to a counter of the process-wide registry, see Metrics.count.
+    """
+
+    get_metrics().count(name, value, **labels)
+
+
+def timed(name=None):
+    """
+    Decorator timing every call of a function as a stage of the process-wide registry.
+
+    Parameters
+    ----------
+    name : str
+        Stage name (Default: None, the function name)
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
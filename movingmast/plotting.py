@@ -1,16 +1,26 @@
 # Functions to handle plotting
 
-from .polygon import parse_s_region
+from .polygon import parse_s_region, get_packed_regions
+from .mast_tap import add_time_columns
+from .metrics import span, timed
+import numpy as np
 from bokeh.plotting import figure, output_file, show, output_notebook
 from bokeh.layouts import column
-from bokeh.models import Arrow, VeeHead, HoverTool, Slider, ColumnDataSource
-from bokeh.palettes import Spectral7 as palette
+from bokeh.models import Arrow, VeeHead, HoverTool, Slider, ColumnDataSource, LinearColorMapper, Range1d
+from bokeh.palettes import Spectral7 as palette, Viridis256
 import matplotlib.pyplot as plt
+import pandas as pd
+try:
+    from bokeh.events import RangesUpdate
+except ImportError:  # Bokeh < 2.4, ranges are watched directly
+    RangesUpdate = None
 
 
+@timed()
 def polygon_bokeh(stcs, display=True):
-    patch_xs = parse_s_region(stcs)['ra']
-    patch_ys = parse_s_region(stcs)['dec']
+    coords = parse_s_region(stcs)
+    patch_xs = coords['ra']
+    patch_ys = coords['dec']
 
     p = figure(plot_width=700, x_axis_label="RA (deg)", y_axis_label="Dec (deg)")
 
@@ -31,8 +41,9 @@ def polygon_bokeh(stcs, display=True):
     
 
 def quick_bokeh(stcs, outfile='test.html'):
-    patch_xs = parse_s_region(stcs)['ra']
-    patch_ys = parse_s_region(stcs)['dec']
+    coords = parse_s_region(stcs)
+    patch_xs = coords['ra']
+    patch_ys = coords['dec']
 
     p = figure(plot_width=700)
 
@@ -46,8 +57,9 @@ def quick_bokeh(stcs, outfile='test.html'):
 
 
 def quick_plot(stcs):
-    patch_xs = parse_s_region(stcs)['ra']
-    patch_ys = parse_s_region(stcs)['dec']
+    coords = parse_s_region(stcs)
+    patch_xs = coords['ra']
+    patch_ys = coords['dec']
 
     f, ax = plt.subplots(figsize=(8, 4))
     ax.scatter(patch_xs, patch_ys, edgecolors="black", marker='.', linestyle='None', s=50,
@@ -57,39 +69,220 @@ def quick_plot(stcs):
     plt.show()
 
 
-def _individual_plot_data(df):
-    # Generate individual patch information for each POLYGON of an observation, currently only for Kepler and K2
-
-    plot_data = []
-    for i, row in df.iterrows():
-        stcs_list = [f'POLYGON {s.strip()}' for s in row['s_region'].split('POLYGON') if s != '']
-        for stcs in stcs_list:
-            if 'CIRCLE' in stcs:
-                # Sometimes circles are in the data and get strings with 'POLYGON CIRCLE'
-                stcs = stcs.replace('POLYGON ', '')
-
-            # Add patches with the observation footprings
-            coords = parse_s_region(stcs)
-            patch_xs = [coords['ra']]
-            patch_ys = [coords['dec']]
-
-            data = ColumnDataSource({'x': patch_xs, 'y': patch_ys,
-                                     'obs_collection': [row['obs_collection']],
-                                     'instrument_name': [row['instrument_name']],
-                                     'obs_id': [row['obs_id']],
-                                     'target_name': [row['target_name']],
-                                     'proposal_pi': [row['proposal_pi']],
-                                     'obs_mid_date': [row['obs_mid_date']],
-                                     'filters': [row['filters']]})
-            plot_data.append(data)
-
-    return plot_data
-
+MAX_FOOTPRINTS = 2000  # visible footprints drawn as patches, a density image is shown above this
+DENSITY_BINS = 200  # density image resolution
+TOOLTIP_COLUMNS = ('obs_collection', 'instrument_name', 'obs_id', 'target_name', 'proposal_pi', 'obs_mid_date',
+                   'filters')
+
+
+def _individual_plot_data(df, packed):
+    # Generate multi-polygon information for each observation, with one polygon per ring (POLYGON or CIRCLE)
+    # for observations with several rings (eg, Kepler and K2)
+
+    ring_rows = packed.ring_rows()
+    patch_xs, patch_ys = packed.ring_coordinates()
+    xs = [[] for _ in range(len(packed))]
+    ys = [[] for _ in range(len(packed))]
+    for row, x, y in zip(ring_rows, patch_xs, patch_ys):
+        xs[row].append([x.tolist()])
+        ys[row].append([y.tolist()])
+    data = {'x': xs, 'y': ys}
+    for col in TOOLTIP_COLUMNS:
+        data[col] = np.asarray(df[col])
+    return data
+
+
+class FootprintLayers:
+    """
+    Level-of-detail rendering of MAST footprints in a Bokeh figure.
+
+    The footprints of each mission are packed in a single multi-polygon data source (one entry per observation),
+    holding only the observations within the visible ranges with their vertices decimated to the plot resolution.
+    When more than max_footprints observations are visible, a density image of their centers is shown instead.
+    Sources are refreshed when the ranges change in a Bokeh server (eg, Panel); static plots keep the initial view.
+
+    Parameters
+    ----------
+    p : bokeh figure
+        Figure to draw on, with Range1d ranges
+    df : pandas DataFrame
+        Observations, with the tooltip columns
+    packed : PackedRegions
+        Observation footprints
+    max_footprints : int
+        Maximum number of visible footprints drawn as patches (Default: MAX_FOOTPRINTS)
+    bins : int
+        Number of bins of the density image along each axis (Default: DENSITY_BINS)
+    pixels : float
+        Decimation tolerance in screen pixels (Default: 1)
+    refresh : bool
+        Refresh the sources when the ranges change. Needs a Bokeh server or Panel. (Default: True)
+    """
+
+    def __init__(self, p, df, packed, max_footprints=MAX_FOOTPRINTS, bins=DENSITY_BINS, pixels=1., refresh=True):
+        self.p = p
+        self.max_footprints = max_footprints
+        self.bins = bins
+        self.pixels = pixels
+        self._view = None
+        self._n_visible = 0
+
+        # Observations that can be drawn, with their centers for the density image
+        usable = packed.valid & (packed.counts > 0)
+        self.boxes = packed.boxes
+        self.centers = np.column_stack([(self.boxes[:, 0] + self.boxes[:, 1]) / 2,
+                                        (self.boxes[:, 2] + self.boxes[:, 3]) / 2])
+        self.usable = usable
+
+        # One multi-polygon source per mission, coloring each separately
+        self.missions = []
+        self.renderers = []
+        collections = np.asarray(df['obs_collection'])
+        for mission, color in zip(pd.unique(collections[usable]), palette):
+            rows = np.where(usable & (collections == mission))[0]
+            source = ColumnDataSource(_individual_plot_data(df.iloc[rows[:0]], packed.take(rows[:0])))
+            renderer = p.multi_polygons('x', 'y', source=source, legend=mission, fill_color=color, fill_alpha=0.3,
+                                        line_color="white", line_width=0.5)
+            self.missions.append((rows, df.iloc[rows], packed.take(rows), source))
+            self.renderers.append(renderer)
+
+        # Density image of the footprint centers, transparent where empty
+        self.mapper = LinearColorMapper(palette=Viridis256, low=1, high=2, low_color=(0, 0, 0, 0))
+        self.density = ColumnDataSource({'image': [], 'x': [], 'y': [], 'dw': [], 'dh': []})
+        self.image = p.image(image='image', x='x', y='y', dw='dw', dh='dh', source=self.density,
+                             color_mapper=self.mapper, global_alpha=0.6, legend='Footprint density')
+
+        if not refresh:
+            return
+        if RangesUpdate is not None:
+            p.on_event(RangesUpdate, lambda event: self.refresh())
+        else:
+            for r in (p.x_range, p.y_range):
+                r.on_change('start', lambda attr, old, new: self.refresh())
+                r.on_change('end', lambda attr, old, new: self.refresh())
+
+    @property
+    def width(self):
+        width = self.p.plot_width if hasattr(self.p, 'plot_width') else self.p.width
+        return width or 700
+
+    def refresh(self):
+        """
+        Update the data sources for the current ranges of the figure.
+        """
+
+        self.update(self.p.x_range.start, self.p.x_range.end, self.p.y_range.start, self.p.y_range.end)
+
+    def update(self, x_start, x_end, y_start, y_end):
+        """
+        Update the data sources for a view.
+
+        Parameters
+        ----------
+        x_start, x_end, y_start, y_end : float
+            RA and Dec ranges of the view in degrees, in any order
+
+        Returns
+        -------
+        n_visible : int
+            Number of observations in the view
+        """
+
+        x0, x1 = sorted((x_start, x_end))
+        y0, y1 = sorted((y_start, y_end))
+        view = (x0, x1, y0, y1)
+        if view == self._view:
+            return self._n_visible
+        self._view = view
+
+        with span('footprint_layers') as stage:
+            self._update(x0, x1, y0, y1)
+            stage.set(visible=self._n_visible, density=self._n_visible > self.max_footprints)
+        return self._n_visible
+
+    def _update(self, x0, x1, y0, y1):
+        # Fill the sources for a view, see update
+        with np.errstate(invalid='ignore'):
+            visible = self.usable & (self.boxes[:, 1] >= x0) & (self.boxes[:, 0] <= x1) & \
+                (self.boxes[:, 3] >= y0) & (self.boxes[:, 2] <= y1)
+        self._n_visible = int(visible.sum())
+
+        if self._n_visible > self.max_footprints:
+            # Too many footprints to draw: counts of the centers, with RA decreasing to the right like the axis
+            centers = self.centers[visible]
+            counts, _, _ = np.histogram2d(centers[:, 1], centers[:, 0], bins=self.bins, range=[[y0, y1], [x0, x1]])
+            self.mapper.high = max(counts.max(), 2)
+            self.density.data = {'image': [counts[:, ::-1]], 'x': [x1], 'y': [y0], 'dw': [x1 - x0], 'dh': [y1 - y0]}
+            for rows, df, packed, source in self.missions:
+                source.data = _individual_plot_data(df.iloc[:0], packed.take(rows[:0]))
+            return
+
+        # Visible footprints, without the vertices closer than the size of a pixel
+        tolerance = self.pixels * max(x1 - x0, y1 - y0) / self.width
+        self.density.data = {'image': [], 'x': [], 'y': [], 'dw': [], 'dh': []}
+        for rows, df, packed, source in self.missions:
+            keep = np.where(visible[rows])[0]
+            source.data = _individual_plot_data(df.iloc[keep], packed.take(keep).decimated(tolerance))
+
+
+def _extent(ra, dec, padding=0.05):
+    # Padded view around the given coordinates, ignoring NaN
+    ra_min, ra_max = np.nanmin(ra), np.nanmax(ra)
+    dec_min, dec_max = np.nanmin(dec), np.nanmax(dec)
+    pad = padding * max(ra_max - ra_min, dec_max - dec_min, 0.01)
+    return ra_min - pad, ra_max + pad, dec_min - pad, dec_max + pad
+
+
+@timed()
+def mast_bokeh(eph, mast_results, stcs=None, display=False, max_footprints=MAX_FOOTPRINTS, refresh=None):
+    """
+    Bokeh plot of MAST results with the target path.
+
+    Footprints are rendered with FootprintLayers: only those in view are sent to the browser, decimated to
+    the plot resolution, and a density image replaces them when more than max_footprints are in view.
+
+    Parameters
+    ----------
+    eph : astropy Table
+        Ephemerides from get_path
+    mast_results : astropy Table
+        MAST results, with s_region and the tooltip columns
+    stcs : str
+        Search polygon (Default: None)
+    display : bool
+        Show the plot in the notebook instead of returning it (Default: False)
+    max_footprints : int
+        Maximum number of footprints in view drawn as patches (Default: MAX_FOOTPRINTS)
+    refresh : bool
+        Refresh the footprints when zooming or panning, for plots served with Bokeh or Panel
+        (Default: None, only when the plot is returned instead of displayed)
+
+    Returns
+    -------
+    final : bokeh layout
+    """
+
+    # Prepare MAST footprints, parsing all of them at once
+    if 'obs_mid_date' not in mast_results.colnames:
+        # Dates for the tooltips, not in place
+        mast_results = add_time_columns(mast_results.copy(copy_data=False))
+    obsDF = mast_results.to_pandas()
+    packed = get_packed_regions(mast_results['s_region'])
+    for col in mast_results.colnames:
+        if len(obsDF) > 0 and isinstance(obsDF[col][0], bytes):
+            obsDF[col] = obsDF[col].str.decode('utf-8')
 
-def mast_bokeh(eph, mast_results, stcs=None, display=False):
-    # Function to produce a Bokeh plot of MAST results with the target path
+    # Initial view including the path, the search area and the footprints, with RA flipped
+    coords = parse_s_region(stcs) if stcs is not None else None
+    ra = [np.asarray(eph['RA'], dtype=float), packed.boxes[:, 0], packed.boxes[:, 1]]
+    dec = [np.asarray(eph['DEC'], dtype=float), packed.boxes[:, 2], packed.boxes[:, 3]]
+    if coords is not None:
+        ra.append(np.asarray(coords['ra'], dtype=float))
+        dec.append(np.asarray(coords['dec'], dtype=float))
+    x0, x1, y0, y1 = _extent(np.concatenate(ra), np.concatenate(dec))
 
-    p = figure(plot_width=700, x_axis_label="RA (deg)", y_axis_label="Dec (deg)")
+    p = figure(plot_width=700, x_axis_label="RA (deg)", y_axis_label="Dec (deg)",
+               x_range=Range1d(x1, x0), y_range=Range1d(y0, y1))
 
     # Target path
     eph_data = {'eph_x': eph['RA'], 'eph_y': eph['DEC'], 'Date': eph['datetime_str']}
@@ -100,42 +293,15 @@ def mast_bokeh(eph, mast_results, stcs=None, display=False):
     p.add_tools(HoverTool(renderers=[eph_plot1, eph_plot2], tooltips=[('Date', "@Date")]))
 
     # Target footprint
-    patch_xs = parse_s_region(stcs)['ra']
-    patch_ys = parse_s_region(stcs)['dec']
-
-    stcs_data = {'stcs_x': [patch_xs], 'stcs_y': [patch_ys]}
-    p.patches('stcs_x', 'stcs_y', source=stcs_data, fill_alpha=0., line_color="grey", line_width=0.8,
-              line_dash='dashed', legend='Search Area')
+    if coords is not None:
+        stcs_data = {'stcs_x': [coords['ra']], 'stcs_y': [coords['dec']]}
+        p.patches('stcs_x', 'stcs_y', source=stcs_data, fill_alpha=0., line_color="grey", line_width=0.8,
+                  line_dash='dashed', legend='Search Area')
 
-    # Prepare MAST footprints
-    obsDF = mast_results.to_pandas()
-    obsDF['coords'] = obsDF.apply(lambda x: parse_s_region(x['s_region']), axis=1)
-    for col in mast_results.colnames:
-        if isinstance(obsDF[col][0], bytes):
-            obsDF[col] = obsDF[col].str.decode('utf-8')
-
-    # Loop over missions, coloring each separately
-    mast_plots = []
-    for mission, color in zip(obsDF['obs_collection'].unique(), palette):
-        ind = obsDF['obs_collection'] == mission
-
-        # Some missions have very complex STCS and need to be treated separately
-        if mission in ('Kepler', 'K2', 'K2FFI'):
-            plot_data = _individual_plot_data(obsDF[ind])
-            for data in plot_data:
-                mast_plots.append(p.patches('x', 'y', source=data, legend=mission,
-                                            fill_color=color, fill_alpha=0.3, line_color="white", line_width=0.5))
-        else:
-            # Add patches with the observation footprings
-            patch_xs = [c['ra'] for c in obsDF['coords'][ind]]
-            patch_ys = [c['dec'] for c in obsDF['coords'][ind]]
-
-            data = {'x': patch_xs, 'y': patch_ys, 'obs_collection': obsDF['obs_collection'][ind],
-                    'instrument_name': obsDF['instrument_name'][ind], 'obs_id': obsDF['obs_id'][ind],
-                    'target_name': obsDF['target_name'][ind], 'proposal_pi': obsDF['proposal_pi'][ind],
-                    'obs_mid_date': obsDF['obs_mid_date'][ind], 'filters': obsDF['filters'][ind]}
-            mast_plots.append(p.patches('x', 'y', source=data, legend=mission,
-                                        fill_color=color, fill_alpha=0.3, line_color="white", line_width=0.5))
+    # MAST footprints, one multi-polygon source per mission
+    refresh = not display if refresh is None else refresh
+    layers = FootprintLayers(p, obsDF, packed, max_footprints=max_footprints, refresh=refresh)
+    layers.update(x0, x1, y0, y1)
 
     # Add hover tooltip for MAST observations
     tooltip = [("obs_id", "@obs_id"),
@@ -143,16 +309,15 @@ def mast_bokeh(eph, mast_results, stcs=None, display=False):
                ("instrument_name", "@instrument_name"),
                ("filters", "@filters"),
                ('obs_mid_date', '@obs_mid_date')]
-    p.add_tools(HoverTool(renderers=mast_plots, tooltips=tooltip))
+    p.add_tools(HoverTool(renderers=layers.renderers, tooltips=tooltip))
 
     # Additional settings
     p.legend.click_policy = "hide"
-    p.x_range.flipped = True
 
     # Slider for alpha settings
     slider = Slider(start=0, end=1, step=0.01, value=0.3, title="Footprint opacity")
-    for i in range(len(mast_plots)):
-        slider.js_link('value', mast_plots[i].glyph, 'fill_alpha')
+    for renderer in layers.renderers:
+        slider.js_link('value', renderer.glyph, 'fill_alpha')
     final = column(p, slider)
 
     if display:
@@ -1,9 +1,91 @@
 # Functions to handle polygon conversions
 
+import re
+import hashlib
+import threading
 import numpy as np
+from collections import OrderedDict
+from functools import lru_cache
 import astropy.units as u
-from astropy.visualization.wcsaxes.patches import _rotate_polygon
-from astropy.coordinates import SkyCoord
+from .spherical import lonlat_to_xyz, signed_areas, bounding_caps
+
+
+_circle_cache = OrderedDict()
+_circle_lock = threading.Lock()
+MAX_CACHED_CIRCLES = 100000
+
+
+@lru_cache(maxsize=None)
+def _unit_ring(resolution):
+    # Cosine and sine of the azimuths of a ring with the given number of vertices
+    azimuth = np.linspace(0., 2 * np.pi, resolution + 1)[:-1]
+    return np.cos(azimuth), np.sin(azimuth)
+
+
+def _rotate_circles(center_ra, center_dec, radius, resolution):
+    # Draw the rings around the North pole and rotate them so the pole moves to the centers,
+    # as astropy's _rotate_polygon does, for all circles at once
+    cos_az, sin_az = _unit_ring(resolution)
+    ra0 = np.radians(center_ra)[:, np.newaxis]
+    colat = np.radians(90. - center_dec)[:, np.newaxis]
+    r = np.radians(radius)[:, np.newaxis]
+    x = np.sin(r) * cos_az
+    y = np.sin(r) * sin_az
+    z = np.cos(r) * np.ones_like(cos_az)
+    x, z = np.cos(colat) * x + np.sin(colat) * z, np.cos(colat) * z - np.sin(colat) * x
+    x, y = np.cos(ra0) * x - np.sin(ra0) * y, np.sin(ra0) * x + np.cos(ra0) * y
+    lon = np.degrees(np.arctan2(y, x)) % 360
+    lat = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    return lon, lat
+
+
+def convert_to_polygons(center_ra, center_dec, radius, resolution=16):
+    """
+    Convert many circles to polygons at once.
+    Results are cached, so repeated (ra, dec, radius, resolution) circles are only computed once.
+
+    Parameters
+    ----------
+    center_ra, center_dec, radius : numpy array
+        Circle centers and radii in degrees
+    resolution : int
+        Number of vertices of each polygon (Default: 16)
+
+    Returns
+    -------
+    lon, lat : numpy array
+        Polygon vertices in degrees with shape (N, resolution)
+    """
+
+    circles = np.column_stack([np.atleast_1d(center_ra), np.atleast_1d(center_dec),
+                               np.atleast_1d(radius)]).astype(float)
+    unique, inverse = np.unique(circles, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    lon = np.zeros((len(unique), resolution))
+    lat = np.zeros((len(unique), resolution))
+
+    # Cached circles first, then the rest in a single batch
+    missing = []
+    with _circle_lock:
+        for k, circle in enumerate(unique):
+            key = (*circle.tolist(), resolution)
+            if key in _circle_cache:
+                _circle_cache.move_to_end(key)
+                lon[k], lat[k] = _circle_cache[key]
+            else:
+                missing.append(k)
+
+    if len(missing) > 0:
+        missing = np.array(missing)
+        new_lon, new_lat = _rotate_circles(unique[missing, 0], unique[missing, 1], unique[missing, 2], resolution)
+        lon[missing], lat[missing] = new_lon, new_lat
+        with _circle_lock:
+            for k, a, b in zip(missing, new_lon, new_lat):
+                _circle_cache[(*unique[k].tolist(), resolution)] = (a, b)
+            while len(_circle_cache) > MAX_CACHED_CIRCLES:
+                _circle_cache.popitem(last=False)
+
+    return lon[inverse], lat[inverse]
 
 
 def convert_to_polygon(center_ra, center_dec, radius, resolution=16):
@@ -23,12 +105,9 @@ def convert_to_polygon(center_ra, center_dec, radius, resolution=16):
     lat
     """
 
-    lon = np.linspace(0., 2 * np.pi, resolution + 1)[:-1] * u.radian
-    lat = np.repeat(0.5 * np.pi - radius.to_value(u.radian), resolution) * u.radian
-    lon, lat = _rotate_polygon(lon, lat, center_ra, center_dec)
-    lon = lon.to_value(u.deg).tolist()
-    lat = lat.to_value(u.deg).tolist()
-    return lon, lat
+    lon, lat = convert_to_polygons(center_ra.to_value(u.deg), center_dec.to_value(u.deg), radius.to_value(u.deg),
+                                   resolution=resolution)
+    return lon[0].tolist(), lat[0].tolist()
 
 
 def parse_s_region(s_region):
@@ -73,79 +152,492 @@ def parse_s_region(s_region):
     return {'ra': ra, 'dec': dec}
 
 
-def _frame_convert(points):
-    # Helper function to transform points (ra/dec) to Galactic coordinates and avoid pole issues
-    c_icrs = SkyCoord(ra=points[:, 0], dec=points[:, 1], unit='deg', frame='icrs')
-    c_gal = c_icrs.galactic
+class PackedRegions:
+    """
+    Footprints of many S_REGION values packed in a single vertex array.
+    Each row (S_REGION value) has zero or more rings (POLYGON or CIRCLE), stored contiguously.
 
-    # Return Galactic l and b in the same format as points
-    return np.dstack((c_gal.l.value, c_gal.b.value))[0]
+    Attributes
+    ----------
+    vertices : numpy array
+        RA/Dec of all vertices with shape (N, 2)
+    ring_offsets : numpy array
+        Index of the first vertex of each ring, with a final entry for the total number of vertices
+    row_offsets : numpy array
+        Index of the first ring of each row, with a final entry for the total number of rings
+    valid : numpy array
+        Boolean flag for rows that could be parsed
+    """
 
+    def __init__(self, vertices, ring_offsets, row_offsets, valid):
+        self.vertices = vertices
+        self.ring_offsets = ring_offsets
+        self.row_offsets = row_offsets
+        self.valid = valid
+        self._xyz = None
+        self._caps = None
+        self._next = None
+        self._boxes = None
+
+    def __len__(self):
+        return len(self.valid)
+
+    @classmethod
+    def from_rings(cls, rings):
+        # Pack a list of (N, 2) RA/Dec arrays, one ring per row
+        rings = [np.asarray(ring, dtype=float).reshape(-1, 2) for ring in rings]
+        ring_offsets = np.concatenate([[0], np.cumsum([len(ring) for ring in rings])]).astype(int)
+        vertices = np.concatenate(rings) if len(rings) > 0 else np.zeros((0, 2))
+        return cls(vertices, ring_offsets, np.arange(len(rings) + 1), np.array([len(r) >= 3 for r in rings], dtype=bool))
+
+    @property
+    def offsets(self):
+        # Index of the first vertex of each row
+        return self.ring_offsets[self.row_offsets]
+
+    @property
+    def counts(self):
+        # Number of vertices of each row
+        return np.diff(self.offsets)
+
+    @property
+    def ring_counts(self):
+        # Number of rings of each row
+        return np.diff(self.row_offsets)
+
+    @property
+    def next_vertex(self):
+        # Index of the following vertex within the same ring, computed once
+        if self._next is None:
+            index = np.arange(len(self.vertices)) + 1
+            starts = self.ring_offsets[:-1]
+            ends = self.ring_offsets[1:]
+            filled = ends > starts
+            index[ends[filled] - 1] = starts[filled]
+            self._next = index
+        return self._next
+
+    @property
+    def xyz(self):
+        # Unit vectors of the vertices, computed once
+        if self._xyz is None:
+            self._xyz = lonlat_to_xyz(self.vertices[:, 0], self.vertices[:, 1]).reshape(-1, 3)
+        return self._xyz
+
+    @property
+    def caps(self):
+        # Bounding caps (center unit vectors and radii in degrees) of the rows, computed once
+        if self._caps is None:
+            self._caps = bounding_caps(self.xyz, self.offsets)
+        return self._caps
+
+    @property
+    def boxes(self):
+        # RA/Dec bounding boxes (ra_min, ra_max, dec_min, dec_max) of the rows, NaN for rows without vertices,
+        # computed once
+        if self._boxes is None:
+            boxes = np.full((len(self), 4), np.nan)
+            filled = self.counts > 0
+            if np.any(filled):
+                # Rows without vertices add nothing between the starts of the filled rows
+                starts = self.offsets[:-1][filled]
+                boxes[filled, 0] = np.minimum.reduceat(self.vertices[:, 0], starts)
+                boxes[filled, 1] = np.maximum.reduceat(self.vertices[:, 0], starts)
+                boxes[filled, 2] = np.minimum.reduceat(self.vertices[:, 1], starts)
+                boxes[filled, 3] = np.maximum.reduceat(self.vertices[:, 1], starts)
+            self._boxes = boxes
+        return self._boxes
+
+    def rings(self, row):
+        """
+        List of (N, 2) RA/Dec arrays with the rings of a row.
+        """
+
+        first, last = self.row_offsets[row], self.row_offsets[row + 1]
+        return [self.vertices[self.ring_offsets[k]:self.ring_offsets[k + 1]] for k in range(first, last)]
+
+    def ring_rows(self):
+        """
+        Row index of each ring.
+        """
+
+        return np.repeat(np.arange(len(self)), self.ring_counts)
+
+    def ring_coordinates(self):
+        """
+        RA and Dec lists for each ring, eg for Bokeh patches.
+        """
+
+        ra = np.split(self.vertices[:, 0], self.ring_offsets[1:-1])
+        dec = np.split(self.vertices[:, 1], self.ring_offsets[1:-1])
+        return ra, dec
+
+    def take(self, rows):
+        """
+        New PackedRegions with a subset of the rows.
+
+        Parameters
+        ----------
+        rows : numpy array
+            Row indices or boolean mask
+
+        Returns
+        -------
+        packed : PackedRegions
+        """
+
+        rows = np.arange(len(self))[rows]
+        ring_counts = self.ring_counts[rows]
+        rings = np.repeat(self.row_offsets[rows], ring_counts) + \
+            np.arange(ring_counts.sum()) - np.repeat(np.cumsum(ring_counts) - ring_counts, ring_counts)
+        vertex_counts = np.diff(self.ring_offsets)[rings]
+        vertices = np.repeat(self.ring_offsets[rings], vertex_counts) + \
+            np.arange(vertex_counts.sum()) - np.repeat(np.cumsum(vertex_counts) - vertex_counts, vertex_counts)
+        return PackedRegions(self.vertices[vertices].reshape(-1, 2),
+                             np.concatenate([[0], np.cumsum(vertex_counts)]).astype(int),
+                             np.concatenate([[0], np.cumsum(ring_counts)]).astype(int),
+                             self.valid[rows])
+
+    def counterclockwise(self):
+        """
+        Boolean array, True for the rings that are counter-clockwise.
+        """
+
+        return signed_areas(self.xyz, self.ring_offsets) > 0
+
+    def oriented(self):
+        """
+        New PackedRegions with all rings counter-clockwise.
+        """
+
+        index = _reverse_index(self.ring_offsets, ~self.counterclockwise())
+        return PackedRegions(self.vertices[index], self.ring_offsets, self.row_offsets, self.valid)
+
+    def decimated(self, tolerance):
+        """
+        New PackedRegions with fewer vertices, eg for display at a coarse zoom level.
+        Vertices falling in the same tolerance-sized RA/Dec cell as the previous vertex of their ring are dropped.
+        Rings that would keep fewer than 3 vertices are reduced to a triangle of their original vertices instead.
+
+        Parameters
+        ----------
+        tolerance : float
+            Cell size in degrees
+
+        Returns
+        -------
+        packed : PackedRegions
+        """
+
+        if tolerance <= 0 or len(self.vertices) == 0:
+            return self
+
+        ring_counts = np.diff(self.ring_offsets)
+        ring = np.repeat(np.arange(len(ring_counts)), ring_counts)
+        position = np.arange(len(self.vertices)) - self.ring_offsets[ring]
+        cells = np.floor(self.vertices / tolerance)
+        keep = np.ones(len(self.vertices), dtype=bool)
+        keep[1:] = np.any(cells[1:] != cells[:-1], axis=1)
+        keep[position == 0] = True
+
+        size = ring_counts[ring]
+        small = (np.bincount(ring[keep], minlength=len(ring_counts)) < 3)[ring]
+        triangle = (position == 0) | (position == size // 3) | (position == 2 * size // 3) | (size < 3)
+        keep = np.where(small, triangle, keep)
+
+        new_counts = np.bincount(ring[keep], minlength=len(ring_counts))
+        return PackedRegions(self.vertices[keep], np.concatenate([[0], np.cumsum(new_counts)]).astype(int),
+                             self.row_offsets, self.valid)
+
+
+# Markers replacing the S_REGION keywords so a whole column is converted to floats at once
+_ROW, _POLYGON, _CIRCLE, _UNSUPPORTED = -1e9, -2e9, -3e9, -4e9
+_SHAPES = {'POLYGON': _POLYGON, 'CIRCLE': _CIRCLE, 'BOX': _UNSUPPORTED, 'ELLIPSE': _UNSUPPORTED,
+           'POSITION': _UNSUPPORTED, 'CONVEX': _UNSUPPORTED, 'NOT': _UNSUPPORTED, 'INTERSECTION': _UNSUPPORTED}
+_WORD = re.compile(r'\b[A-Z_][A-Z0-9_]*')
+
+
+def _replace_word(word):
+    # Shapes become markers, other words (frames, UNION) are dropped
+    marker = _SHAPES.get(word)
+    return ' ' if marker is None else f' {marker} '
+
+
+def _tokenize(values):
+    # Convert S_REGION strings into one float array with markers for the rows and shapes
+    text = f' {_ROW} '.join(values).upper()
+    for bracket in '()':
+        if bracket in text:
+            text = text.replace(bracket, ' ')
+
+    # Words are the same in most rows: find them in a sample and replace them in the whole text
+    sample = ' '.join(values[::max(len(values) // 16, 1)]).upper()
+    words = set(_WORD.findall(sample)) | {'POLYGON', 'CIRCLE'}
+    for word in sorted(words, key=len, reverse=True):
+        if word in text:
+            text = text.replace(word, _replace_word(word))
+    try:
+        return np.array(f'{_ROW} {text}'.split(), dtype=float)
+    except ValueError:
+        pass
 
-def check_direction(STCS):
+    # Other words: replace them with a regular expression, then convert token by token
+    text = _WORD.sub(lambda match: _replace_word(match.group(0)), text)
+    return np.array([_to_number(x) for x in f'{_ROW} {text}'.split()])
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def pack_s_regions(s_regions, circle_resolution=16):
     """
-    Function to check vertices of closed STCS and see if they are counter-clockwise.
-    Adapted from https://gist.github.com/jd-au/45d1cdc0c6e2a7bc848a4be8f46c8958
+    Parse a column of S_REGION strings into a PackedRegions object.
+
+    All strings are tokenized together and their numbers converted in bulk with numpy.
+    Supports POLYGON and CIRCLE shapes, including several shapes per row (eg, Kepler/K2 multi-POLYGON strings).
+    Coordinate frames are ignored. Rows without shapes, with malformed or unsupported shapes, are invalid.
 
     Parameters
     ----------
-    STCS : str
-        String describing the bounds of the object.
+    s_regions : list or astropy Column
+        S_REGION values
+    circle_resolution : int
+        Number of vertices of the polygons replacing circles (Default: 16)
 
     Returns
     -------
-    True/False
+    packed : PackedRegions
+    """
+
+    values = [s.decode() if isinstance(s, bytes) else ('' if s is None or s is np.ma.masked else str(s))
+              for s in s_regions]
+    n_rows = len(values)
+    tokens = _tokenize(values)
+
+    # Assign shapes to rows and numbers to shapes
+    is_row = tokens == _ROW
+    is_polygon = tokens == _POLYGON
+    is_shape = is_polygon | (tokens == _CIRCLE) | (tokens == _UNSUPPORTED)
+    is_number = ~is_row & ~is_shape
+    token_row = np.cumsum(is_row) - 1
+    token_shape = np.cumsum(is_shape) - 1
+    shape_row = token_row[is_shape]
+    shape_kind = tokens[is_shape]
+    n_shapes = len(shape_row)
+
+    numbers = tokens[is_number]
+    number_row = token_row[is_number]
+    number_shape = token_shape[is_number]
+    orphan = number_shape < 0
+    orphan[~orphan] = shape_row[number_shape[~orphan]] != number_row[~orphan]
+    ok = np.ones(n_rows, dtype=bool)
+    ok[number_row[orphan | ~np.isfinite(numbers)]] = False
+    numbers = numbers[~orphan]
+    number_shape = number_shape[~orphan]
+
+    # Shapes must be POLYGONs with at least 3 vertices or CIRCLEs with center and radius
+    # (empty POLYGONs, as in 'POLYGON CIRCLE ...', are ignored)
+    n_values = np.bincount(number_shape, minlength=n_shapes)
+    polygon = shape_kind == _POLYGON
+    empty = polygon & (n_values == 0)
+    good = (polygon & (n_values >= 6) & (n_values % 2 == 0)) | ((shape_kind == _CIRCLE) & (n_values == 3)) | empty
+    ok[shape_row[~good]] = False
+    has_shape = np.zeros(n_rows, dtype=bool)
+    has_shape[shape_row[~empty]] = True
+    ok &= has_shape
+
+    # Rings of the valid rows
+    keep = ~empty & ok[shape_row]
+    ring_shape = np.where(keep)[0]
+    ring_row = shape_row[keep]
+    ring_polygon = polygon[keep]
+    ring_size = np.where(ring_polygon, n_values[ring_shape] // 2, circle_resolution)
+    ring_offsets = np.concatenate([[0], np.cumsum(ring_size)]).astype(int)
+    vertices = np.zeros((ring_offsets[-1], 2))
+
+    # Polygon vertices keep their order: the numbers of the kept polygons are contiguous pairs
+    keep_number = np.zeros(n_shapes, dtype=bool)
+    keep_number[ring_shape[ring_polygon]] = True
+    size = ring_size[ring_polygon]
+    destination = np.repeat(ring_offsets[:-1][ring_polygon], size) + \
+        np.arange(size.sum()) - np.repeat(np.cumsum(size) - size, size)
+    vertices[destination] = numbers[keep_number[number_shape]].reshape(-1, 2)
+
+    # Circles are converted to polygons all at once
+    circles = np.where(~ring_polygon)[0]
+    if len(circles) > 0:
+        first = np.searchsorted(number_shape, ring_shape[circles])
+        lon, lat = convert_to_polygons(numbers[first], numbers[first + 1], numbers[first + 2],
+                                       resolution=circle_resolution)
+        destination = ring_offsets[circles][:, np.newaxis] + np.arange(circle_resolution)
+        vertices[destination, 0] = lon
+        vertices[destination, 1] = lat
+
+    vertices[:, 0] = np.where(vertices[:, 0] < 0, vertices[:, 0] + 360, vertices[:, 0])
+    row_offsets = np.concatenate([[0], np.cumsum(np.bincount(ring_row, minlength=n_rows))]).astype(int)
+    return PackedRegions(vertices, ring_offsets, row_offsets, ok)
+
+
+_packed_cache = OrderedDict()
+_packed_lock = threading.Lock()
+
+
+def get_packed_regions(s_regions, max_entries=8):
+    """
+    Parse a column of S_REGION strings with pack_s_regions, reusing the result for identical columns
+    (eg, when the same MAST results are verified and then plotted).
+
+    Parameters
+    ----------
+    s_regions : list or astropy Column
+        S_REGION values
+    max_entries : int
+        Number of parsed columns to keep (Default: 8)
+
+    Returns
+    -------
+    packed : PackedRegions
+    """
+
+    values = [s.decode() if isinstance(s, bytes) else ('' if s is None or s is np.ma.masked else str(s))
+              for s in s_regions]
+    key = hashlib.sha1('\n'.join(values).encode()).hexdigest()
+    with _packed_lock:
+        if key in _packed_cache:
+            _packed_cache.move_to_end(key)
+            return _packed_cache[key]
+
+    packed = pack_s_regions(values)
+    with _packed_lock:
+        _packed_cache[key] = packed
+        while len(_packed_cache) > max_entries:
+            _packed_cache.popitem(last=False)
+    return packed
+
+
+def counterclockwise(ra, dec, offsets=None):
+    """
+    Check if polygons are counter-clockwise (as required for STC-S and ADQL polygons).
+    The orientation comes from the signed spherical area, so RA=0/360 crossings and poles need no special handling.
+
+    Parameters
+    ----------
+    ra, dec : numpy array
+        Vertices in degrees, for one polygon or for many polygons one after the other
+    offsets : numpy array
+        Index of the first vertex of each polygon, with a final entry for the total number of vertices
+        (Default: None, a single polygon)
+
+    Returns
+    -------
+    ccw : bool or numpy array
+        True for counter-clockwise polygons
+    """
+
+    ra = np.asarray(ra, dtype=float)
+    single = offsets is None
+    if single:
+        offsets = [0, len(ra)]
+    ccw = signed_areas(lonlat_to_xyz(ra, dec).reshape(-1, 3), offsets) > 0
+    return bool(ccw[0]) if single else ccw
+
+
+def _reverse_index(offsets, flip):
+    # Vertex order with the polygons flagged in flip reversed
+    offsets = np.asarray(offsets, dtype=int)
+    counts = np.diff(offsets)
+    polygon = np.repeat(np.arange(len(counts)), counts)
+    index = np.arange(offsets[-1])
+    reverse = offsets[polygon] + offsets[polygon + 1] - 1 - index
+    return np.where(np.asarray(flip)[polygon], reverse, index)
+
+
+def orient_counterclockwise(ra, dec, offsets=None):
+    """
+    Reverse the clockwise polygons so all are counter-clockwise.
+
+    Parameters
+    ----------
+    ra, dec : numpy array
+        Vertices in degrees, for one polygon or for many polygons one after the other
+    offsets : numpy array
+        Index of the first vertex of each polygon, with a final entry for the total number of vertices
+        (Default: None, a single polygon)
+
+    Returns
+    -------
+    ra, dec : numpy array
+        Vertices, with the same offsets
     """
 
-    data = STCS.split()
-    data = data[1:]  # ignore the polygon part
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    if offsets is None:
+        offsets = [0, len(ra)]
+    index = _reverse_index(offsets, ~counterclockwise(ra, dec, offsets))
+    return ra[index], dec[index]
 
-    # Strip string beyond polygon, if present
+
+def format_stcs(ra, dec, frame=None):
+    """
+    Format polygon vertices as an STC-S string.
+
+    Parameters
+    ----------
+    ra, dec : numpy array
+        Vertices in degrees
+    frame : str
+        Coordinate frame to include, eg ICRS (Default: None)
+
+    Returns
+    -------
+    stcs : str
+    """
+
+    prefix = 'POLYGON ' if frame is None else f'POLYGON {frame} '
+    return prefix + ' '.join([f'{a} {d}' for a, d in zip(np.asarray(ra).tolist(), np.asarray(dec).tolist())])
+
+
+def _split_stcs(STCS):
+    # Split a POLYGON STC-S string into the optional frame and the coordinate tokens
+    data = STCS.split()[1:]  # ignore the polygon part
+    extra_string = ''
     try:
         _ = float(data[0])
     except ValueError:
+        extra_string = data[0]
         data = data[1:]
+    return extra_string, data
+
+
+def check_direction(STCS):
+    """
+    Function to check vertices of closed STCS and see if they are counter-clockwise.
+    The orientation comes from the signed spherical area, so RA=0/360 crossings and poles need no special handling.
+
+    Parameters
+    ----------
+    STCS : str
+        String describing the bounds of the object.
+
+    Returns
+    -------
+    True/False
+    """
 
+    _, data = _split_stcs(STCS)
     try:
-        points = np.array(data).reshape(int(len(data) / 2), 2).astype(float)
+        points = np.array(data, dtype=float).reshape(-1, 2)
     except ValueError:
         print('WARNING: Unable to test polygon direction. Non-numeric characters/Multipolygon')
         return True
 
-    # If closed, remove the last point
-    if points[-1, 0] == points[0, 0] and points[-1, 1] == points[0, 1]:
-        points = points[:-1]
-
-    # Check if close to Equatorial poles, switch to Galactic
-    if abs(np.mean(points[:, 1])) >= 75:
-        points = _frame_convert(points)
-
-    # Fix cases that pass ra=360/0
-    min_ra = min(points[:, 0])
-    max_ra = max(points[:, 0])
-    avg_ra = np.mean(points[:, 0])
-    delta_ra = (max_ra - min_ra) % 360
-    if delta_ra >= 180:
-        if avg_ra < 180:  # for values close to zero, shift them up so they are 180..540
-            for i, val in enumerate(points[:, 0]):
-                if points[i, 0] < avg_ra: points[i, 0] += 360
-        else:  # for values close to 360, shift them down so they are -180..180
-            for i, val in enumerate(points[:, 0]):
-                if points[i, 0] > avg_ra: points[i, 0] -= 360
-
-    # Implementation of Shoelace formula
-    total = 0
-    for curr_idx in range(len(points)):
-        next_idx = curr_idx + 1 if curr_idx < len(points) - 1 else 0
-        total += (points[next_idx, 0] - points[curr_idx, 0]) * (points[next_idx, 1] + points[curr_idx, 1])
-
     # Positive: counter-clockwise direction (as required)
-    if total > 0:
-        # print('Polygon is CCW')
-        return True
-    else:
-        # print('Polygon is CW')
-        return False
+    return counterclockwise(points[:, 0], points[:, 1])
 
 
 def reverse_direction(STCS):
@@ -163,23 +655,8 @@ def reverse_direction(STCS):
         Reversed STCS
     """
 
-    data = STCS.split()
-    data = data[1:]  # ignore the polygon part
-
-    # Strip string beyond polygon, if present
-    extra_string = ''
-    try:
-        value = float(data[0])
-    except ValueError:
-        extra_string = data[0]
-        data = data[1:]
-
-    # make array of the points and then reverse the order of the point pairs
-    points = np.array(data).reshape(int(len(data) / 2), 2)[::-1]
-
-    # recreate STCS
-    STCS = "POLYGON {}".format(extra_string)
-    for x in range(len(points)):
-        STCS += " {} {}".format(points[x, 0], points[x, 1])
+    extra_string, data = _split_stcs(STCS)
 
-    return STCS
+    # Reverse the order of the point pairs, keeping their original text
+    points = np.array(data).reshape(-1, 2)[::-1]
+    return f"POLYGON {extra_string} " + ' '.join([f'{a} {d}' for a, d in points])
@@ -0,0 +1,454 @@
+# Functions to handle MAST data products: product lists and downloads
+
+import os
+import time
+import shlex
+import base64
+import binascii
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import requests
+from urllib.parse import urlencode
+from astropy.table import Table, vstack
+from astroquery.mast import Observations
+from .cache import get_product_cache
+from .metrics import span, count
+
+MAST_DOWNLOAD_URL = 'https://mast.stsci.edu/api/v0.1/Download/file'
+# Digest header algorithms (RFC 3230 and RFC 9530) and their hashlib names
+DIGEST_ALGORITHMS = {'md5': 'md5', 'sha': 'sha1', 'sha-256': 'sha256', 'sha-512': 'sha512'}
+
+
+def _as_str(values):
+    return [x.decode() if isinstance(x, bytes) else str(x).strip() for x in values]
+
+
+def _path_name(value, column):
+    # Single path component from a product column, never leaving the download directory
+    name = os.path.basename(value.replace('\\', '/'))
+    if name in ('', '.', '..'):
+        raise ValueError(f'Invalid {column} for a local file name: {value!r}')
+    return name
+
+
+def _split_by_parent(products, obsids):
+    # Rows of a product list for each requested obsID, matched on parent_obsid (or obsID)
+    column = 'parent_obsid' if 'parent_obsid' in products.colnames else 'obsID'
+    if len(products) == 0 or column not in products.colnames:
+        return {obsid: products[:0] for obsid in obsids}
+    ids = np.array(_as_str(products[column]))
+    order = np.argsort(ids, kind='stable')
+    lo = np.searchsorted(ids[order], obsids, side='left')
+    hi = np.searchsorted(ids[order], obsids, side='right')
+    return {obsid: products[order[a:b]] for obsid, a, b in zip(obsids, lo, hi)}
+
+
+def get_product_lists(obsids, chunk_size=100, max_workers=4, cache=True, fetch=None, verbose=False):
+    """
+    Product lists of many observations, fetched in parallel chunks and cached per observation.
+
+    Parameters
+    ----------
+    obsids : list
+        MAST obsID values
+    chunk_size : int
+        Number of observations per product list request (Default: 100)
+    max_workers : int
+        Number of requests running at the same time (Default: 4)
+    cache : bool or ProductCache
+        Use the process-wide product cache (True), another cache or none (False) (Default: True)
+    fetch : callable
+        Function returning the product list of a list of obsID values (Default: Observations.get_product_list)
+    verbose : bool
+        Flag to control verbosity of output messages. (Default: False)
+
+    Returns
+    -------
+    products : astropy Table
+        Products of all the observations, in the order of obsids
+    """
+
+    obsids = list(dict.fromkeys(_as_str(obsids)))
+    if cache is True:
+        cache = get_product_cache()
+    elif cache is False:
+        cache = None
+    fetch = Observations.get_product_list if fetch is None else fetch
+
+    lists = {}
+    missing = []
+    for obsid in obsids:
+        products = cache.lookup(obsid) if cache is not None else None
+        if products is None:
+            missing.append(obsid)
+        else:
+            lists[obsid] = products
+
+    chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    if verbose:
+        print(f'{len(lists)} product lists cached, fetching {len(missing)} in {len(chunks)} requests')
+
+    def fetch_chunk(chunk):
+        with span('product_list', observations=len(chunk)) as stage:
+            products = fetch(chunk)
+            stage.set(rows=len(products))
+        return products
+
+    if len(chunks) > 0:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(fetch_chunk, chunk): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                chunk = futures[future]
+                for obsid, products in _split_by_parent(future.result(), chunk).items():
+                    lists[obsid] = products
+                    if cache is not None:
+                        cache.store(obsid, products)
+
+    tables = [lists[obsid] for obsid in obsids if len(lists[obsid]) > 0]
+    if len(tables) == 0:
+        return Table()
+    return vstack(tables, metadata_conflicts='silent')
+
+
+class RateLimiter:
+    """
+    Token bucket shared by the download threads to limit the total bandwidth.
+
+    Parameters
+    ----------
+    bytes_per_second : float
+        Maximum rate. None or 0 for no limit.
+    burst : float
+        Bytes that can be sent at once (Default: None, one second worth of data)
+    """
+
+    def __init__(self, bytes_per_second=None, burst=None):
+        self.rate = bytes_per_second or None
+        self.capacity = burst or self.rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n_bytes):
+        """
+        Wait until n_bytes can be transferred.
+        """
+
+        if self.rate is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= n_bytes
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.
+        if wait > 0:
+            time.sleep(wait)
+
+
+def response_digest(response):
+    """
+    Checksum of the whole file announced by a download response, from its Repr-Digest, Digest or
+    Content-MD5 header. Content-MD5 only covers the response body, so it is used for complete (200) responses.
+
+    Returns
+    -------
+    digest : tuple
+        (hashlib algorithm, hex digest), None if the response has no usable digest header
+    """
+
+    for header in ('Repr-Digest', 'Digest'):
+        for item in response.headers.get(header, '').split(','):
+            name, _, encoded = item.strip().partition('=')
+            algorithm = DIGEST_ALGORITHMS.get(name.strip().lower())
+            if algorithm is None:
+                continue
+            try:
+                return algorithm, base64.b64decode(encoded.strip().strip(':'), validate=True).hex()
+            except (ValueError, binascii.Error):
+                continue
+    if response.status_code == 200 and response.headers.get('Content-MD5'):
+        try:
+            return 'md5', base64.b64decode(response.headers['Content-MD5'].strip(), validate=True).hex()
+        except (ValueError, binascii.Error):
+            pass
+    return None
+
+
+def file_checksum(filename, algorithm='md5', block_size=1024 ** 2):
+    """
+    Hex digest of a file.
+    """
+
+    digest = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DownloadManager:
+    """
+    Concurrent, resumable and verified downloads of MAST data products.
+
+    Files are written to <directory>/<obs_id>/<productFilename>, first as .part files that later
+    attempts resume with HTTP range requests. Completed files are checked against the product size and
+    against a checksum: from the checksum column when given, otherwise from the digest headers of the
+    download responses (see response_digest). When neither is available (MAST product lists have no checksum
+    column), only the size is checked. Files that are already complete are skipped.
+
+    Parameters
+    ----------
+    directory : str
+        Download directory
+    max_workers : int
+        Number of files downloaded at the same time (Default: 4)
+    max_bytes_per_second : float
+        Total bandwidth limit (Default: None, no limit)
+    retries : int
+        Attempts for each file, resuming after failures (Default: 3)
+    timeout : float
+        Timeout of the requests in seconds (Default: 60)
+    checksum_column : str
+        Product column with the expected checksum (Default: None, digest headers of the responses are used)
+    algorithm : str
+        Checksum algorithm, see hashlib (Default: md5)
+    url : str
+        MAST download service (Default: MAST_DOWNLOAD_URL)
+    chunk_size : int
+        Size of the blocks read from the responses in bytes (Default: 1 MB)
+    """
+
+    def __init__(self, directory='.', max_workers=4, max_bytes_per_second=None, retries=3, timeout=60,
+                 checksum_column=None, algorithm='md5', url=MAST_DOWNLOAD_URL, chunk_size=1024 ** 2):
+        self.directory = directory
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(max_bytes_per_second)
+        self.retries = retries
+        self.timeout = timeout
+        self.checksum_column = checksum_column
+        self.algorithm = algorithm
+        self.url = url
+        self.chunk_size = chunk_size
+        self.bytes_received = 0
+        self._cancelled = threading.Event()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        """
+        Stop the downloads in progress, keeping their .part files for later.
+        """
+
+        self._cancelled.set()
+
+    def _session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def local_path(self, product):
+        """
+        Local file of a product, <directory>/<obs_id>/<productFilename>.
+        Directories in obs_id and productFilename are dropped, and ValueError is raised when nothing is left
+        (eg, '..'), so files are never written outside the download directory.
+        """
+
+        filename = _path_name(_as_str([product['productFilename']])[0], 'productFilename')
+        if 'obs_id' in product.colnames:
+            return os.path.join(self.directory, _path_name(_as_str([product['obs_id']])[0], 'obs_id'), filename)
+        return os.path.join(self.directory, filename)
+
+    def _local_paths(self, products):
+        # Local file of each product, None with the error message for invalid names
+        paths = []
+        for product in products:
+            try:
+                paths.append((self.local_path(product), None))
+            except ValueError as e:
+                paths.append((None, str(e)))
+        return paths
+
+    def _verify(self, filename, size, checksum, algorithm=None):
+        # Error message for a downloaded file, None if it is fine
+        if size is not None and os.path.getsize(filename) != size:
+            return f'Size mismatch: expected {size} bytes, got {os.path.getsize(filename)}'
+        if checksum is not None and file_checksum(filename, algorithm or self.algorithm) != checksum.lower():
+            return f'Checksum mismatch ({algorithm or self.algorithm})'
+        return None
+
+    def _fetch(self, uri, part, size):
+        # Download uri into part, resuming from its current size
+        # Returns the checksum announced by the response, see response_digest
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if size is not None and offset == size:
+            return None
+        headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+        with self._session().get(self.url, params={'uri': uri}, headers=headers, stream=True,
+                                 timeout=self.timeout) as response:
+            if response.status_code == 416 and offset > 0:
+                return None  # nothing left to send
+            response.raise_for_status()
+            digest = response_digest(response)
+            mode = 'ab' if response.status_code == 206 else 'wb'  # 200: the server ignored the range
+            with open(part, mode) as f:
+                for block in response.iter_content(chunk_size=self.chunk_size):
+                    if self._cancelled.is_set():
+                        raise InterruptedError('Download cancelled')
+                    self.limiter.consume(len(block))
+                    f.write(block)
+                    with self._lock:
+                        self.bytes_received += len(block)
+        return digest
+
+    def download_file(self, uri, filename, size=None, checksum=None):
+        """
+        Download a product to filename.
+
+        Returns
+        -------
+        status : str
+            COMPLETE, SKIPPED (already downloaded) or ERROR
+        message : str
+            Error message, None otherwise
+        """
+
+        if os.path.exists(filename) and self._verify(filename, size, checksum) is None:
+            return 'SKIPPED', None
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        part = filename + '.part'
+        message = None
+        announced = None  # checksum from the response headers, kept across resumed attempts
+        for attempt in range(self.retries):
+            if self._cancelled.is_set():
+                return 'ERROR', 'Download cancelled'
+            try:
+                announced = self._fetch(uri, part, size) or announced
+            except InterruptedError as e:
+                return 'ERROR', str(e)
+            except (requests.RequestException, OSError) as e:
+                message = str(e)
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            if checksum is not None:
+                message = self._verify(part, size, checksum)
+            elif announced is not None:
+                message = self._verify(part, size, announced[1], algorithm=announced[0])
+            else:
+                message = self._verify(part, size, None)
+            if message is None:
+                os.replace(part, filename)
+                return 'COMPLETE', None
+            os.remove(part)  # corrupted, start over
+            announced = None
+        return 'ERROR', message
+
+    def download(self, products, progress=None):
+        """
+        Download many products concurrently.
+
+        Parameters
+        ----------
+        products : astropy Table
+            Products with dataURI and productFilename columns, eg from get_product_lists.
+            Rows with the same dataURI are downloaded once.
+        progress : callable
+            Called with (done, total, bytes_received) as files complete. Exceptions raised by it
+            (eg, a cancelled job) cancel the remaining downloads and are raised again.
+
+        Returns
+        -------
+        manifest : astropy Table
+            Local Path, Status, Message and URL of each product
+        """
+
+        uris = _as_str(products['dataURI'])
+        if len(uris) > 0:
+            _, first = np.unique(uris, return_index=True)
+            products = products[np.sort(first)]
+        paths = self._local_paths(products)
+        manifest = Table([[path or '' for path, _ in paths], ['ERROR'] * len(products),
+                          [message or '' for _, message in paths], _as_str(products['dataURI'])],
+                         names=['Local Path', 'Status', 'Message', 'URL'], dtype=[object] * 4)
+        sizes = [None] * len(products)
+        if 'size' in products.colnames:
+            sizes = [int(x) if np.isfinite(x) and x > 0 else None
+                     for x in np.ma.filled(np.ma.asarray(products['size'], dtype=float), np.nan)]
+        checksums = [None] * len(products)
+        if self.checksum_column is not None and self.checksum_column in products.colnames:
+            checksums = [x or None for x in _as_str(products[self.checksum_column])]
+
+        start = self.bytes_received
+        with span('download', files=len(products)) as stage, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(self.download_file, manifest['URL'][i], manifest['Local Path'][i],
+                                   sizes[i], checksums[i]): i
+                       for i in range(len(products)) if paths[i][0] is not None}
+            try:
+                for done, future in enumerate(as_completed(futures), start=1):
+                    i = futures[future]
+                    status, message = future.result()
+                    manifest['Status'][i] = status
+                    manifest['Message'][i] = message or ''
+                    count('downloads', status=status)
+                    if progress is not None:
+                        progress(done, len(futures), self.bytes_received)
+            except BaseException:
+                self.cancel()
+                raise
+            finally:
+                stage.set(bytes=self.bytes_received - start)
+        return manifest
+
+
+def download_script(products, directory='mast_files', url=MAST_DOWNLOAD_URL):
+    """
+    Shell script downloading products with curl, to run on the user's machine (eg, from the dashboard).
+    Files are written like DownloadManager does and interrupted downloads are resumed when run again.
+
+    Parameters
+    ----------
+    products : astropy Table
+        Products with dataURI and productFilename columns, eg from get_files
+    directory : str
+        Download directory, relative to where the script runs (Default: mast_files)
+    url : str
+        MAST download service (Default: MAST_DOWNLOAD_URL)
+
+    Returns
+    -------
+    script : str
+    """
+
+    manager = DownloadManager(directory, url=url)
+    lines = ['#!/bin/sh', f'# {len(products)} MAST files']
+    for uri, (path, message) in zip(_as_str(products['dataURI']), manager._local_paths(products)):
+        if path is None:
+            lines.append(f'# Skipped: {message}')
+            continue
+        source = f'{url}?{urlencode({"uri": uri})}'
+        lines.append(f'curl --fail --location --create-dirs -C - -o {shlex.quote(path)} {shlex.quote(source)}')
+    return '\n'.join(lines) + '\n'
+
+
+def download_products(products, directory='.', **kwargs):
+    """
+    Download products with a DownloadManager.
+
+    Parameters
+    ----------
+    products : astropy Table
+        Products to download, eg from get_files
+    directory : str
+        Download directory (Default: current directory)
+    kwargs
+        Additional arguments for DownloadManager
+
+    Returns
+    -------
+    manifest : astropy Table
+    """
+
+    return DownloadManager(directory, **kwargs).download(products)
@@ -0,0 +1,298 @@
+# Functions to handle spherical geometry with unit vectors and great-circle edges
+# Coordinates are RA/Dec (lon/lat) in degrees unless noted otherwise
+
+import numpy as np
+
+MAX_EDGE_TESTS = 2 ** 22  # number of (pair, edge) tests evaluated per chunk
+
+
+def lonlat_to_xyz(lon, lat):
+    """
+    Convert lon/lat in degrees to unit vectors with shape (..., 3).
+    """
+
+    lon = np.radians(np.asarray(lon, dtype=float))
+    lat = np.radians(np.asarray(lat, dtype=float))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def xyz_to_lonlat(xyz):
+    """
+    Convert vectors with shape (..., 3) to lon (0..360) and lat in degrees.
+    """
+
+    xyz = np.asarray(xyz, dtype=float)
+    lon = np.degrees(np.arctan2(xyz[..., 1], xyz[..., 0])) % 360
+    lat = np.degrees(np.arctan2(xyz[..., 2], np.hypot(xyz[..., 0], xyz[..., 1])))
+    return lon, lat
+
+
+def _normalize(xyz):
+    norm = np.linalg.norm(xyz, axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return xyz / norm
+
+
+def _angle(a, b):
+    # Angle in radians between unit vectors, accurate for small and large angles
+    return np.arctan2(np.linalg.norm(np.cross(a, b), axis=-1), np.sum(a * b, axis=-1))
+
+
+def separation(lon1, lat1, lon2, lat2):
+    """
+    Angular separation in degrees (haversine formula).
+    """
+
+    lon1, lat1, lon2, lat2 = [np.radians(np.asarray(x, dtype=float)) for x in (lon1, lat1, lon2, lat2)]
+    hav = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1))))
+
+
+def signed_areas(xyz, offsets):
+    """
+    Signed areas of many polygons, positive for counter-clockwise polygons as seen on the sky
+    (ie, from the center of the sphere, with East to the left of North).
+
+    Parameters
+    ----------
+    xyz : numpy array
+        Unit vectors of all vertices with shape (N, 3), without repeating the first vertex
+    offsets : numpy array
+        Index of the first vertex of each polygon, with a final entry for the total number of vertices
+
+    Returns
+    -------
+    areas : numpy array
+        Signed areas in steradians
+    """
+
+    offsets = np.asarray(offsets, dtype=int)
+    counts = np.diff(offsets)
+    areas = np.zeros(len(counts))
+    filled = counts > 0
+    if not np.any(filled):
+        return areas
+
+    # Fan of triangles from the first vertex (Van Oosterom & Strackee formula)
+    polygon = np.repeat(np.arange(len(counts)), counts)
+    position = np.arange(len(polygon)) - offsets[polygon]
+    first = xyz[offsets[polygon]]
+    a = xyz
+    b = xyz[offsets[polygon] + (position + 1) % counts[polygon]]
+    numerator = np.sum(first * np.cross(a, b), axis=-1)
+    denominator = 1 + np.sum(first * a, axis=-1) + np.sum(a * b, axis=-1) + np.sum(b * first, axis=-1)
+    triangle = 2 * np.arctan2(numerator, denominator)
+
+    # Vectors point outwards; seen from the center the orientation is reversed
+    areas[filled] = -np.bincount(polygon, weights=triangle, minlength=len(counts))[filled]
+    return areas
+
+
+def signed_area(lon, lat):
+    """
+    Signed area in steradians of a polygon, positive when counter-clockwise as seen on the sky.
+    """
+
+    lon = np.asarray(lon, dtype=float)
+    return signed_areas(lonlat_to_xyz(lon, lat), [0, len(lon)])[0]
+
+
+def polygon_area(lon, lat):
+    """
+    Area in square degrees of a polygon.
+    """
+
+    return abs(signed_area(lon, lat)) * np.degrees(1) ** 2
+
+
+def _pair_chunks(counts, max_tests=MAX_EDGE_TESTS):
+    # Split pairs into consecutive chunks with at most max_tests edge tests each
+    start = 0
+    cumulative = np.cumsum(counts)
+    while start < len(counts):
+        done = cumulative[start - 1] if start > 0 else 0
+        stop = max(np.searchsorted(cumulative, done + max_tests, side='right'), start + 1)
+        yield start, stop
+        start = stop
+
+
+def _expand_edges(packed, rows, start, stop, counts):
+    # Expand pairs start:stop into the edges of their polygons (all rings of the row)
+    # Returns the pair index and the vertex indices (i, j) of each edge
+    pair = np.repeat(np.arange(start, stop), counts)
+    first = np.repeat(packed.offsets[rows[start:stop]], counts)
+    i = first + np.arange(len(pair)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return pair, i, packed.next_vertex[i]
+
+
+def points_in_polygons(packed, rows, lon, lat):
+    """
+    Vectorized spherical point-in-polygon test for (polygon, point) pairs.
+
+    The winding number of each polygon around the point is computed from the angles subtended by its
+    great-circle edges; points with odd winding numbers are inside (equivalent to the even-odd rule).
+    Rows with several rings (eg, Kepler CCDs) are tested against all their edges at once.
+    Points more than 90 degrees away from the polygon center are always outside.
+
+    Parameters
+    ----------
+    packed : PackedRegions
+        Polygons
+    rows : numpy array
+        Index of the polygon for each pair
+    lon, lat : numpy array
+        Point coordinates for each pair
+
+    Returns
+    -------
+    inside : numpy array
+        Boolean array, True when the point is inside the polygon
+    """
+
+    rows = np.asarray(rows, dtype=int)
+    points = lonlat_to_xyz(lon, lat).reshape(-1, 3)
+    inside = np.zeros(len(rows), dtype=bool)
+    counts = packed.counts[rows]
+    xyz = packed.xyz
+
+    for start, stop in _pair_chunks(counts):
+        n = counts[start:stop]
+        if n.sum() == 0:
+            continue
+        pair, i, j = _expand_edges(packed, rows, start, stop, n)
+        p = points[pair]
+        a = xyz[i]
+        b = xyz[j]
+        numerator = np.sum(p * np.cross(a, b), axis=-1)
+        denominator = np.sum(a * b, axis=-1) - np.sum(a * p, axis=-1) * np.sum(b * p, axis=-1)
+        winding = np.bincount(pair - start, weights=np.arctan2(numerator, denominator), minlength=stop - start)
+        inside[start:stop] = np.round(winding / (2 * np.pi)).astype(int) % 2 == 1
+
+    centers, _ = packed.caps
+    near = np.sum(points * centers[rows], axis=-1) > 0
+    return inside & near
+
+
+def arcs_intersect(a0, a1, b0, b1):
+    """
+    Vectorized test of whether great-circle arcs (a0, a1) and (b0, b1) intersect or touch.
+    Arcs are given as unit vectors with shape (..., 3) and should be shorter than 180 degrees.
+    """
+
+    na = np.cross(a0, a1)
+    nb = np.cross(b0, b1)
+    s1 = np.sign(np.sum(na * b0, axis=-1))
+    s2 = np.sign(np.sum(na * b1, axis=-1))
+    s3 = np.sign(np.sum(nb * a0, axis=-1))
+    s4 = np.sign(np.sum(nb * a1, axis=-1))
+    # Both arcs straddle the other's great circle, on the same side of the sphere
+    same_side = np.sum((a0 + a1) * (b0 + b1), axis=-1) > 0
+    return (s1 * s2 <= 0) & (s3 * s4 <= 0) & same_side
+
+
+def point_arc_distance(p, a, b):
+    """
+    Angular distance in degrees between points p and great-circle arcs (a, b), given as unit vectors.
+    """
+
+    n = _normalize(np.cross(a, b))
+    degenerate = ~np.all(np.isfinite(n), axis=-1)
+    n = np.where(degenerate[..., np.newaxis], 0., n)
+    within = (np.sum(np.cross(a, p) * n, axis=-1) >= 0) & (np.sum(np.cross(p, b) * n, axis=-1) >= 0) & ~degenerate
+    to_circle = np.abs(np.arcsin(np.clip(np.sum(p * n, axis=-1), -1, 1)))
+    to_ends = np.minimum(_angle(p, a), _angle(p, b))
+    return np.degrees(np.where(within, to_circle, to_ends))
+
+
+def arcs_cross_polygons(packed, rows, a, b):
+    """
+    Vectorized test of whether great-circle arcs (a, b), given as unit vectors, cross the edges of their polygons.
+    """
+
+    rows = np.asarray(rows, dtype=int)
+    crosses = np.zeros(len(rows), dtype=bool)
+    counts = packed.counts[rows]
+    xyz = packed.xyz
+
+    for start, stop in _pair_chunks(counts):
+        n = counts[start:stop]
+        if n.sum() == 0:
+            continue
+        pair, i, j = _expand_edges(packed, rows, start, stop, n)
+        hit = arcs_intersect(a[pair], b[pair], xyz[i], xyz[j])
+        crosses[start:stop] = np.bincount(pair - start, weights=hit, minlength=stop - start) > 0
+
+    return crosses
+
+
+def bounding_caps(xyz, offsets):
+    """
+    Bounding caps (center unit vector and angular radius in degrees) of many polygons.
+    """
+
+    offsets = np.asarray(offsets, dtype=int)
+    counts = np.diff(offsets)
+    centers = np.full((len(counts), 3), np.nan)
+    radii = np.full(len(counts), np.nan)
+    filled = np.where(counts > 0)[0]
+    if len(filled) == 0:
+        return centers, radii
+
+    starts = offsets[filled]
+    centers[filled] = _normalize(np.add.reduceat(xyz, starts, axis=0))
+    polygon = np.repeat(np.arange(len(counts)), counts)
+    distance = np.degrees(_angle(xyz, centers[polygon]))
+    radii[filled] = np.maximum.reduceat(distance, starts)
+    return centers, radii
+
+
+def polygons_intersect(lon1, lat1, lon2, lat2):
+    """
+    Check if two spherical polygons intersect (overlap, touch, or one contains the other).
+    """
+
+    from .polygon import PackedRegions
+
+    first = PackedRegions.from_rings([np.column_stack([lon1, lat1])])
+    second = PackedRegions.from_rings([np.column_stack([lon2, lat2])])
+    if np.any(points_in_polygons(second, np.zeros(len(lon1), dtype=int), lon1, lat1)):
+        return True
+    if np.any(points_in_polygons(first, np.zeros(len(lon2), dtype=int), lon2, lat2)):
+        return True
+
+    # Test every pair of edges
+    a = first.xyz
+    b = second.xyz
+    i, j = np.meshgrid(np.arange(len(a)), np.arange(len(b)), indexing='ij')
+    i, j = i.ravel(), j.ravel()
+    return bool(np.any(arcs_intersect(a[i], a[(i + 1) % len(a)], b[j], b[(j + 1) % len(b)])))
+
+
+def to_tangent_plane(lon, lat, center_lon, center_lat):
+    """
+    Gnomonic projection onto the plane tangent at the center.
+    Returns x (towards East) and y (towards North) in degrees; great circles become straight lines.
+    """
+
+    lon, lat = np.radians(np.asarray(lon, dtype=float)), np.radians(np.asarray(lat, dtype=float))
+    lon0, lat0 = np.radians(center_lon), np.radians(center_lat)
+    cos_c = np.sin(lat0) * np.sin(lat) + np.cos(lat0) * np.cos(lat) * np.cos(lon - lon0)
+    x = np.cos(lat) * np.sin(lon - lon0) / cos_c
+    y = (np.cos(lat0) * np.sin(lat) - np.sin(lat0) * np.cos(lat) * np.cos(lon - lon0)) / cos_c
+    return np.degrees(x), np.degrees(y)
+
+
+def from_tangent_plane(x, y, center_lon, center_lat):
+    """
+    Inverse of to_tangent_plane. Returns lon (0..360) and lat in degrees.
+    """
+
+    x, y = np.radians(np.asarray(x, dtype=float)), np.radians(np.asarray(y, dtype=float))
+    lon0, lat0 = np.radians(center_lon), np.radians(center_lat)
+    rho = np.hypot(x, y)
+    c = np.arctan(rho)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lat = np.where(rho > 0, np.arcsin(np.cos(c) * np.sin(lat0) + y * np.sin(c) * np.cos(lat0) / rho), lat0)
+    lon = lon0 + np.arctan2(x * np.sin(c), rho * np.cos(lat0) * np.cos(c) - y * np.sin(lat0) * np.sin(c))
+    return np.degrees(lon) % 360, np.degrees(lat)
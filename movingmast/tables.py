@@ -0,0 +1,172 @@
+# Paginated display of result tables for the dashboard
+
+import numpy as np
+import panel as pn
+
+PAGE_SIZES = [10, 25, 50, 100]
+
+
+class ResultTable:
+    """
+    Paginated view of an in-memory result table (ephemerides, MAST results or products).
+
+    Sorting and filtering run on the table with numpy, and only the rows of the current page are converted
+    to HTML and sent to the browser, so the cost of a page does not depend on the size of the table.
+    Sorted and filtered row orders are kept, so moving between pages only slices them.
+
+    Parameters
+    ----------
+    table : astropy Table
+        Results to display
+    columns : list
+        Columns to display (Default: None, all columns)
+    page_size : int
+        Number of rows per page (Default: 25)
+    """
+
+    def __init__(self, table, columns=None, page_size=25):
+        self.table = table
+        self.columns = [c for c in (columns if columns is not None else table.colnames) if c in table.colnames]
+        self.page_size = page_size
+        self._text = {}  # lower-case text of the columns, for filtering
+        self._sorted = {}  # sorted row order of each column
+        self._orders = {}  # row orders by (sort, descending, query)
+
+    def __len__(self):
+        return len(self.table)
+
+    def _column_text(self, col):
+        if col not in self._text:
+            values = self.table[col]
+            if values.dtype.kind == 'S':
+                text = np.char.decode(np.asarray(values), 'utf-8')
+            else:
+                text = np.asarray(values).astype(str)
+            self._text[col] = np.char.lower(text)
+        return self._text[col]
+
+    def _sort_index(self, col):
+        if col not in self._sorted:
+            values = self.table[col]
+            if values.dtype.kind == 'S':
+                values = np.char.decode(np.asarray(values), 'utf-8')
+            self._sorted[col] = np.asarray(values.argsort(kind='stable'))
+        return self._sorted[col]
+
+    def rows(self, sort=None, descending=False, query=''):
+        """
+        Row indices of the table, filtered and sorted.
+
+        Parameters
+        ----------
+        sort : str
+            Column to sort by (Default: None, table order)
+        descending : bool
+            Sort in descending order (Default: False)
+        query : str
+            Keep the rows with this text in any of the displayed columns, case-insensitive (Default: '', all rows)
+
+        Returns
+        -------
+        rows : numpy array
+        """
+
+        sort = sort if sort in self.table.colnames else None
+        query = query.strip().lower()
+        key = (sort, bool(descending), query)
+        if key in self._orders:
+            return self._orders[key]
+
+        order = np.arange(len(self.table)) if sort is None else self._sort_index(sort)
+        if descending:
+            order = order[::-1]
+        if query:
+            match = np.zeros(len(self.table), dtype=bool)
+            for col in self.columns:
+                match |= np.char.find(self._column_text(col), query) >= 0
+            order = order[match[order]]
+        self._orders[key] = order
+        return order
+
+    def n_pages(self, n_rows=None):
+        n_rows = len(self.table) if n_rows is None else n_rows
+        return max(int(np.ceil(n_rows / self.page_size)), 1)
+
+    def page(self, number, sort=None, descending=False, query=''):
+        """
+        Rows of a page of the filtered and sorted table.
+
+        Parameters
+        ----------
+        number : int
+            Page number, starting at 0. Out of range numbers are clipped to the first or last page.
+        sort, descending, query
+            See rows
+
+        Returns
+        -------
+        page : astropy Table
+            Displayed columns of the rows of the page
+        first : int
+            Position of the first row of the page in the filtered table
+        n_rows : int
+            Number of rows of the filtered table
+        """
+
+        rows = self.rows(sort, descending, query)
+        number = min(max(int(number), 0), self.n_pages(len(rows)) - 1)
+        first = number * self.page_size
+        return self.table[rows[first:first + self.page_size]][self.columns], first, len(rows)
+
+    def to_html(self, number, sort=None, descending=False, query=''):
+        """
+        HTML of a page, with a summary of the rows shown.
+        """
+
+        page, first, n_rows = self.page(number, sort, descending, query)
+        if n_rows == 0:
+            return '<p>No matching rows.</p>'
+        html = page.to_pandas().to_html(index=False, classes=['table', 'panel-df'])
+        return f'<p>Rows {first + 1} to {first + len(page)} of {n_rows}</p>' + html
+
+    def panel(self):
+        """
+        Panel component with the page, sort and filter controls, updating only the displayed page.
+        """
+
+        sort = pn.widgets.Select(name='Sort by', options=['(none)'] + self.columns, value='(none)')
+        descending = pn.widgets.Checkbox(name='Descending', value=False)
+        query = pn.widgets.TextInput(name='Filter', placeholder='Text in any column', value='')
+        page_size = pn.widgets.Select(name='Rows per page', options=sorted(set(PAGE_SIZES + [self.page_size])),
+                                      value=self.page_size)
+        previous = pn.widgets.Button(name='Previous', width=90)
+        following = pn.widgets.Button(name='Next', width=90)
+        pane = pn.pane.HTML(sizing_mode='stretch_width')
+        state = {'page': 0}
+
+        def settings():
+            return (None if sort.value == '(none)' else sort.value), descending.value, query.value
+
+        def render():
+            n_rows = len(self.rows(*settings()))
+            state['page'] = min(max(state['page'], 0), self.n_pages(n_rows) - 1)
+            pane.object = self.to_html(state['page'], *settings())
+
+        def reset(event):
+            self.page_size = page_size.value
+            state['page'] = 0
+            render()
+
+        def move(step):
+            def callback(event):
+                state['page'] += step
+                render()
+            return callback
+
+        for widget in (sort, descending, query, page_size):
+            widget.param.watch(reset, 'value')
+        previous.on_click(move(-1))
+        following.on_click(move(1))
+        render()
+        return pn.Column(pn.Row(query, sort, descending, page_size), pn.Row(previous, following), pane,
+                         sizing_mode='stretch_width')
@@ -1,10 +1,17 @@
 # Functions to handle the moving target
 
-from astroquery.jplhorizons import Horizons
-from .polygon import check_direction, reverse_direction
+from .polygon import orient_counterclockwise, format_stcs
+from .cache import get_ephemeris_cache, date_to_jd, step_to_days
+from .ephemeris import get_engine
+from .metrics import span, timed
+from .spherical import lonlat_to_xyz, xyz_to_lonlat, to_tangent_plane, from_tangent_plane, _normalize, _angle
 import time
+import numpy as np
+from astropy.table import vstack
 from datetime import timedelta, datetime
-from shapely.geometry import LineString
+from shapely.geometry import LineString, Polygon
+
+ADAPTIVE_STEP = 'auto'  # time step requesting adaptive sampling, see adaptive_path
 
 
 def check_times(times, maximum_date_range=30):
@@ -41,7 +48,7 @@ def check_times(times, maximum_date_range=30):
         raise Exception("Sorry, enter time as float or dict")
 
 
-def get_path(obj_name, times, id_type='smallbody', location=None):
+def get_path(obj_name, times, id_type='smallbody', location=None, cache=True, engine=None):
     """
 
     # See more details at https://astroquery.readthedocs.io/en/latest/jplhorizons/jplhorizons.html
@@ -78,6 +85,15 @@ def get_path(obj_name, times, id_type='smallbody', location=None):
        Hubble: @hst
        Kepler: 500@-227
 
+    cache: bool or EphemerisCache
+       Cache to use for the ephemerides. True (default) uses the process-wide cache,
+       False disables caching. Only results from remote engines are cached.
+       Identical requests made at the same time are coalesced into a single fetch.
+
+    engine: HorizonsEngine or KeplerEngine
+       Ephemeris engine to use. Default of None uses JPL Horizons.
+       A KeplerEngine computes the ephemerides locally from orbital elements.
+
     Returns
     -------
     eph: Astropy table
@@ -85,19 +101,266 @@ def get_path(obj_name, times, id_type='smallbody', location=None):
 
     """
 
-    obj = Horizons(id=obj_name, location=location, id_type=id_type, epochs=times)
-    eph = obj.ephemerides()
+    engine = get_engine(engine)
+    if cache is True:
+        cache = get_ephemeris_cache()
+    if cache is False or not engine.remote:
+        cache = None
+
+    def ephemerides():
+        with span('ephemerides', engine=type(engine).__name__) as stage:
+            eph = engine.ephemerides(obj_name, times, id_type=id_type, location=location)
+            stage.set(rows=len(eph))
+        return eph
+
+    def fetch():
+        eph = cache.lookup(obj_name, times, id_type=id_type, location=location)
+        if eph is None:
+            eph = ephemerides()
+            cache.store(obj_name, times, eph, id_type=id_type, location=location)
+        return eph
+
+    with span('get_path', obj_name=str(obj_name)) as stage:
+        if cache is None:
+            eph = ephemerides()
+        else:
+            # Concurrent identical requests (eg, from several dashboard sessions) share a single fetch
+            eph = cache.coalesce(cache.key(obj_name, times, id_type=id_type, location=location), fetch)
+        stage.set(rows=len(eph))
+    return eph
+
+
+def path_velocities(eph):
+    """
+    Sky velocities of the target as vectors tangent to the unit sphere, from the RA_rate (which includes
+    cos(Dec), as in JPL Horizons) and DEC_rate columns in arcsec/hour.
+
+    Parameters
+    ----------
+    eph: astropy Table
+        Ephemerides with RA, DEC, RA_rate and DEC_rate
+
+    Returns
+    -------
+    velocities: numpy array
+        Velocities in radians per day, shape (N, 3)
+    """
+
+    ra = np.radians(np.asarray(eph['RA'], dtype=float))
+    dec = np.radians(np.asarray(eph['DEC'], dtype=float))
+    to_radians_per_day = np.radians(24. / 3600)
+    ra_rate, dec_rate = [np.ma.filled(np.ma.asarray(eph[col], dtype=float), np.nan) * to_radians_per_day
+                         for col in ('RA_rate', 'DEC_rate')]
+    east = np.stack([-np.sin(ra), np.cos(ra), np.zeros_like(ra)], axis=-1)
+    north = np.stack([-np.sin(dec) * np.cos(ra), -np.sin(dec) * np.sin(ra), np.cos(dec)], axis=-1)
+    return ra_rate[:, np.newaxis] * east + dec_rate[:, np.newaxis] * north
+
+
+def chord_errors(eph):
+    """
+    Estimated distance between the straight path joining consecutive ephemerides and the true path.
+
+    Each interval is modelled as the cubic Hermite curve through the end positions with the end velocities
+    (see path_velocities). The error is the larger of the distance between the chord and the curve at
+    the middle of the interval, and the mismatch between the displacement and the one predicted by
+    the velocities, which flags intervals too long for the cubic model to be trusted.
+
+    Parameters
+    ----------
+    eph: astropy Table
+        Ephemerides sorted by time, with RA, DEC, RA_rate, DEC_rate and datetime_jd
+
+    Returns
+    -------
+    errors: numpy array
+        Error of each of the len(eph) - 1 intervals in degrees, NaN rates giving infinite errors
+    """
+
+    xyz = lonlat_to_xyz(eph['RA'], eph['DEC']).reshape(-1, 3)
+    velocities = path_velocities(eph)
+    h = np.diff(np.asarray(eph['datetime_jd'], dtype=float))[:, np.newaxis]
+
+    middle = (xyz[:-1] + xyz[1:]) / 2
+    curve = _normalize(middle + h / 8 * (velocities[:-1] - velocities[1:]))
+    deviation = _angle(_normalize(middle), curve)
+    mismatch = np.linalg.norm(xyz[1:] - xyz[:-1] - h * (velocities[:-1] + velocities[1:]) / 2, axis=-1)
+    errors = np.degrees(np.maximum(deviation, mismatch))
+    return np.where(np.isfinite(errors), errors, np.inf)
+
+
+def adaptive_path(obj_name, times, radius=0.0083, tolerance=0.25, id_type='smallbody', location=None,
+                  max_step='5d', min_step='10m', max_epochs=200, max_iterations=10, cache=True, engine=None,
+                  verbose=False):
+    """
+    Ephemerides sampled just finely enough for the straight path between samples to stay within
+    tolerance * radius of the true path (see chord_errors), instead of at a fixed step.
+
+    The time range is first sampled every max_step. Intervals whose estimated error is too large are then
+    split, with more pieces for larger errors, and the new epochs fetched together, until all the intervals
+    are accurate or min_step long. Slow, distant targets get few samples; fast or curving paths (eg,
+    near-Earth objects) are sampled finely only where needed.
+
+    Parameters
+    ----------
+    obj_name: str
+        Object name, see get_path
+    times: dict
+        Time range with start and stop (example: {'start':'2019-01-01', 'stop':'2019-01-31'}), any step is ignored
+    radius: float
+        Width of the path in degrees, as given to convert_path_to_polygon (Default: 0.0083)
+    tolerance: float
+        Maximum path error as a fraction of radius (Default: 0.25)
+    id_type: str
+        Object ID type for JPL Horizons, see get_path
+    location: str
+        Observer location, see get_path
+    max_step: str
+        Initial sampling, as used by JPL Horizons (Default: 5d)
+    min_step: str
+        Shortest interval between samples (Default: 10m)
+    max_epochs: int
+        Maximum number of epochs per ephemerides request (Default: 200)
+    max_iterations: int
+        Maximum number of refinements (Default: 10)
+    cache: bool or EphemerisCache
+        Cache to use for the ephemerides, see get_path (Default: True)
+    engine: HorizonsEngine or KeplerEngine
+        Ephemeris engine, see get_path. Its ephemerides must include RA_rate and DEC_rate. (Default: None)
+    verbose: bool
+        Report the number of samples and refinements. (Default: False)
+
+    Returns
+    -------
+    eph: astropy Table
+        Ephemerides sorted by time
+    """
+
+    start, stop = date_to_jd(times['start']), date_to_jd(times['stop'])
+    if start is None or stop is None:
+        raise ValueError(f"Unable to interpret start/stop times: {times['start']}, {times['stop']}")
+    longest, shortest = step_to_days(max_step), step_to_days(min_step)
+    if longest is None or shortest is None:
+        raise ValueError(f'Unable to interpret steps: {max_step}, {min_step}')
+    limit = tolerance * radius
+
+    def fetch(jd):
+        tables = [get_path(obj_name, jd[i:i + max_epochs].tolist(), id_type=id_type, location=location,
+                           cache=cache, engine=engine) for i in range(0, len(jd), max_epochs)]
+        return vstack(tables, metadata_conflicts='silent')
+
+    with span('adaptive_path', obj_name=str(obj_name)) as stage:
+        eph = fetch(np.linspace(start, stop, max(int(np.ceil((stop - start) / longest - 1e-9)), 1) + 1))
+        if len(eph) > 1 and ('RA_rate' not in eph.colnames or 'DEC_rate' not in eph.colnames):
+            raise ValueError('Adaptive sampling needs the RA_rate and DEC_rate columns of the ephemerides')
+
+        iteration = 0
+        while len(eph) > 1 and iteration < max_iterations:
+            jd = np.asarray(eph['datetime_jd'], dtype=float)
+            h = np.diff(jd)
+            errors = chord_errors(eph)
+
+            # Chord errors shrink with the square of the interval, split accordingly
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pieces = np.ceil(np.sqrt(errors / limit))
+            pieces = np.minimum(np.nan_to_num(pieces, posinf=16), 16)
+            pieces = np.minimum(pieces, np.floor(h / shortest)).astype(int)
+            split = np.where(pieces >= 2)[0]
+            if len(split) == 0:
+                break
+            new = np.concatenate([jd[i] + h[i] * np.arange(1, pieces[i]) / pieces[i] for i in split])
+            eph = vstack([eph, fetch(new)], metadata_conflicts='silent')
+            eph.sort('datetime_jd')
+            iteration += 1
+
+        worst = float(np.max(chord_errors(eph))) if len(eph) > 1 else 0.
+        stage.set(rows=len(eph), refinements=iteration)
+    if verbose:
+        print(f'{len(eph)} ephemerides after {iteration} refinements, '
+              f'largest path error {worst * 3600:.2f} arcsec (tolerance {limit * 3600:.2f} arcsec)')
+    if worst > limit:
+        print(f'WARNING: Path error of {worst * 3600:.2f} arcsec exceeds the tolerance of {limit * 3600:.2f} arcsec')
     return eph
 
 
-def convert_path_to_polygon(eph, radius=0.0083):
+def buffer_path(path, radius, max_vertices=None, resolution=8, iterations=20):
+    """
+    Buffer a path into a polygon, optionally within a vertex budget.
+
+    To meet the budget, the path is simplified with a tolerance and buffered by radius plus that tolerance
+    with mitred joins and square caps, which guarantees the polygon still contains the round buffer of the
+    original path. The smallest tolerance meeting the budget is found by bisection.
+
+    Parameters
+    ----------
+    path : shapely LineString
+        Path to buffer
+    radius : float
+        Width of the path in degrees
+    max_vertices : int
+        Maximum number of vertices (Default: None, no budget)
+    resolution : int
+        Number of segments per quarter circle of the round buffer (Default: 8)
+    iterations : int
+        Number of bisection steps for the tolerance (Default: 20)
+
+    Returns
+    -------
+    polygon : shapely Polygon
+        Buffered path, without holes
+    inflation : float
+        Fractional increase in area relative to the round buffer of the original path (eg, 0.05 for 5%)
+    """
+
+    polygon = Polygon(path.buffer(distance=radius, resolution=resolution).exterior)
+    if max_vertices is None or len(polygon.exterior.coords) - 1 <= max_vertices:
+        return polygon, 0.
+
+    def conservative(tolerance):
+        simple = path.simplify(tolerance, preserve_topology=True)
+        return Polygon(simple.buffer(radius + tolerance, cap_style=3, join_style=2, mitre_limit=2.).exterior)
+
+    def n_vertices(p):
+        return len(p.exterior.coords) - 1
+
+    # Find a tolerance that meets the budget, then bisect for the smallest one
+    minx, miny, maxx, maxy = path.bounds
+    low, high = 0., max(maxx - minx, maxy - miny, radius) * 1e-3
+    best = conservative(low)
+    while n_vertices(best) > max_vertices and high < 2 * max(maxx - minx, maxy - miny, radius):
+        candidate = conservative(high)
+        if n_vertices(candidate) <= max_vertices:
+            best = candidate
+            break
+        low, high = high, high * 2
+
+    if n_vertices(best) > max_vertices:
+        print(f'WARNING: Unable to simplify polygon to {max_vertices} vertices')
+    elif low < high:
+        for _ in range(iterations):
+            middle = (low + high) / 2
+            candidate = conservative(middle)
+            if n_vertices(candidate) <= max_vertices:
+                best, high = candidate, middle
+            else:
+                low = middle
+
+    return best, best.area / polygon.area - 1
+
+
+@timed()
+def convert_path_to_polygon(eph, radius=0.0083, max_vertices=None, verbose=False):
     """
 
     Parameters
     ----------
     eph
     radius : float
-        Width of path to build in arcseconds
+        Width of path to build in degrees
+    max_vertices : int
+        Maximum number of vertices of the polygon. The polygon is simplified conservatively to meet the budget,
+        so it still contains the whole buffered path. (Default: None, no simplification)
+    verbose : bool
+        Report the area increase of the simplified polygon. (Default: False)
 
     Returns
     -------
@@ -105,22 +368,74 @@ def convert_path_to_polygon(eph, radius=0.0083):
         Polygon constructed from path
     """
 
-    # Use shapely to better construct the polygon
-    path_tuple = [(row['RA'], row['DEC']) for row in eph]
-    path = LineString(path_tuple)
-    thick_path = path.buffer(distance=radius, resolution=8)
-    coords = thick_path.exterior.coords[:-1]
+    ra = np.asarray(eph['RA'], dtype=float)
+    dec = np.asarray(eph['DEC'], dtype=float)
 
-    stcs = 'POLYGON '
-    stcs += ' '.join([f'{c[0]} {c[1]}' for c in coords])
+    # Build the polygon in the plane tangent at the path center, where the path has no RA wraparound
+    # or pole distortion. The width is enlarged to stay at least radius at the edges of the projection.
+    xyz = lonlat_to_xyz(ra, dec).reshape(-1, 3)
+    center = np.mean(xyz, axis=0)
+    center_ra, center_dec = xyz_to_lonlat(center / np.linalg.norm(center))
+    spread = np.max(np.arccos(np.clip(xyz @ (center / np.linalg.norm(center)), -1, 1)))
+    tangent = spread < np.radians(60)
+    if tangent:
+        x, y = to_tangent_plane(ra, dec, center_ra, center_dec)
+        width = np.degrees(np.tan(np.radians(radius))) / np.cos(spread) ** 2
+    else:
+        # Very long paths: RA/Dec plane, with RA unwrapped to be continuous
+        x, y = np.degrees(np.unwrap(np.radians(ra))), dec
+        width = radius
 
-    # Check winding direction, these need to be counter-clockwise
-    if not check_direction(stcs):
-        stcs = reverse_direction(stcs)
+    # Use shapely to better construct the polygon
+    path = LineString(list(zip(x, y)))
+    thick_path, inflation = buffer_path(path, width, max_vertices=max_vertices, resolution=8)
+    if verbose and max_vertices is not None:
+        print(f'Polygon with {len(thick_path.exterior.coords) - 1} vertices, area increased by {inflation:.1%}')
+    coords = np.array(thick_path.exterior.coords[:-1])
+    if tangent:
+        poly_ra, poly_dec = from_tangent_plane(coords[:, 0], coords[:, 1], center_ra, center_dec)
+    else:
+        poly_ra, poly_dec = coords[:, 0] % 360, coords[:, 1]
+
+    # Winding direction needs to be counter-clockwise
+    poly_ra, poly_dec = orient_counterclockwise(poly_ra, poly_dec)
+    stcs = format_stcs(poly_ra, poly_dec)
 
     return stcs
 
 
+def split_path(eph, max_days=5.):
+    """
+    Split an ephemerides path into consecutive time segments.
+    Segments share their end points so together they cover the whole path.
+
+    Parameters
+    ----------
+    eph: astropy Table
+        Ephemerides, sorted by time
+    max_days: float
+        Maximum duration of each segment in days (Default: 5)
+
+    Returns
+    -------
+    segments: list
+        List of astropy Tables with at least two rows each (unless eph has a single row)
+    """
+
+    if len(eph) <= 2 or max_days is None:
+        return [eph]
+
+    jd = np.asarray(eph['datetime_jd'], dtype=float)
+    segments = []
+    start = 0
+    while start < len(eph) - 1:
+        stop = np.searchsorted(jd, jd[start] + max_days, side='right') - 1
+        stop = min(max(stop, start + 1), len(eph) - 1)
+        segments.append(eph[start:stop + 1])
+        start = stop
+    return segments
+
+
 def check(date):
     try:
         _ = time.strptime(date, '%Y-%m-%d')
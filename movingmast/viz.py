@@ -1,10 +1,82 @@
 # Functions for handling Jupiter visualizations
 
+import io
+import asyncio
 import panel as pn
 import param
-from movingmast.mast_tap import run_tap_query, get_files
-from movingmast.target import get_path, convert_path_to_polygon, check_times
+from astropy.table import Table, vstack
+from movingmast.mast_tap import (iter_tap_query, iter_chunked_tap_query, fetch_columns, get_files, add_time_columns,
+                                 clean_up_results, DERIVED_COLUMNS)
+from movingmast.target import get_path, adaptive_path, convert_path_to_polygon, check_times, ADAPTIVE_STEP
 from movingmast.plotting import polygon_bokeh, mast_bokeh
+from movingmast.jobs import get_job_manager, CANCELLED, ERROR
+from movingmast.tables import ResultTable
+from movingmast.products import download_script
+from movingmast.metrics import span
+
+
+# Background jobs of the dashboard, run by the process-wide JobManager
+# Each job is timed as a dashboard stage, see movingmast.metrics
+def _ephem_job(job, obj_name, times, id_type, location, radius):
+    with span('dashboard_ephemerides', obj_name=obj_name):
+        job.update(f'Fetching ephemerides of {obj_name}...')
+        if times['step'].strip().lower() == ADAPTIVE_STEP:
+            # Sampled according to the target motion, accurate to a fraction of the radius
+            eph = adaptive_path(obj_name, times, radius=radius, id_type=id_type, location=location)
+        else:
+            eph = get_path(obj_name, times, id_type=id_type, location=location)
+        job.update(f'Fetched {len(eph)} ephemerides, building the search polygon...')
+        stcs = convert_path_to_polygon(eph, radius=radius)
+    return eph, stcs
+
+
+def _mast_job(job, eph, stcs, radius, maxrec, mission, columns, no_time=False, target=None, display_columns=None):
+    def progress(done, total, n_records):
+        job.update(f'Querying MAST: {done} of {total} segments done, {n_records} records so far...',
+                   done=done, total=total)
+
+    job.update('Querying MAST...')
+    with span('dashboard_mast', maxrec=maxrec) as stage:
+        # Get MAST results, if the debug option for no time is on, it will include a time search
+        if no_time:
+            stream = iter_tap_query(stcs, start_time=None, end_time=None, max_records=maxrec, mission=mission,
+                                    columns=columns)
+        else:
+            stream = iter_chunked_tap_query(eph, radius=radius, max_records=maxrec, mission=mission,
+                                            columns=columns, progress=progress)
+        # Only the latest page is published while streaming, the pages are stacked once at the end
+        chunks = []
+        n_records = 0
+        for chunk in stream:
+            chunks.append(chunk)
+            n_records += len(chunk)
+            if no_time:
+                job.update(f'Querying MAST: {n_records} records so far...', partial=chunk)
+            else:
+                job.update(partial=chunk)
+        results = vstack(chunks, metadata_conflicts='silent') if len(chunks) > 0 else Table()
+        if target is not None and not no_time and len(results) > 0:
+            # Path of the target over each exposure intersected with the footprint, see clean_up_results
+            job.update(f'Verifying the footprints of {len(results)} MAST records...')
+            with span('dashboard_verify', rows=len(results)):
+                results = clean_up_results(results, target['obj_name'], orig_eph=eph, id_type=target['id_type'],
+                                           location=target['location'], radius=radius, swept=True)
+        missing = [c for c in display_columns or [] if c not in results.colnames and c not in DERIVED_COLUMNS]
+        if len(missing) > 0 and len(results) > 0:
+            # Displayed columns not queried, fetched for the remaining rows only
+            job.update(f'Fetching {len(missing)} more columns for {len(results)} MAST records...')
+            results = fetch_columns(results, missing)
+        if len(results) > 0:
+            results.sort('t_min')
+        add_time_columns(results)
+        stage.set(rows=len(results))
+    return results
+
+
+def _products_job(job, results, obs_ids):
+    job.update('Fetching the list of MAST files...')
+    with span('dashboard_products'):
+        return get_files(results, obs_ids)
 
 
 class MastQuery(param.Parameterized):
@@ -12,34 +84,33 @@ class MastQuery(param.Parameterized):
     def __init__(self, data_tables=False):
         self.data_tables = data_tables
         self.width = 900
-        if data_tables:
-            self.script = """
-            <script>
-            $(document).ready( function () {
-                $('table').DataTable();
-            } );
-            </script>
-            """
+        self.max_days = 365  # longer searches are split into segments, see iter_chunked_tap_query
+        self.page_size = 25 if data_tables else 10
+        self._jobs = {}  # latest background job of each kind, see movingmast.jobs
+        self._target = None  # obj_name, id_type and location of the ephemerides
         super().__init__()
 
     # Global variables
     eph = param.Parameter(default=None, doc="eph table")
     stcs = param.Parameter(default=None, doc="polygon")
     results = param.Parameter(default=None, doc="MAST Results")
+    products = param.Parameter(default=None, doc="MAST Files")
 
     # Widgets
     obj_name = pn.widgets.TextInput(name="Object Name or Specification", value='')
     start_time = pn.widgets.TextInput(name="Start Time", value='1995-07-17')
     stop_time = pn.widgets.TextInput(name="Stop Time", value='1995-07-30')
-    time_step = pn.widgets.TextInput(name="Time Step (eg, 12h, 1d)", value='1d')
+    time_step = pn.widgets.TextInput(name="Time Step (eg, 12h, 1d, or auto to follow the target motion)",
+                                     value='1d')
     id_type = pn.widgets.Select(name='Object Type', options=['majorbody', 'smallbody', 'asteroid_name',
                                                              'comet_name', 'name', 'designation'])
-    max_rec = pn.widgets.TextInput(name="Maximum number of MAST records", value='200')
+    max_rec = pn.widgets.TextInput(name="Maximum number of MAST records (None for all)", value='200')
     mission = pn.widgets.TextInput(name="Comma-separated mission filter (Default of None=all missions)", value='None')
     radius = pn.widgets.TextInput(name="Footprint radius/width (degrees)", value='0.0083')
     location = pn.widgets.TextInput(name="User location (Default of None=geocentric)", value='None')
     obs_ids = pn.widgets.TextInput(name="Comma-separated observations to search files for (obs_id)", value='')
     no_time = pn.widgets.Checkbox(name="Ignore time in MAST query (will yield incorrect results)", value=False)
+    verify = pn.widgets.Checkbox(name="Verify the target is in the footprint during each exposure", value=False)
 
     # Column selector
     eph_cols = ['targetname', 'datetime_str', 'datetime_jd', 'RA', 'DEC',
@@ -88,75 +159,144 @@ class MastQuery(param.Parameterized):
     tap_button = param.Action(lambda x: x.param.trigger('tap_button'), label='Fetch MAST Results')
     product_button = param.Action(lambda x: x.param.trigger('product_button'), label='Fetch MAST Files')
     full_run = param.Action(lambda x: x.param.trigger('full_run'), label='Search MAST')
+    cancel_button = param.Action(lambda x: x._cancel_jobs(), label='Cancel')
 
     # Callback functions
+    def _cancel_jobs(self):
+        for job in self._jobs.values():
+            job.cancel()
+
+    def _progress(self, job):
+        # Progress message, bar and cancel button of a running job
+        fraction = job.fraction
+        bar = pn.indicators.Progress(value=-1 if fraction is None else int(100 * fraction), max=100,
+                                     active=fraction is None, sizing_mode='stretch_width')
+        return pn.Column(pn.pane.Markdown(f'{job.message}'), bar, self.param['cancel_button'])
+
+    async def _follow(self, job, interval=0.5):
+        # Progress display until the job finishes, without blocking the server
+        while not job.finished:
+            yield self._progress(job)
+            await asyncio.sleep(interval)
+
+    def _table(self, table, cols):
+        # Paginated table: sorting and filtering run on the server, only the current page is sent
+        return ResultTable(table, cols, page_size=self.page_size).panel()
+
+    @staticmethod
+    def _failure(job):
+        if job.status == CANCELLED:
+            return pn.pane.Markdown('Search cancelled.')
+        if job.status == ERROR:
+            return pn.pane.Markdown(f'{job.error}')
+        return None
+
     @param.depends('ephem_button', 'full_run')
-    def get_ephem(self):
+    async def get_ephem(self):
         if self.obj_name.value == '':
             self.eph = None
             self.stcs = None
-            return pn.pane.Markdown('Provide the name or identifier of an object to search for.')
+            yield pn.pane.Markdown('Provide the name or identifier of an object to search for.')
+            return
         times = {'start': self.start_time.value, 'stop': self.stop_time.value, 'step': self.time_step.value}
-        if not check_times(times, maximum_date_range=30):
+        if not check_times(times, maximum_date_range=self.max_days):
             self.eph = None
             self.stcs = None
-            return pn.pane.Markdown('Invalid date strings (Year-month-day) or time range exceeds maximum (30 days).')
+            yield pn.pane.Markdown(f'Invalid date strings (Year-month-day) or time range exceeds maximum '
+                                   f'({self.max_days} days).')
+            return
         try:
             radius = float(self.radius.value)
-            location = self.location.value
-            if location.lower() == 'none':
-                location = None
-            self.eph = get_path(self.obj_name.value, times, id_type=self.id_type.value, location=location)
-            self.stcs = convert_path_to_polygon(self.eph, radius=radius)
-            self.results = None
         except ValueError as e:
-            return pn.pane.Markdown(f'{e}')
+            yield pn.pane.Markdown(f'{e}')
+            return
+        location = self.location.value
+        if location.lower() == 'none':
+            location = None
+        target = {'obj_name': self.obj_name.value, 'id_type': self.id_type.value, 'location': location}
+        job = get_job_manager().submit(_ephem_job, self.obj_name.value, times, self.id_type.value, location,
+                                       radius, name=f'Ephemerides of {self.obj_name.value}')
+        self._jobs['ephem'] = job
+        async for pane in self._follow(job):
+            yield pane
+        failure = self._failure(job)
+        if failure is not None:
+            yield failure
+            return
+        self.eph, self.stcs = job.result
+        self._target = target
+        self.results = None
 
         # Display results, if available
         if self.eph is not None and len(self.eph) > 0:
-            cols = self.eph_col_choice.value
-            if self.data_tables:
-                html = self.eph[cols].to_pandas().to_html(index=False, classes=['table', 'panel-df'])
-                return pn.pane.HTML(html + self.script, sizing_mode='stretch_width')
-            else:
-                return self.eph[cols].show_in_notebook(display_length=10)
+            yield self._table(self.eph, self.eph_col_choice.value)
         else:
-            return pn.pane.Markdown('No results found.')
+            yield pn.pane.Markdown('No results found.')
+
+    # Columns queried, needed by mast_bokeh, get_files and the verification.
+    # Other displayed columns are fetched for the verified rows, see _mast_job
+    plot_cols = ['obs_id', 'obsID', 'obs_collection', 'instrument_name', 'target_name', 'proposal_pi', 'filters',
+                 's_region']
+
+    def _mast_table(self, results):
+        if 'obs_mid_date' not in results.colnames:
+            # Dates of a page being streamed, not in place since the page is stacked with the others later
+            results = add_time_columns(results.copy(copy_data=False))
+        return self._table(results, self.mast_col_choice.value)
 
     @param.depends('tap_button', 'full_run')
-    def get_mast(self):
+    async def get_mast(self):
+        # Wait for the ephemerides of a full run
+        ephem_job = self._jobs.get('ephem')
+        if ephem_job is not None and not ephem_job.finished:
+            yield pn.pane.Markdown('Waiting for the ephemerides...')
+            await ephem_job.wait()
         if self.eph is None or self.stcs is None:
-            return pn.pane.Markdown('Fetch ephemerides first and then run the MAST query.')
-        start_time = min(self.eph['datetime_jd']) - 2400000.5
-        end_time = max(self.eph['datetime_jd']) - 2400000.5
+            yield pn.pane.Markdown('Fetch ephemerides first and then run the MAST query.')
+            return
         try:
-            maxrec = int(self.max_rec.value)
-            location = self.location.value
-            mission = self.mission.value
-            if location.lower() == 'none':
-                location = None
-            if mission.lower() == 'none':
-                mission = None
-            # Get MAST results, if the debug option for no time is on, it will include a time search
-            if self.no_time.value:
-                self.results = run_tap_query(self.stcs, start_time=None, end_time=None, maxrec=maxrec, mission=mission)
+            maxrec = None if self.max_rec.value.lower() in ('', 'none') else int(self.max_rec.value)
+            radius = float(self.radius.value)
+        except ValueError as e:
+            yield pn.pane.Markdown(f'{e}')
+            return
+        mission = self.mission.value
+        if mission.lower() == 'none':
+            mission = None
+        target = self._target if self.verify.value else None
+        job = get_job_manager().submit(_mast_job, self.eph, self.stcs, radius, maxrec, mission, self.plot_cols,
+                                       self.no_time.value, target, list(self.mast_col_choice.value),
+                                       name='MAST search')
+        self._jobs['mast'] = job
+
+        # Results are streamed in pages, showing the latest page until all of them have arrived
+        shown = None
+        while not job.finished:
+            partial = job.partial
+            if partial is not None and partial is not shown:
+                shown = partial
+                table = pn.Column(pn.pane.Markdown('Latest page of MAST records:'), self._mast_table(partial))
+            if shown is None:
+                yield self._progress(job)
             else:
-                self.results = run_tap_query(self.stcs, start_time=start_time, end_time=end_time,
-                                             maxrec=maxrec, mission=mission)
-                # Removing clean_up_results call: this was buggy and is removing valid results
-        except Exception as e:
-            return pn.pane.Markdown(f'{e}')
+                yield pn.Column(self._progress(job), table)
+            await asyncio.sleep(0.5)
+        failure = self._failure(job)
+        if failure is not None:
+            yield failure
+            return
+        self.results = job.result
 
         # Display results, if available
         if self.results is not None and len(self.results) > 0:
-            cols = self.mast_col_choice.value
-            if self.data_tables:
-                html = self.results[cols].to_pandas().to_html(index=False, classes=['table', 'panel-df'])
-                return pn.pane.HTML(html + self.script, sizing_mode='stretch_width')
+            table = self._mast_table(self.results)
+            if maxrec is not None and len(self.results) >= maxrec:
+                yield pn.Column(pn.pane.Markdown(f'Showing the first {maxrec} MAST records, increase the maximum '
+                                                 f'number of records (or use None) to get all of them.'), table)
             else:
-                return self.results[cols].show_in_notebook(display_length=10)
+                yield table
         else:
-            return pn.pane.Markdown('No results found.')
+            yield pn.pane.Markdown('No results found.')
 
     @param.depends('stcs')
     def fetch_stcs(self):
@@ -167,29 +307,39 @@ class MastQuery(param.Parameterized):
                          pn.pane.Bokeh(p))
 
     @param.depends('product_button')
-    def get_products(self):
+    async def get_products(self):
         if self.eph is None or self.results is None:
-            return pn.pane.Markdown('Fetch ephemerides first and then run the MAST query.')
+            yield pn.pane.Markdown('Fetch ephemerides first and then run the MAST query.')
+            return
         if len(self.results) == 0:
-            return pn.pane.Markdown(f'No MAST results to get.')
+            yield pn.pane.Markdown(f'No MAST results to get.')
+            return
         if self.obs_ids.value is None or self.obs_ids.value == '':
-            return pn.pane.Markdown(f'No observations selected.')
-        file_list = get_files(self.results, self.obs_ids.value)
+            yield pn.pane.Markdown(f'No observations selected.')
+            return
+        job = get_job_manager().submit(_products_job, self.results, self.obs_ids.value, name='MAST files')
+        self._jobs['products'] = job
+        async for pane in self._follow(job):
+            yield pane
+        failure = self._failure(job)
+        if failure is not None:
+            yield failure
+            return
+        file_list = job.result
+        self.products = file_list
 
         # Display results, if available
         if file_list is not None and len(file_list) > 0:
-            cols = self.product_col_choice.value
-            if self.data_tables:
-                # file_list['Download'] = [f'<a href="https://mast.stsci.edu/portal/api/' \
-                #                          f'v0.1/Download/file?uri={x}">Download</a>'
-                #                          for x in file_list['dataURI']]
-                # cols = ['Download'] + cols
-                html = file_list[cols].to_pandas().to_html(index=False, classes=['table', 'panel-df'])
-                return pn.pane.HTML(html + self.script, sizing_mode='stretch_width')
-            else:
-                return file_list[cols].show_in_notebook(display_length=10)
+            # file_list['Download'] = [f'<a href="https://mast.stsci.edu/portal/api/' \
+            #                          f'v0.1/Download/file?uri={x}">Download</a>'
+            #                          for x in file_list['dataURI']]
+            # Files are downloaded by the browser user with a script, never written on the server
+            script = pn.widgets.FileDownload(callback=lambda: io.StringIO(download_script(file_list)),
+                                             filename='mast_download.sh', label='Download script (curl)',
+                                             button_type='primary')
+            yield pn.Column(self._table(file_list, self.product_col_choice.value), script)
         else:
-            return pn.pane.Markdown('No results found.')
+            yield pn.pane.Markdown('No results found.')
 
     @param.depends('eph', 'stcs', 'results')
     def mast_figure(self):
@@ -198,14 +348,15 @@ class MastQuery(param.Parameterized):
         if len(self.results) == 0:
             return pn.pane.Markdown(f'No MAST results to display.')
         try:
-            p = mast_bokeh(self.eph, self.results, self.stcs, display=False)
+            with span('dashboard_figure', rows=len(self.results)):
+                p = mast_bokeh(self.eph, self.results, self.stcs, display=False)
         except Exception as e:
             return pn.pane.Markdown(f'{e}')
         return pn.pane.Bokeh(p)
 
     # Panel displays
     def additional_parameters(self):
-        return pn.Column(self.time_step, self.max_rec, self.mission, self.radius, self.location)
+        return pn.Column(self.time_step, self.max_rec, self.mission, self.radius, self.location, self.verify)
 
     def panel(self, debug=False):
         title = pn.pane.Markdown("""
@@ -241,7 +392,8 @@ class MastQuery(param.Parameterized):
                               ('MAST Plot', self.mast_figure),
                               ('MAST Files', pn.Column(self.obs_ids, self.product_col_choice,
                                                        self.param['product_button'],
-                                                       self.get_products, width=self.width, sizing_mode='stretch_width')),
+                                                       self.get_products,
+                                                       width=self.width, sizing_mode='stretch_width')),
                               ('Additional Parameters', self.additional_parameters)
                               )
         if debug:
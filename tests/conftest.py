@@ -0,0 +1,38 @@
+# Shared fixtures: a synthetic path and the local stand-in TAP service, no network access needed
+
+import pytest
+from astropy.time import Time
+from movingmast.target import get_path, convert_path_to_polygon
+from movingmast.local_services import FixtureEngine, LocalTapService, synthetic_observations
+
+TARGET = {'obj_name': '1143', 'id_type': 'smallbody', 'start': '2015-08-20', 'stop': '2015-09-01'}
+RADIUS = 0.2
+
+
+@pytest.fixture(scope='session')
+def engine():
+    return FixtureEngine()
+
+
+@pytest.fixture(scope='session')
+def eph(engine):
+    times = {'start': TARGET['start'], 'stop': TARGET['stop'], 'step': '6h'}
+    return get_path(TARGET['obj_name'], times, id_type=TARGET['id_type'], cache=False, engine=engine)
+
+
+@pytest.fixture(scope='session')
+def catalog(eph):
+    return synthetic_observations(eph, 300, radius=RADIUS, on_path=0.8, missions=['HST', 'K2'], seed=1)
+
+
+@pytest.fixture(scope='session')
+def tap_service(catalog):
+    with LocalTapService(catalog) as tap:
+        yield tap
+
+
+@pytest.fixture(scope='session')
+def search(eph):
+    # Arguments of run_tap_query/iter_tap_query for the path
+    return {'stcs': convert_path_to_polygon(eph, radius=RADIUS), 'start_time': Time(TARGET['start']).mjd,
+            'end_time': Time(TARGET['stop']).mjd}
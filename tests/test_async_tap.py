@@ -0,0 +1,79 @@
+# Tests of the asynchronous (UWS) TAP client against the local stand-in service
+
+import time
+import asyncio
+import numpy as np
+import pytest
+from movingmast.async_tap import AsyncTapClient, run_coroutine
+from movingmast.mast_tap import build_tap_query, run_tap_query, run_tap_queries, run_tap_queries_async
+from movingmast.local_services import LocalTapService
+
+
+def test_gather_runs_jobs_and_deletes_them(tap_service, search):
+    queries = [build_tap_query(maxrec=n, **search) for n in (5, 10, 20)]
+    client = AsyncTapClient(tap_service.url, poll_interval=0.01)
+    tables = run_coroutine(client.gather(queries, maxrec=100))
+    assert [len(t) for t in tables] == [5, 10, 20]
+    assert len(tap_service._jobs) == 0
+
+
+def test_failed_job_raises(tap_service):
+    client = AsyncTapClient(tap_service.url, poll_interval=0.01)
+    with pytest.raises(Exception):
+        run_coroutine(client.query('SELECT * FROM missing_table WHERE'))
+    errors = run_coroutine(client.gather(['SELECT * FROM missing_table WHERE'], return_exceptions=True))
+    assert isinstance(errors[0], Exception)
+    assert len(tap_service._jobs) == 0
+
+
+def test_jobs_run_concurrently(catalog, search):
+    queries = [build_tap_query(maxrec=n, **search) for n in (5, 6, 7, 8)]
+    with LocalTapService(catalog, latency=0.1) as tap:
+        elapsed = {}
+        for workers in (1, 4):
+            client = AsyncTapClient(tap.url, max_concurrent=workers, poll_interval=0.01)
+            start = time.perf_counter()
+            run_coroutine(client.gather(queries))
+            elapsed[workers] = time.perf_counter() - start
+    assert elapsed[4] < 0.5 * elapsed[1]
+
+
+def test_run_tap_queries_matches_sync_queries(tap_service, search):
+    searches = [search, {**search, 'mission': 'HST'}]
+    tables = run_tap_queries(searches, service=tap_service.url, maxrec=1000, cache=False)
+    for found, query in zip(tables, searches):
+        expected = run_tap_query(service=tap_service.url, maxrec=1000, cache=False, **query)
+        assert sorted(np.asarray(found['obsID']).astype(str)) == sorted(np.asarray(expected['obsID']).astype(str))
+    assert set(np.char.strip(np.asarray(tables[1]['obs_collection']).astype(str))) == {'HST'}
+
+
+def test_async_entry_point_does_not_block_the_loop(catalog, search):
+    async def main(url):
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        tables = await run_tap_queries_async([search, search], service=url, maxrec=50, cache=False)
+        task.cancel()
+        return tables, ticks
+
+    with LocalTapService(catalog, latency=0.1) as tap:
+        tables, ticks = asyncio.run(main(tap.url))
+    assert [len(t) for t in tables] == [50, 50]
+    assert ticks > 10  # the loop kept running during the jobs
+
+
+def test_run_coroutine_inside_running_loop():
+    async def value():
+        await asyncio.sleep(0)
+        return 42
+
+    async def main():
+        return run_coroutine(value())
+
+    assert asyncio.run(main()) == 42
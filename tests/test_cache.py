@@ -0,0 +1,87 @@
+# Tests of the ephemeris, TAP and product caches
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from astropy.table import Table
+from movingmast.cache import EphemerisCache, TapResultCache, ProductCache
+from movingmast.mast_tap import run_tap_query
+from movingmast.products import get_product_lists
+from movingmast.target import get_path
+from movingmast.local_services import FixtureEngine
+
+TIMES = {'start': '2015-08-20', 'stop': '2015-09-01', 'step': '1d'}
+
+
+def test_get_path_second_call_is_cache_hit():
+    cache = EphemerisCache(directory=False, backend=False)
+    engine = FixtureEngine(remote=True)
+    first = get_path('1143', TIMES, cache=cache, engine=engine)
+    assert (cache.hits, cache.misses) == (0, 1)
+    second = get_path('1143', TIMES, cache=cache, engine=engine)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert len(second) == len(first)
+    assert list(second['RA']) == list(first['RA'])
+
+
+
+def test_explicit_empty_tap_cache_is_used(tap_service, search):
+    cache = TapResultCache(directory=False, backend=False)
+    first = run_tap_query(service=tap_service.url, maxrec=1000, cache=cache, **search)
+    assert len(first) > 0
+    sent = tap_service.bytes_sent
+    second = run_tap_query(service=tap_service.url, maxrec=1000, cache=cache, **search)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert tap_service.bytes_sent == sent
+    assert list(second['obsID']) == list(first['obsID'])
+
+
+def test_product_lists_cached_per_observation():
+    calls = []
+
+    def fetch(obsids):
+        calls.append(list(obsids))
+        return Table({'parent_obsid': obsids, 'productFilename': [f'{x}.fits' for x in obsids]})
+
+    cache = ProductCache(directory=False, backend=False)
+    get_product_lists(['1', '2'], cache=cache, fetch=fetch)
+    products = get_product_lists(['2', '3'], cache=cache, fetch=fetch)
+    assert calls == [['1', '2'], ['3']]
+    assert list(products['productFilename']) == ['2.fits', '3.fits']
+
+
+def test_concurrent_requests_are_coalesced():
+    cache = EphemerisCache(directory=False, backend=False)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return Table({'x': [1, 2, 3]})
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        leader = pool.submit(cache.coalesce, 'key', fetch)
+        started.wait(5)
+        followers = [pool.submit(cache.coalesce, 'key', fetch) for _ in range(3)]
+        while cache.coalesced < 3:
+            time.sleep(0.01)
+        release.set()
+        tables = [leader.result()] + [f.result() for f in followers]
+    assert len(calls) == 1
+    assert cache.coalesced == 3
+    assert all(list(t['x']) == [1, 2, 3] for t in tables)
+
+
+def test_failed_fetch_is_raised_to_waiting_requests():
+    cache = EphemerisCache(directory=False, backend=False)
+    flight, leader = cache.join('key')
+    assert leader
+    follower, leader = cache.join('key')
+    assert not leader
+    cache.finish('key', error=ValueError('Horizons error'))
+    with pytest.raises(ValueError):
+        follower.result()
@@ -0,0 +1,52 @@
+# Tests of the local ephemeris engine and its observers
+
+import numpy as np
+import pytest
+from astropy.table import Table
+from movingmast.ephemeris import HorizonsObserver, geocentric_observer, epochs_to_jd, compare_ephemerides
+
+
+def fake_vectors(calls):
+    # Vectors of an observer at the geocenter, recording the requested time ranges
+    def vectors(body, start, stop, step):
+        calls.append((start, stop))
+        grid = np.arange(start, stop + 1e-9, 0.25)
+        return grid, geocentric_observer(grid)
+    return vectors
+
+
+def test_observer_is_extended_outside_fetched_range():
+    calls = []
+    observer = HorizonsObserver('@TESS', vectors=fake_vectors(calls))
+    first = np.linspace(2458400., 2458410., 11)
+    observer(first)
+    assert len(calls) == 1
+
+    later = np.linspace(2458500., 2458501., 5)
+    xyz = observer(later)
+    assert len(calls) == 2
+    assert calls[1][0] <= first.min() and calls[1][1] >= later.max()
+    assert np.allclose(xyz, geocentric_observer(later), atol=1e-4)
+
+    observer(first)
+    assert len(calls) == 2
+
+
+def test_observer_raises_instead_of_clamping():
+    observer = HorizonsObserver('@TESS', extend=False, vectors=fake_vectors([]))
+    observer(np.array([2458400., 2458410.]))
+    with pytest.raises(ValueError):
+        observer(np.array([2458500.]))
+
+
+def test_epochs_to_jd_steps():
+    jd = epochs_to_jd({'start': '2019-01-01', 'stop': '2019-01-02', 'step': '6h'})
+    assert np.allclose(np.diff(jd), 0.25)
+    assert len(jd) == 5
+
+
+def test_compare_ephemerides_in_arcseconds():
+    eph = Table({'RA': [10., 180., 359.9999], 'DEC': [0., 60., -30.]})
+    reference = Table({'RA': [10., 180. + 2 / 3600, 0.], 'DEC': [1 / 3600, 60., -30.]})
+    expected = [1., 1., 0.0001 * 3600 * np.cos(np.radians(30.))]
+    np.testing.assert_allclose(compare_ephemerides(eph, reference), expected, rtol=1e-6)
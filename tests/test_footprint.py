@@ -0,0 +1,40 @@
+# Tests of the footprint checks on known geometries
+
+import numpy as np
+import pytest
+from movingmast.polygon import get_packed_regions
+from movingmast.footprint import FootprintIndex, swept_check
+
+# Target moving along the equator from RA 10 to 11 degrees in one day
+EPH_MJD = np.linspace(57000., 57001., 11)
+EPH_RA = np.linspace(10., 11., 11)
+EPH_DEC = np.zeros(11)
+BOX = 'POLYGON ICRS 10.2 -0.1 10.4 -0.1 10.4 0.1 10.2 0.1'
+
+
+def fractions(regions, t_min, t_max, radius=None):
+    index = FootprintIndex(get_packed_regions(regions), np.asarray(t_min, dtype=float) + 57000.,
+                           np.asarray(t_max, dtype=float) + 57000.)
+    return swept_check(index, EPH_RA, EPH_DEC, EPH_MJD, radius=radius)
+
+
+def test_swept_fraction_of_exposure():
+    found = fractions([BOX, BOX, BOX, BOX], [0., 0.2, 0.5, 0.3], [1., 0.3, 0.6, 0.5])
+    np.testing.assert_allclose(found, [0.2, 1., 0., 0.5], atol=1e-6)
+
+
+def test_swept_fraction_grown_by_radius():
+    found = fractions([BOX, BOX], [0., 0.5], [1., 0.6], radius=0.05)
+    np.testing.assert_allclose(found, [0.3, 0.], atol=1e-4)
+
+    # Beside the path, only reached with the radius
+    beside = 'POLYGON ICRS 10.2 0.03 10.4 0.03 10.4 0.2 10.2 0.2'
+    np.testing.assert_allclose(fractions([beside], [0.], [1.]), [0.], atol=1e-9)
+    assert fractions([beside], [0.], [1.], radius=0.05)[0] == pytest.approx(0.2 + 2 * 0.04, abs=1e-4)
+
+
+def test_swept_fraction_through_circle():
+    # Chord through the center of a circle (polygon of 16 vertices)
+    found = fractions(['CIRCLE ICRS 10.7 0 0.05', 'CIRCLE ICRS 10.7 0.5 0.05'], [0., 0.], [1., 1.])
+    assert found[0] == pytest.approx(0.1, abs=0.003)
+    assert found[1] == 0
@@ -0,0 +1,48 @@
+# Tests of the local stand-ins with the fixtures recorded in benchmarks/fixtures
+
+import os
+import numpy as np
+import pytest
+from astropy.table import Table
+from movingmast.target import get_path
+from movingmast.mast_tap import iter_chunked_tap_query
+from movingmast.local_services import FixtureEngine, LocalTapService, read_tap_fixtures, read_moving_targets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+
+
+@pytest.fixture(scope='module')
+def target():
+    targets = [x for x in read_moving_targets(os.path.join(ROOT, 'moving_targets.txt')) if x['obj_name'] == '1143']
+    assert len(targets) == 1
+    return targets[0]
+
+
+def test_fixture_engine_serves_recorded_ephemerides(target):
+    engine = FixtureEngine(FIXTURES, synthetic=False)
+    recorded = Table.read(os.path.join(FIXTURES, 'horizons', '1143_smallbody.ecsv'))
+    times = {'start': target['start'], 'stop': target['stop'], 'step': '1h'}
+    eph = get_path(target['obj_name'], times, id_type=target['id_type'], cache=False, engine=engine)
+    assert len(eph) == 12 * 24 + 1
+    # Recorded every 6h, interpolated in between
+    np.testing.assert_allclose(np.asarray(eph['RA'][::6]), np.asarray(recorded['RA']), atol=1e-9)
+    np.testing.assert_allclose(np.asarray(eph['DEC'][::6]), np.asarray(recorded['DEC']), atol=1e-9)
+
+    with pytest.raises(ValueError):
+        engine.ephemerides(target['obj_name'], {'start': '2015-09-01', 'stop': '2015-09-03', 'step': '1d'},
+                           id_type=target['id_type'])
+    with pytest.raises(ValueError):
+        engine.ephemerides('2060', times)
+
+
+def test_recorded_results_are_served_again(target):
+    engine = FixtureEngine(FIXTURES, synthetic=False)
+    catalog = read_tap_fixtures(FIXTURES)
+    assert len(catalog) > 0
+    times = {'start': target['start'], 'stop': target['stop'], 'step': '6h'}
+    eph = get_path(target['obj_name'], times, id_type=target['id_type'], cache=False, engine=engine)
+    with LocalTapService(catalog) as tap:
+        pages = list(iter_chunked_tap_query(eph, service=tap.url, cache=False))
+    ids = np.concatenate([np.asarray(page['obsID']) for page in pages])
+    assert sorted(ids) == sorted(np.asarray(catalog['obsID']))
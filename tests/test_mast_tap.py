@@ -0,0 +1,121 @@
+# Tests of the TAP searches against the local stand-in service
+
+import time
+import asyncio
+import numpy as np
+from astropy.table import vstack
+from astropy.time import Time
+from movingmast.mast_tap import (run_tap_query, iter_tap_query, iter_chunked_tap_query, clean_up_results,
+                                 run_chunked_tap_query, run_chunked_tap_query_async, fetch_columns, mjd_to_iso, jd_to_iso, VERIFY_COLUMNS)
+from movingmast.local_services import LocalTapService
+from conftest import TARGET, RADIUS
+
+
+def test_iter_tap_query_pages(tap_service, search):
+    everything = run_tap_query(service=tap_service.url, maxrec=100000, cache=False, **search)
+    pages = list(iter_tap_query(service=tap_service.url, page_size=40, cache=False, **search))
+    assert len(everything) > 100
+    assert [len(page) for page in pages[:-1]] == [40] * (len(pages) - 1)
+    assert 0 < len(pages[-1]) <= 40
+    ids = np.concatenate([np.asarray(page['obsID']).astype(str) for page in pages])
+    assert len(ids) == len(set(ids)) == len(everything)
+    assert set(ids) == set(np.asarray(everything['obsID']).astype(str))
+    assert 't_mid' in pages[0].colnames
+
+
+def test_iter_tap_query_max_records(tap_service, search):
+    pages = list(iter_tap_query(service=tap_service.url, page_size=40, max_records=90, cache=False, **search))
+    assert [len(page) for page in pages] == [40, 40, 10]
+
+
+def test_chunked_stream_deduplicates_segments(tap_service, eph):
+    calls = []
+    pages = list(iter_chunked_tap_query(eph, radius=RADIUS, max_days=2, service=tap_service.url, page_size=25,
+                                        cache=False, progress=lambda *args: calls.append(args)))
+    ids = np.concatenate([np.asarray(page['obsID']).astype(str) for page in pages])
+    assert len(ids) == len(set(ids)) > 0
+    n_segments = calls[0][1]
+    assert n_segments > 1
+    assert calls[-1] == (n_segments, n_segments, len(ids))
+
+    limited = list(iter_chunked_tap_query(eph, radius=RADIUS, max_days=2, service=tap_service.url, page_size=25,
+                                          cache=False, max_records=30))
+    assert sum(len(page) for page in limited) == 30
+
+
+def test_chunked_stream_queries_segments_concurrently(catalog, eph):
+    with LocalTapService(catalog, latency=0.2) as tap:
+        elapsed = {}
+        for workers in (1, 6):
+            start = time.perf_counter()
+            pages = list(iter_chunked_tap_query(eph, radius=RADIUS, max_days=2, service=tap.url, page_size=1000,
+                                                cache=False, max_concurrent=workers))
+            elapsed[workers] = time.perf_counter() - start
+            assert sum(len(page) for page in pages) > 0
+    assert elapsed[6] < 0.6 * elapsed[1]
+
+
+def test_mjd_to_iso_matches_astropy():
+    rng = np.random.default_rng(3)
+    mjd = np.concatenate([rng.uniform(40000., 60000., 1000), [57000., 57000.5, 58849.999999]])
+    assert list(mjd_to_iso(mjd)) == list(Time(mjd, format='mjd').iso)
+    assert list(jd_to_iso(mjd + 2400000.5)) == list(Time(mjd + 2400000.5, format='jd').iso)
+    assert list(mjd_to_iso([np.nan, 57000.])) == ['', Time(57000., format='mjd').iso]
+
+
+def test_dates_only_for_verified_rows(tap_service, search, eph, engine):
+    pages = list(iter_tap_query(service=tap_service.url, page_size=100, cache=False, **search))
+    assert 't_mid' in pages[0].colnames and 'obs_mid_date' not in pages[0].colnames
+
+    results = run_tap_query(service=tap_service.url, maxrec=100000, cache=False, **search)
+    expected = Time(np.asarray(results['t_mid']), format='jd').iso
+    assert list(results['obs_mid_date']) == list(expected)
+
+    t = vstack(pages)
+    verified = clean_up_results(t, TARGET['obj_name'], orig_eph=eph, radius=RADIUS, swept=True, engine=engine)
+    assert 0 < len(verified) < len(t)
+    assert list(verified['start_date']) == list(Time(np.asarray(verified['t_min']), format='mjd').iso)
+
+
+def test_fetch_columns_matches_rows(tap_service, search, catalog):
+    t = run_tap_query(service=tap_service.url, maxrec=100000, cache=False, columns=VERIFY_COLUMNS, **search)
+    assert 'target_name' not in t.colnames
+    # Shuffled, with an observation unknown to the service
+    t = t[np.random.default_rng(2).permutation(len(t))]
+    t['obsID'][0] = -1
+    found = fetch_columns(t, ['target_name', 'proposal_pi', 'obs_mid_date'], service=tap_service.url,
+                          batch_size=25)
+    assert len(found) == len(t)
+    assert list(found['obsID']) == list(t['obsID'])
+
+    expected = {str(i): (str(name), str(pi)) for i, name, pi in
+                zip(catalog['obsID'], catalog['target_name'], catalog['proposal_pi'])}
+    assert found['target_name'].mask[0] and found['proposal_pi'].mask[0]
+    for row in found[1:]:
+        assert (row['target_name'], row['proposal_pi']) == expected[str(row['obsID'])]
+    assert list(found['obs_mid_date']) == list(t['obs_mid_date'])
+
+
+def test_chunked_query_without_maxrec(tap_service, eph):
+    pages = list(iter_chunked_tap_query(eph, radius=RADIUS, max_days=2, service=tap_service.url, cache=False))
+    expected = sorted(np.concatenate([np.asarray(page['obsID']) for page in pages]))
+    assert len(expected) > 100
+
+    everything = run_chunked_tap_query(eph, radius=RADIUS, max_days=2, service=tap_service.url, maxrec=None,
+                                       cache=False)
+    assert sorted(everything['obsID']) == expected
+    assert np.all(np.diff(np.asarray(everything['t_min'])) >= 0)
+    found = asyncio.run(run_chunked_tap_query_async(eph, radius=RADIUS, max_days=2, service=tap_service.url,
+                                                    maxrec=None, cache=False))
+    assert sorted(found['obsID']) == expected
+    assert len(run_chunked_tap_query(eph, radius=RADIUS, max_days=2, service=tap_service.url, maxrec=10,
+                                     cache=False)) == 10
+
+
+def test_chunked_query_columns_do_not_depend_on_segments(tap_service, eph):
+    single = run_chunked_tap_query(eph, radius=RADIUS, max_days=30, service=tap_service.url, maxrec=1000, cache=False)
+    several = run_chunked_tap_query(eph, radius=RADIUS, max_days=2, service=tap_service.url, maxrec=1000,
+                                    cache=False)
+    assert len(single) > 0 and len(several) > 0
+    assert several.colnames == single.colnames
+    assert 'obs_mid_date' in several.colnames
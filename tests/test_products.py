@@ -0,0 +1,147 @@
+# Tests of product lists and downloads
+
+import os
+import base64
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pytest
+from astropy.table import Table
+from movingmast.products import DownloadManager, download_script
+
+CONTENT = {'mast:TEST/a.fits': os.urandom(50000), 'mast:TEST/b.fits': os.urandom(1000)}
+
+
+@pytest.fixture
+def file_server():
+    # Download service serving CONTENT, with range requests and configurable digest headers
+    state = {'headers': lambda body: {}, 'corrupt': False, 'requests': []}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            uri = parse_qs(urlparse(self.path).query)['uri'][0]
+            body = CONTENT[uri]
+            state['requests'].append((uri, self.headers.get('Range')))
+            headers = state['headers'](body)
+            if state['corrupt']:
+                body = body[:-1] + bytes([body[-1] ^ 1])
+            status, start = 200, 0
+            if self.headers.get('Range'):
+                status, start = 206, int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body) - start))
+            self.end_headers()
+            self.wfile.write(body[start:])
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state['url'] = f'http://127.0.0.1:{server.server_address[1]}/download'
+    yield state
+    server.shutdown()
+
+
+def products_table(sizes=True):
+    products = Table({'obs_id': ['obs1', 'obs2'], 'productFilename': ['a.fits', 'b.fits'],
+                      'dataURI': list(CONTENT)})
+    if sizes:
+        products['size'] = [len(x) for x in CONTENT.values()]
+    return products
+
+
+def md5_header(body):
+    return base64.b64encode(hashlib.md5(body).digest()).decode()
+
+
+def test_downloads_verified_with_content_md5(tmp_path, file_server):
+    file_server['headers'] = lambda body: {'Content-MD5': md5_header(body)}
+    manager = DownloadManager(str(tmp_path), url=file_server['url'], retries=1)
+    manifest = manager.download(products_table())
+    assert list(manifest['Status']) == ['COMPLETE', 'COMPLETE']
+    with open(tmp_path / 'obs1' / 'a.fits', 'rb') as f:
+        assert f.read() == CONTENT['mast:TEST/a.fits']
+
+    # Complete files are not downloaded again
+    manifest = manager.download(products_table())
+    assert list(manifest['Status']) == ['SKIPPED', 'SKIPPED']
+
+
+def test_corrupted_download_fails_digest_check(tmp_path, file_server):
+    def sha256_header(body):
+        return {'Digest': 'sha-256=' + base64.b64encode(hashlib.sha256(body).digest()).decode()}
+
+    file_server['headers'] = sha256_header
+    file_server['corrupt'] = True
+    manager = DownloadManager(str(tmp_path), url=file_server['url'], retries=1)
+    manifest = manager.download(products_table())
+    assert list(manifest['Status']) == ['ERROR', 'ERROR']
+    assert all(message.startswith('Checksum mismatch') for message in manifest['Message'])
+    assert not os.path.exists(tmp_path / 'obs1' / 'a.fits')
+
+
+def test_without_digest_only_the_size_is_checked(tmp_path, file_server):
+    file_server['corrupt'] = True
+    manager = DownloadManager(str(tmp_path), url=file_server['url'], retries=1)
+    manifest = manager.download(products_table())
+    assert list(manifest['Status']) == ['COMPLETE', 'COMPLETE']
+
+
+def test_checksum_column_takes_precedence(tmp_path, file_server):
+    products = products_table()
+    products['md5'] = ['0' * 32, hashlib.md5(CONTENT['mast:TEST/b.fits']).hexdigest()]
+    manager = DownloadManager(str(tmp_path), url=file_server['url'], retries=1, checksum_column='md5')
+    manifest = manager.download(products)
+    assert list(manifest['Status']) == ['ERROR', 'COMPLETE']
+
+
+def test_partial_download_is_resumed(tmp_path, file_server):
+    body = CONTENT['mast:TEST/a.fits']
+    os.makedirs(tmp_path / 'obs1')
+    with open(tmp_path / 'obs1' / 'a.fits.part', 'wb') as f:
+        f.write(body[:20000])
+    file_server['headers'] = lambda body: {'Repr-Digest': 'md5=:' + md5_header(body) + ':'}
+    manager = DownloadManager(str(tmp_path), url=file_server['url'], retries=1)
+    manifest = manager.download(products_table()[:1])
+    assert list(manifest['Status']) == ['COMPLETE']
+    assert file_server['requests'] == [('mast:TEST/a.fits', 'bytes=20000-')]
+    assert manager.bytes_received == len(body) - 20000
+    with open(tmp_path / 'obs1' / 'a.fits', 'rb') as f:
+        assert f.read() == body
+
+
+def test_download_script_quotes_paths_and_uris():
+    products = Table({'obs_id': ['hst_a', 'k2 b'], 'productFilename': ['a.fits', "b'c.fits"],
+                      'dataURI': ['mast:HST/product/a.fits', 'mast:K2/url/b&c.fits']})
+    lines = download_script(products, directory='files').splitlines()
+    assert lines[0] == '#!/bin/sh'
+    assert len(lines) == 4
+    assert "-o files/hst_a/a.fits 'https://mast.stsci.edu/api/v0.1/Download/file?uri=mast%3AHST%2Fproduct%2Fa.fits'" \
+        in lines[2]
+    assert "-o 'files/k2 b/b'\"'\"'c.fits'" in lines[3]
+    assert 'uri=mast%3AK2%2Furl%2Fb%26c.fits' in lines[3]
+
+
+def test_local_paths_stay_in_the_directory(tmp_path, file_server):
+    products = Table({'obs_id': ['../../outside', '..', 'obs/..'], 'productFilename': ['a.fits', 'b.fits', 'c.fits'],
+                      'dataURI': ['mast:TEST/a.fits', 'mast:TEST/b.fits', 'mast:TEST/c.fits']})
+    manager = DownloadManager(str(tmp_path / 'files'), url=file_server['url'])
+    assert manager.local_path(products[0]) == str(tmp_path / 'files' / 'outside' / 'a.fits')
+    for row in products[1:]:
+        with pytest.raises(ValueError):
+            manager.local_path(row)
+
+    manifest = manager.download(products)
+    assert list(manifest['Status']) == ['COMPLETE', 'ERROR', 'ERROR']
+    assert 'Invalid obs_id' in manifest['Message'][1]
+    assert sorted(str(p.relative_to(tmp_path)) for p in tmp_path.rglob('*') if p.is_file()) == \
+        ['files/outside/a.fits']
+
+    lines = download_script(products, directory='files').splitlines()
+    assert '-o files/outside/a.fits ' in lines[2]
+    assert lines[3].startswith('# Skipped: Invalid obs_id') and lines[4].startswith('# Skipped: Invalid obs_id')
@@ -0,0 +1,49 @@
+# Tests of the paginated result tables of the dashboard
+
+import numpy as np
+from astropy.table import Table
+from movingmast.tables import ResultTable
+
+
+def make_table():
+    return Table({'obs_id': ['b2', 'A1', 'c3', 'a4', 'B5'],
+                  'obs_collection': np.array([b'HST', b'K2', b'HST', b'TESS', b'K2']),
+                  't_min': [5., 3., 4., 1., 3.],
+                  'hidden': ['x', 'x', 'hst', 'x', 'x']})
+
+
+def test_sort():
+    view = ResultTable(make_table(), columns=['obs_id', 'obs_collection', 't_min', 'missing'], page_size=2)
+    assert view.columns == ['obs_id', 'obs_collection', 't_min']
+    assert list(view.rows()) == [0, 1, 2, 3, 4]
+    # Stable, ties in table order
+    assert list(view.rows(sort='t_min')) == [3, 1, 4, 2, 0]
+    assert list(view.rows(sort='t_min', descending=True)) == [0, 2, 4, 1, 3]
+    assert list(view.rows(sort='obs_collection')) == [0, 2, 1, 4, 3]
+    assert list(view.rows(sort='unknown')) == [0, 1, 2, 3, 4]
+
+
+def test_filter():
+    view = ResultTable(make_table(), columns=['obs_id', 'obs_collection', 't_min'], page_size=2)
+    # Case-insensitive, in the displayed columns only (not in hidden)
+    assert list(view.rows(query=' hst ')) == [0, 2]
+    assert list(view.rows(query='a')) == [1, 3]
+    assert list(view.rows(sort='t_min', query='k2')) == [1, 4]
+    assert list(view.rows(query='3')) == [1, 2, 4]
+    assert len(view.rows(query='nothing')) == 0
+    assert view.rows(query='hst') is view.rows(query='HST')
+
+
+def test_pages():
+    view = ResultTable(make_table(), columns=['obs_id', 't_min'], page_size=2)
+    assert view.n_pages() == 3
+    page, first, n_rows = view.page(1, sort='t_min')
+    assert page.colnames == ['obs_id', 't_min']
+    assert list(page['obs_id']) == ['B5', 'c3'] and (first, n_rows) == (2, 5)
+    # Out of range pages are clipped
+    page, first, _ = view.page(10, sort='t_min')
+    assert list(page['obs_id']) == ['b2'] and first == 4
+    page, first, n_rows = view.page(-1, query='k2')
+    assert len(page) == 0 and n_rows == 0
+    assert view.to_html(0, query='nothing') == '<p>No matching rows.</p>'
+    assert view.to_html(0).startswith('<p>Rows 1 to 2 of 5</p>')
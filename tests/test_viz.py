@@ -0,0 +1,24 @@
+# Tests of the background jobs of the dashboard, against the local stand-in service
+
+import functools
+from movingmast import viz
+from movingmast.jobs import Job
+from movingmast.mast_tap import clean_up_results
+from conftest import TARGET, RADIUS
+
+
+def test_mast_job_fetches_displayed_columns(monkeypatch, tap_service, eph, search, engine):
+    monkeypatch.setattr(viz, 'iter_chunked_tap_query',
+                        functools.partial(viz.iter_chunked_tap_query, service=tap_service.url, cache=False))
+    monkeypatch.setattr(viz, 'fetch_columns', functools.partial(viz.fetch_columns, service=tap_service.url))
+    monkeypatch.setattr(viz, 'clean_up_results', functools.partial(clean_up_results, engine=engine))
+
+    job = Job(name='MAST search')
+    target = {'obj_name': TARGET['obj_name'], 'id_type': TARGET['id_type'], 'location': None}
+    results = viz._mast_job(job, eph, search['stcs'], RADIUS, None, None, viz.MastQuery.plot_cols, target=target,
+                            display_columns=['obs_id', 't_exptime', 'dataproduct_type', 'obs_mid_date'])
+    assert len(results) > 0
+    assert job.message.startswith('Fetching 2 more columns')
+    for col in ['t_exptime', 'dataproduct_type', 'obs_mid_date', 'footprint_fraction']:
+        assert col in results.colnames
+    assert not any(getattr(results['t_exptime'], 'mask', [False]))